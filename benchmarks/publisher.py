@@ -0,0 +1,100 @@
+"""
+Compare publishes/s of publish_logs against the old declare-per-message path.
+
+The broker is replaced by an in-memory stand-in that adds a fixed delay to
+every RPC, so the numbers reflect broker round trips rather than network noise.
+
+Usage:
+    python -m benchmarks.publisher [messages] [rpc_latency_ms]
+"""
+import asyncio
+import json
+import sys
+import time
+from contextlib import asynccontextmanager
+
+import aio_pika
+from aio_pika import DeliveryMode, ExchangeType
+
+from infrastructure.queue import publisher
+
+
+class FakeExchange:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.published = 0
+
+    async def publish(self, message, routing_key):
+        await asyncio.sleep(self.latency)  # publisher confirm
+        self.published += 1
+
+
+class FakeQueue:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def bind(self, exchange, routing_key):
+        await asyncio.sleep(self.latency)
+
+
+class FakeChannel:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.close_callbacks = set()
+        self.reopen_callbacks = set()
+
+    async def declare_exchange(self, name, type):
+        await asyncio.sleep(self.latency)
+        return FakeExchange(self.latency)
+
+    async def declare_queue(self, name):
+        await asyncio.sleep(self.latency)
+        return FakeQueue(self.latency)
+
+
+class FakePool:
+    def __init__(self, latency: float):
+        self.channel = FakeChannel(latency)
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.channel
+
+
+async def publish_logs_redeclare(data: dict) -> None:
+    """The publisher as it was before topology caching."""
+    async with publisher.channel_pool.acquire() as channel:
+        exchange = await channel.declare_exchange("logs", type=ExchangeType.DIRECT)
+        queue = await channel.declare_queue(publisher.queue_name)
+        await queue.bind(exchange, publisher.routing_key)
+
+        message = aio_pika.Message(
+            body=json.dumps(data).encode(), delivery_mode=DeliveryMode.PERSISTENT
+        )
+        await exchange.publish(message=message, routing_key=publisher.routing_key)
+
+
+async def run(publish, messages: int) -> float:
+    data = {"index": "wallet_transactions", "document": {"message": "benchmark"}}
+    started = time.perf_counter()
+    for _ in range(messages):
+        await publish(data)
+    return messages / (time.perf_counter() - started)
+
+
+async def main(messages: int, latency: float) -> None:
+    publisher.channel_pool = FakePool(latency)
+    publisher._exchanges.clear()
+
+    before = await run(publish_logs_redeclare, messages)
+    after = await run(publisher.publish_logs, messages)
+
+    print(f"re-declare per message: {before:10.0f} publishes/s")
+    print(f"cached topology:        {after:10.0f} publishes/s")
+    print(f"speedup:                {after / before:10.1f}x")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    asyncio.run(main(count, latency_ms / 1000))
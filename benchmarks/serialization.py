@@ -0,0 +1,159 @@
+"""
+Compare the CPU time spent serializing deposit and batch requests before and
+after the orjson serialization path.
+
+Before: the event is dumped once per use, the endpoint returns a BaseResponse
+that FastAPI validates and encodes with the stdlib JSON encoder, and the audit
+log is encoded with json.dumps. After: the event is dumped once and reused, and
+the response and the log are encoded with orjson.
+
+Each scenario runs both paths for several alternating rounds over fresh events
+and reports the median CPU time per request with the spread of the saving, so
+the difference can be told apart from noise.
+
+Usage:
+    python -m benchmarks.serialization [requests] [rounds]
+"""
+import json
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import orjson
+from pydantic import TypeAdapter
+
+from domain.events import Deposited
+from presentation.schemas import BaseResponse
+
+BATCH_SIZE = 100
+
+response_adapter = TypeAdapter(BaseResponse)
+
+
+def audit_log(event: Deposited) -> dict:
+    return {
+        "index": "wallet_transactions",
+        "document": {
+            "message": "Deposit successful",
+            "success": True,
+            "wallet_id": event.wallet_id,
+            "amount": event.amount,
+            "timestamp": datetime.now().timestamp(),
+        },
+    }
+
+
+def stdlib_response(data) -> None:
+    response = BaseResponse(
+        data=data, message="Deposit successful", status=200, success=True
+    )
+    # What FastAPI does with a response model: validate, serialize, json.dumps.
+    content = response_adapter.dump_python(
+        response_adapter.validate_python(response), mode="json"
+    )
+    json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def orjson_response(data) -> None:
+    orjson.dumps(
+        {
+            "data": data,
+            "message": "Deposit successful",
+            "status": 200,
+            "success": True,
+        }
+    )
+
+
+def stdlib_deposit(events: list[Deposited]) -> None:
+    event = events[0]
+    event.model_dump()  # inserted into WalletEvents
+    stdlib_response(event.model_dump())
+    json.dumps(audit_log(event)).encode()
+
+
+def orjson_deposit(events: list[Deposited]) -> None:
+    event = events[0]
+    dict(event.to_document())  # inserted into WalletEvents
+    orjson_response(event.to_document())
+    orjson.dumps(audit_log(event))
+
+
+def stdlib_batch(events: list[Deposited]) -> None:
+    for event in events:
+        event.model_dump()  # inserted into WalletEvents
+        json.dumps(audit_log(event)).encode()
+    stdlib_response(
+        [
+            {"success": True, "message": "", "data": event.model_dump()}
+            for event in events
+        ]
+    )
+
+
+def orjson_batch(events: list[Deposited]) -> None:
+    for event in events:
+        dict(event.to_document())  # inserted into WalletEvents
+        orjson.dumps(audit_log(event))
+    orjson_response(
+        [
+            {"success": True, "message": "", "data": event.to_document()}
+            for event in events
+        ]
+    )
+
+
+SCENARIOS = {
+    "deposit": (stdlib_deposit, orjson_deposit, 1),
+    f"batch of {BATCH_SIZE}": (stdlib_batch, orjson_batch, BATCH_SIZE),
+}
+
+
+def measure(path, requests: int, events_per_request: int) -> float:
+    """Return the CPU seconds per request, over events created beforehand."""
+    batches = [
+        [
+            Deposited(wallet_id="f0b70509-0d5d-4240-9466-4ed99106d513", amount=i + 1)
+            for i in range(events_per_request)
+        ]
+        for _ in range(requests)
+    ]
+    started = time.process_time()
+    for events in batches:
+        path(events)
+    return (time.process_time() - started) / requests
+
+
+def main(requests: int, rounds: int) -> None:
+    for name, (stdlib_path, orjson_path, events_per_request) in SCENARIOS.items():
+        # Fewer requests for larger payloads keeps every scenario's run time
+        # (and the number of events alive at once) about the same.
+        count = max(1, requests // events_per_request)
+        before, after = [], []
+        for _ in range(rounds):
+            before.append(measure(stdlib_path, count, events_per_request))
+            after.append(measure(orjson_path, count, events_per_request))
+        saved = [b - a for b, a in zip(before, after)]
+
+        print(f"{name} ({count} requests x {rounds} rounds)")
+        print(
+            f"  stdlib + response model: {statistics.median(before) * 1e6:9.2f} "
+            "us CPU/request"
+        )
+        print(
+            f"  orjson, dumped once:     {statistics.median(after) * 1e6:9.2f} "
+            "us CPU/request"
+        )
+        print(
+            f"  saved:                   {statistics.median(saved) * 1e6:9.2f} "
+            f"us CPU/request ({min(saved) * 1e6:.2f} .. {max(saved) * 1e6:.2f}, "
+            f"{statistics.median(saved) / statistics.median(before):.0%})"
+        )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+    )
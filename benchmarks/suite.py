@@ -0,0 +1,281 @@
+"""
+In-process benchmarks for the domain, repository, service and publisher layers.
+
+MongoDB is replaced by mongomock-motor (see requirements.txt) unless
+BENCH_MONGO_URL points at a local mongod, and RabbitMQ by the in-memory broker
+of ``benchmarks.publisher``. Results are written as JSON and compared against
+the committed ``benchmarks/baseline.json``; the run exits non-zero when a
+median got slower than both the relative threshold and an absolute floor
+(``--min-delta-us``), or when no baseline is stored:
+
+    python -m benchmarks.suite                    # run, compare with baseline
+    python -m benchmarks.suite --save-baseline    # run, store as new baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from domain.events import Deposited, WalletCreated, Withdrawn
+from infrastructure import repository
+from infrastructure.data_access import mongo_instance
+from infrastructure.queue import publisher
+from infrastructure.repository import WalletCommandRepository, WalletQueryRepository
+from services.queries import WalletQueryService
+
+from benchmarks.publisher import FakePool
+
+BENCH_DIR = Path(__file__).parent
+BASELINE_PATH = BENCH_DIR / "baseline.json"
+RESULTS_PATH = BENCH_DIR / "results.json"
+BENCH_MONGO_URL = os.getenv("BENCH_MONGO_URL", "")
+
+BENCHMARKS: dict[str, Callable[["Context"], Awaitable[None]]] = {}
+
+
+def benchmark(name: str):
+    """Register an async function running one iteration of a benchmark."""
+
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+class LocalTransactionRunner:
+    """Runs transaction logic without a session, for stand-ins lacking transactions."""
+
+    async def run(self, client, transaction_func, wallet_id=None):
+        await transaction_func(None)
+
+
+class Context:
+    """Shared fixtures: one funded wallet to deposit to, withdraw from and query."""
+
+    def __init__(self):
+        self.commands = WalletCommandRepository()
+        self.queries = WalletQueryRepository()
+        self.user_ids = iter(range(1_000_000, sys.maxsize))
+        self.wallet_id = None
+        self.event = None
+
+    async def setup(self):
+        event = WalletCreated(user_id=next(self.user_ids), wallet_id=str(uuid.uuid4()))
+        await self.commands.apply(event)
+        self.wallet_id = event.wallet_id
+        self.event = Deposited(wallet_id=self.wallet_id, amount=10)
+        for _ in range(200):
+            await self.commands.apply(Deposited(wallet_id=self.wallet_id, amount=10))
+
+
+def use_stand_ins() -> None:
+    if BENCH_MONGO_URL:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        client = AsyncIOMotorClient(BENCH_MONGO_URL)
+        mongo_instance.client = client
+        mongo_instance.database = client["WalletBenchmark"]
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+
+        client = AsyncMongoMockClient()
+        mongo_instance.client = client
+        mongo_instance.database = client["WalletBenchmark"]
+        repository.transaction_runner = LocalTransactionRunner()
+
+    publisher.channel_pool = FakePool(latency=0)
+    publisher._exchanges.clear()
+
+
+@benchmark("events.construct_deposited")
+async def construct_deposited(ctx: Context):
+    Deposited(wallet_id=ctx.wallet_id, amount=10)
+
+
+@benchmark("events.model_dump_deposited")
+async def model_dump_deposited(ctx: Context):
+    ctx.event.model_dump()
+
+
+@benchmark("repository.apply_wallet_created")
+async def apply_wallet_created(ctx: Context):
+    await ctx.commands.apply(
+        WalletCreated(user_id=next(ctx.user_ids), wallet_id=str(uuid.uuid4()))
+    )
+
+
+@benchmark("repository.apply_deposited")
+async def apply_deposited(ctx: Context):
+    await ctx.commands.apply(Deposited(wallet_id=ctx.wallet_id, amount=10))
+
+
+@benchmark("repository.apply_withdrawn")
+async def apply_withdrawn(ctx: Context):
+    await ctx.commands.apply(Withdrawn(wallet_id=ctx.wallet_id, amount=1))
+
+
+@benchmark("repository.get_wallet")
+async def get_wallet(ctx: Context):
+    await ctx.queries.get_wallet(wallet_id=ctx.wallet_id)
+
+
+@benchmark("repository.get_balance")
+async def get_balance(ctx: Context):
+    await ctx.queries.get_balance(wallet_id=ctx.wallet_id)
+
+
+@benchmark("repository.get_transactions")
+async def get_transactions(ctx: Context):
+    await ctx.queries.get_transactions(wallet_id=ctx.wallet_id, limit=100)
+
+
+@benchmark("repository.get_events")
+async def get_events(ctx: Context):
+    now = datetime.now()
+    await ctx.queries.get_events(
+        wallet_id=ctx.wallet_id,
+        from_date=now - timedelta(days=1),
+        to_date=now,
+        include_transactions=True,
+    )
+
+
+@benchmark("services.wallet_query_cached")
+async def wallet_query_cached(ctx: Context):
+    await WalletQueryService().execute(wallet_id=ctx.wallet_id)
+
+
+@benchmark("publisher.publish_logs")
+async def publish_logs(ctx: Context):
+    await publisher.publish_logs(
+        {"index": "wallet_transactions", "document": {"message": "benchmark"}}
+    )
+
+
+async def run_benchmark(func, ctx: Context, iterations: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        await func(ctx)
+
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await func(ctx)
+        timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    return {
+        "iterations": iterations,
+        "mean_us": statistics.fmean(timings) * 1e6,
+        "median_us": statistics.median(timings) * 1e6,
+        "p95_us": timings[int(len(timings) * 0.95) - 1] * 1e6,
+        "ops_per_second": iterations / sum(timings),
+    }
+
+
+def medians(results: dict, baseline: dict) -> dict:
+    """Return the (baseline, current) median of every benchmark in both."""
+    return {
+        name: (baseline[name]["median_us"], result["median_us"])
+        for name, result in results.items()
+        if name in baseline and "median_us" in result
+    }
+
+
+def is_regression(
+    before: float, after: float, threshold: float, min_delta_us: float
+) -> bool:
+    """
+    A median regressed when it got slower than the baseline by more than
+    ``threshold`` (a fraction) and by at least ``min_delta_us``. The absolute
+    floor keeps host noise on microsecond benchmarks from failing the run.
+    """
+    return after - before > before * threshold and after - before >= min_delta_us
+
+
+def compare(
+    results: dict, baseline: dict, threshold: float, min_delta_us: float
+) -> list[str]:
+    """
+    Print every median next to its baseline and return the benchmarks that
+    regressed.
+    """
+    regressions = []
+    for name, (before, after) in medians(results, baseline).items():
+        regressed = is_regression(before, after, threshold, min_delta_us)
+        marker = "REGRESSION" if regressed else ""
+        change = (after - before) / before
+        print(f"{name:40} {before:10.1f}us -> {after:10.1f}us {change:+7.1%} {marker}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+async def main(args) -> int:
+    use_stand_ins()
+    ctx = Context()
+    await ctx.setup()
+
+    results = {}
+    for name, func in BENCHMARKS.items():
+        if args.only and args.only not in name:
+            continue
+        try:
+            results[name] = await run_benchmark(func, ctx, args.iterations, args.warmup)
+        except NotImplementedError as e:
+            # mongomock lacks some operators used by the repositories.
+            results[name] = {"skipped": str(e)}
+            print(f"{name:40} skipped: {e}")
+            continue
+        print(
+            f"{name:40} median {results[name]['median_us']:10.1f}us "
+            f"p95 {results[name]['p95_us']:10.1f}us "
+            f"{results[name]['ops_per_second']:10.0f} ops/s"
+        )
+
+    if args.save_baseline:
+        Path(args.output).write_text(json.dumps(results, indent=2, sort_keys=True))
+        BASELINE_PATH.write_text(json.dumps(results, indent=2, sort_keys=True))
+        return 0
+
+    if not BASELINE_PATH.exists():
+        print("No baseline stored, run with --save-baseline to create one.")
+        return 1
+
+    baseline = json.loads(BASELINE_PATH.read_text())
+    for name, (before, after) in medians(results, baseline).items():
+        if not is_regression(before, after, args.threshold, args.min_delta_us):
+            continue
+        # Measure a suspected regression once more and keep the faster median,
+        # so a single noisy run does not fail the comparison.
+        print(f"{name:40} rerun: {(after - before) / before:+.1%} slower")
+        rerun = await run_benchmark(BENCHMARKS[name], ctx, args.iterations, args.warmup)
+        if rerun["median_us"] < results[name]["median_us"]:
+            results[name] = rerun
+
+    Path(args.output).write_text(json.dumps(results, indent=2, sort_keys=True))
+
+    print()
+    regressions = compare(results, baseline, args.threshold, args.min_delta_us)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument(
+        "--only", default="", help="run benchmarks whose name contains this"
+    )
+    parser.add_argument("--output", default=str(RESULTS_PATH))
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--min-delta-us", type=float, default=2.0)
+    parser.add_argument("--save-baseline", action="store_true")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -1,5 +1,6 @@
 import uuid
 from datetime import datetime
+from functools import cached_property
 from pydantic import BaseModel, Field, field_validator
 
 
@@ -14,6 +15,21 @@ class Event(BaseModel):
         if not hasattr(cls, "event_type"):
             cls.event_type = cls.__name__
 
+    def to_document(self) -> dict:
+        """
+        Return the event as a dict. The event is dumped on the first call only
+        and the same dict is returned afterwards, so callers that mutate it
+        (e.g. Mongo inserts adding an _id) must work on a copy.
+        """
+        return self._document
+
+    @cached_property
+    def _document(self) -> dict:
+        # A cached_property rather than a PrivateAttr: pydantic resolves
+        # private attributes through __getattr__, which costs more than the
+        # dump it would save.
+        return self.model_dump()
+
 
 class WalletCreated(Event):
     user_id: int
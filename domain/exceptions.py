@@ -2,5 +2,25 @@ class NegativeBalanceError(ValueError):
     pass
 
 
+class WalletNotFoundError(LookupError):
+    pass
+
+
+class DuplicateCommandError(ValueError):
+    pass
+
+
+class IdempotencyKeyReusedError(ValueError):
+    pass
+
+
+class ConcurrentAppendError(RuntimeError):
+    pass
+
+
 class MongoConnectionError(ConnectionError):
     pass
+
+
+class ProjectionLagError(TimeoutError):
+    pass
@@ -0,0 +1,431 @@
+"""
+Bucketed event storage.
+
+With ``EVENT_STORAGE=buckets`` the events of a wallet are stored in
+WalletEventBuckets instead of one WalletEvents document each. A bucket holds
+up to ``BUCKET_MAX_EVENTS`` events of one wallet and one day, in commit order,
+along with the bounds of their timestamps and running totals (deposited,
+withdrawn, and the net change to the balance). The command repository pushes
+events into the open bucket of their wallet in the same transaction as the
+balance update.
+
+Range reads select buckets by their timestamp bounds. Buckets entirely inside
+the range contribute their totals without their events being read; only the
+buckets straddling a bound are filtered event by event, inside the
+aggregation. The totals make
+snapshots unnecessary: the balance at a point in time is the sum of the net
+changes of the buckets before it.
+
+Buckets apply to the synchronous projection; with the asynchronous one the
+event log stays one document per versioned event.
+
+Reads only see buckets: the events already in WalletEvents are copied into
+buckets while no API process is writing, before switching modes. Each wallet's
+buckets are rebuilt from scratch, so an interrupted migration is resumed by
+running it again:
+
+    python -m infrastructure.buckets migrate
+"""
+import argparse
+import asyncio
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import List
+
+from domain.events import Event
+from infrastructure.codec import codec
+from infrastructure.data_access import mongo_instance
+from infrastructure.snapshots import signed_amount
+
+EVENT_STORAGE = os.getenv("EVENT_STORAGE", "documents")
+BUCKET_MAX_EVENTS = int(os.getenv("BUCKET_MAX_EVENTS", "500"))
+BUCKET_MIGRATION_BATCH_SIZE = int(os.getenv("BUCKET_MIGRATION_BATCH_SIZE", "1000"))
+
+
+def bucket_day(created_at: datetime) -> datetime:
+    return created_at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _transaction_key(event: dict) -> tuple:
+    return event["created_at"], event["transaction_id"]
+
+
+class EventBucketStore:
+    """
+    Stores and reads the events of wallets in per-wallet, per-day buckets.
+    """
+
+    def __init__(self, max_events: int = BUCKET_MAX_EVENTS):
+        self.db = mongo_instance
+        self.max_events = max_events
+        self.bucket_collection = None
+
+    async def _initialize_collections(self):
+        """
+        Initialize the event bucket collection.
+        """
+        self.bucket_collection = await self.db.event_bucket_collection
+
+    async def push(self, events: List[Event], session=None) -> None:
+        """
+        Append events to the open bucket of their wallet and day, opening a
+        new bucket when it would exceed ``max_events``. The events of one call
+        for a wallet and day share a bucket, in chunks of up to ``max_events``.
+
+        Args:
+            events: The events to store, in commit order.
+            session: The MongoDB session of the command's transaction.
+        """
+        await self._push_documents(
+            [event.to_document() for event in events], session=session
+        )
+
+    async def _push_documents(self, events: List[dict], session=None) -> None:
+        """Push the (decoded) event documents; see ``push``."""
+        if not self.bucket_collection:
+            await self._initialize_collections()
+
+        groups = defaultdict(list)
+        for event in events:
+            groups[(event["wallet_id"], bucket_day(event["created_at"]))].append(event)
+
+        chunks = [
+            (wallet_id, day, group[start : start + self.max_events])
+            for (wallet_id, day), group in groups.items()
+            for start in range(0, len(group), self.max_events)
+        ]
+        for wallet_id, day, group in chunks:
+            documents = [dict(event) for event in group]
+            deposited = withdrawn = net = codec.encode_money(0.0)
+            for document in documents:
+                net += codec.encode_money(signed_amount(document))
+                if document["event_type"] == "Deposited":
+                    deposited += codec.encode_money(document["amount"])
+                elif document["event_type"] == "Withdrawn":
+                    withdrawn += codec.encode_money(document["amount"])
+                del document["wallet_id"]
+
+            await self.bucket_collection.update_one(
+                self._open_bucket_query(wallet_id, day, len(group)),
+                {
+                    "$push": {
+                        "events": {"$each": [codec.encode(d) for d in documents]}
+                    },
+                    "$inc": {
+                        "count": len(group),
+                        "deposited": deposited,
+                        "withdrawn": withdrawn,
+                        "net": net,
+                    },
+                    "$min": {"min_created_at": min(e["created_at"] for e in group)},
+                    "$max": {"max_created_at": max(e["created_at"] for e in group)},
+                },
+                upsert=True,
+                session=session,
+            )
+
+    def _open_bucket_query(self, wallet_id: str, day: datetime, events: int) -> dict:
+        """Query for the bucket of the wallet and day with room for ``events``."""
+        return {
+            "wallet_id": codec.encode_uuid(wallet_id),
+            "day": day,
+            "count": {"$lte": self.max_events - events},
+        }
+
+    @staticmethod
+    def _range(wallet_id: str, from_date: datetime, to_date: datetime):
+        """
+        The filter selecting the buckets of the wallet overlapping the range,
+        the condition on an ``$$event`` being inside it, and the condition on
+        a bucket lying entirely inside it.
+        """
+        bucket_filter = {"wallet_id": codec.encode_uuid(wallet_id)}
+        in_range = []
+        whole = []
+        if from_date:
+            bucket_filter["max_created_at"] = {"$gte": from_date}
+            in_range.append({"$gte": ["$$event.created_at", from_date]})
+            whole.append({"$gte": ["$min_created_at", from_date]})
+        if to_date:
+            bucket_filter["min_created_at"] = {"$lte": to_date}
+            in_range.append({"$lte": ["$$event.created_at", to_date]})
+            whole.append({"$lte": ["$max_created_at", to_date]})
+        return bucket_filter, {"$and": in_range}, {"$and": whole}
+
+    @classmethod
+    def _totals_pipeline(
+        cls, wallet_id: str, from_date: datetime, to_date: datetime
+    ) -> List[dict]:
+        bucket_filter, in_range, whole = cls._range(wallet_id, from_date, to_date)
+
+        def total(event_type: str, field: str) -> dict:
+            return {
+                "$let": {
+                    "vars": {
+                        "matching": {
+                            "$filter": {
+                                "input": "$events",
+                                "as": "event",
+                                "cond": {
+                                    "$eq": [
+                                        "$$event.event_type",
+                                        codec.encode_event_type(event_type),
+                                    ]
+                                },
+                            }
+                        }
+                    },
+                    "in": {"$sum": f"$$matching.{field}"},
+                }
+            }
+
+        return [
+            {"$match": bucket_filter},
+            {
+                "$project": {
+                    "whole": whole,
+                    "count": 1,
+                    "deposited": 1,
+                    "withdrawn": 1,
+                    "net": 1,
+                    "events": {
+                        "$cond": [
+                            whole,
+                            [],
+                            {
+                                "$filter": {
+                                    "input": "$events",
+                                    "as": "event",
+                                    "cond": in_range,
+                                }
+                            },
+                        ]
+                    },
+                }
+            },
+            {
+                "$project": {
+                    "count": {"$cond": ["$whole", "$count", {"$size": "$events"}]},
+                    "deposited": {
+                        "$cond": ["$whole", "$deposited", total("Deposited", "amount")]
+                    },
+                    "withdrawn": {
+                        "$cond": ["$whole", "$withdrawn", total("Withdrawn", "amount")]
+                    },
+                    "net": {
+                        "$cond": [
+                            "$whole",
+                            "$net",
+                            {
+                                "$subtract": [
+                                    {
+                                        "$add": [
+                                            total("WalletCreated", "balance"),
+                                            total("Deposited", "amount"),
+                                        ]
+                                    },
+                                    total("Withdrawn", "amount"),
+                                ]
+                            },
+                        ]
+                    },
+                }
+            },
+            {
+                "$group": {
+                    "_id": None,
+                    "count": {"$sum": "$count"},
+                    "deposited": {"$sum": "$deposited"},
+                    "withdrawn": {"$sum": "$withdrawn"},
+                    "net": {"$sum": "$net"},
+                }
+            },
+        ]
+
+    async def _totals(
+        self, wallet_id: str, from_date: datetime, to_date: datetime
+    ) -> dict:
+        """
+        Sum the deposits, withdrawals and net changes of the wallet within the
+        range, in one aggregation. Buckets entirely inside the range
+        contribute their totals; only the events of the buckets straddling a
+        bound are filtered and summed, by MongoDB.
+
+        Returns:
+            dict: The deposited, withdrawn and net totals and the number of
+                events.
+        """
+        pipeline = self._totals_pipeline(wallet_id, from_date, to_date)
+        result = await self.bucket_collection.aggregate(pipeline).to_list(length=1)
+        totals = result[0] if result else {}
+        return {
+            "deposited": codec.decode_money(totals.get("deposited", 0)),
+            "withdrawn": codec.decode_money(totals.get("withdrawn", 0)),
+            "net": codec.decode_money(totals.get("net", 0)),
+            "count": totals.get("count", 0),
+        }
+
+    async def balance_at(
+        self, wallet_id: str, at: datetime, inclusive: bool = True
+    ) -> float:
+        """
+        Compute the balance of the wallet at the given time from the net
+        changes of the buckets before it.
+        """
+        if not self.bucket_collection:
+            await self._initialize_collections()
+
+        # Stored times have millisecond precision: one microsecond earlier
+        # excludes events recorded exactly at ``at``.
+        before = at if inclusive else at - datetime.resolution
+        totals = await self._totals(wallet_id, None, before)
+        return totals["net"]
+
+    @classmethod
+    def _events_pipeline(
+        cls, wallet_id: str, from_date: datetime, to_date: datetime, limit: int
+    ) -> List[dict]:
+        bucket_filter, _, _ = cls._range(wallet_id, from_date, to_date)
+        return [
+            {"$match": bucket_filter},
+            {"$unwind": "$events"},
+            {"$replaceRoot": {"newRoot": "$events"}},
+            {"$match": {"created_at": {"$gte": from_date, "$lte": to_date}}},
+            {"$sort": {"created_at": 1, "transaction_id": 1}},
+            {"$limit": limit},
+        ]
+
+    async def get_events(
+        self,
+        wallet_id: str,
+        from_date: datetime,
+        to_date: datetime,
+        include_transactions: bool = False,
+        limit: int = 1000,
+    ) -> dict:
+        """
+        Sum the deposits and withdrawals of the wallet within the range, and
+        return its first ``limit`` events there when asked to.
+
+        The events are unwound, sorted and limited by MongoDB, so at most
+        ``limit`` of them are read whatever the size of the range.
+
+        Returns:
+            dict: The deposited and withdrawn totals, the number of events, and
+                the events if ``include_transactions``.
+        """
+        if not self.bucket_collection:
+            await self._initialize_collections()
+
+        totals = await self._totals(wallet_id, from_date, to_date)
+        del totals["net"]
+        if include_transactions:
+            events = self.bucket_collection.aggregate(
+                self._events_pipeline(wallet_id, from_date, to_date, limit)
+            )
+            totals["transactions"] = [codec.decode(event) async for event in events]
+        return totals
+
+    @staticmethod
+    def _transactions_query(wallet_id: str, after: dict = None) -> dict:
+        query = {"wallet_id": codec.encode_uuid(wallet_id)}
+        if after:
+            query["max_created_at"] = {"$gte": after["created_at"]}
+        return query
+
+    async def get_transactions(
+        self, wallet_id: str, after: dict = None, limit: int = 100
+    ) -> List[dict]:
+        """
+        Return the first ``limit`` transactions of the wallet ordered by
+        (created_at, transaction_id), after the given position if any.
+
+        Buckets are read oldest first, and reading stops at the first bucket
+        starting after the last transaction kept.
+        """
+        if not self.bucket_collection:
+            await self._initialize_collections()
+
+        if after:
+            position = (after["created_at"], after["transaction_id"])
+        buckets = self.bucket_collection.find(
+            self._transactions_query(wallet_id, after),
+            {"_id": 0, "min_created_at": 1, "events": 1},
+        ).sort("min_created_at", 1)
+
+        transactions = []
+        async for bucket in buckets:
+            if (
+                len(transactions) >= limit
+                and bucket["min_created_at"] > transactions[-1]["created_at"]
+            ):
+                break
+            for event in map(codec.decode, bucket["events"]):
+                if event["event_type"] == "WalletCreated":
+                    continue
+                if after and _transaction_key(event) <= position:
+                    continue
+                transactions.append(event)
+            transactions.sort(key=_transaction_key)
+            del transactions[limit:]
+        return transactions
+
+
+event_bucket_store = EventBucketStore()
+
+
+async def migrate(database, batch_size: int = BUCKET_MIGRATION_BATCH_SIZE) -> None:
+    """
+    Copy the events of WalletEvents into buckets, wallet by wallet in the
+    order they were recorded. The existing buckets of a wallet are dropped
+    first. WalletEvents is left as is.
+    """
+    store = EventBucketStore()
+    store.bucket_collection = database["WalletEventBuckets"]
+    events = (
+        database["WalletEvents"]
+        .find({}, {"_id": 0})
+        .sort([("wallet_id", 1), ("created_at", 1), ("transaction_id", 1)])
+        .batch_size(batch_size)
+    )
+
+    wallets = migrated = 0
+    wallet_id = None
+    batch = []
+    async for event in events:
+        event = codec.decode(event)
+        if event["wallet_id"] != wallet_id:
+            await store._push_documents(batch)
+            batch = []
+            wallet_id = event["wallet_id"]
+            await store.bucket_collection.delete_many(
+                {"wallet_id": codec.encode_uuid(wallet_id)}
+            )
+            wallets += 1
+        batch.append(event)
+        migrated += 1
+        # The events of one push share a bucket: push no more than it holds.
+        if len(batch) == store.max_events:
+            await store._push_documents(batch)
+            batch = []
+    await store._push_documents(batch)
+    print(f"WalletEventBuckets: {migrated} events of {wallets} wallets migrated")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser(
+        "migrate", help="copy WalletEvents into buckets"
+    )
+    migrate_parser.add_argument(
+        "--batch-size", type=int, default=BUCKET_MIGRATION_BATCH_SIZE
+    )
+    args = parser.parse_args()
+
+    await migrate(mongo_instance.database, args.batch_size)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
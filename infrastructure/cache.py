@@ -0,0 +1,183 @@
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any
+
+# "memory" caches per process and is only correct with a single API worker:
+# a write invalidates the cache of the process that handled it only.
+WALLET_CACHE_BACKEND = os.getenv("WALLET_CACHE_BACKEND", "memory")
+WALLET_CACHE_SIZE = int(os.getenv("WALLET_CACHE_SIZE", "10000"))
+WALLET_CACHE_TTL = float(os.getenv("WALLET_CACHE_TTL", "30"))
+WALLET_CACHE_REDIS_URL = os.getenv("WALLET_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+
+class CacheBackend(ABC):
+    """
+    Interface of the key/value stores the wallet cache can sit on.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Any | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any) -> None:
+        ...
+
+    @abstractmethod
+    async def set_if_newer(self, key: str, value: dict) -> None:
+        """
+        Set the value unless the entry holds a higher ``version``, atomically.
+        """
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+
+class LRUCache(CacheBackend):
+    """
+    In-process LRU cache whose entries expire ``ttl`` seconds after being set.
+
+    Every API process has its own, so as a wallet cache it is only correct
+    with a single worker; use the Redis backend with several.
+    """
+
+    def __init__(self, maxsize: int = WALLET_CACHE_SIZE, ttl: float = WALLET_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    async def get(self, key: str) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def set_if_newer(self, key: str, value: dict) -> None:
+        # Nothing awaits in between: the check and the set are atomic.
+        current = await self.get(key)
+        if current is None or current.get("version", 0) <= value["version"]:
+            await self.set(key, value)
+
+    async def delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+
+class RedisCache(CacheBackend):
+    """
+    Cache shared by every API process, stored in Redis. Requires the ``redis`` package.
+    """
+
+    # Compares the versions and sets in one step on the Redis server.
+    SET_IF_NEWER = """
+    local current = redis.call('GET', KEYS[1])
+    if current and (cjson.decode(current)['version'] or 0) > tonumber(ARGV[2]) then
+        return 0
+    end
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[3])
+    return 1
+    """
+
+    def __init__(
+        self, url: str = WALLET_CACHE_REDIS_URL, ttl: float = WALLET_CACHE_TTL
+    ):
+        from redis import asyncio as aioredis
+
+        self.ttl = ttl
+        self.client = aioredis.from_url(url)
+        self._set_if_newer = self.client.register_script(self.SET_IF_NEWER)
+
+    async def get(self, key: str) -> Any | None:
+        value = await self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value: Any) -> None:
+        await self.client.set(key, json.dumps(value), px=int(self.ttl * 1000))
+
+    async def set_if_newer(self, key: str, value: dict) -> None:
+        await self._set_if_newer(
+            keys=[key],
+            args=[json.dumps(value), value["version"], int(self.ttl * 1000)],
+        )
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(key)
+
+
+class WalletCache:
+    """
+    Read-through cache of wallets, keyed by wallet ID and by user ID.
+
+    Entries hold the public wallet fields (wallet_id, user_id, balance,
+    version). The command repository updates them when a wallet is created
+    and invalidates them whenever its balance changes.
+
+    An invalidated entry is replaced by a marker holding the version of the
+    change, and entries are only set if they are at least as new as what is
+    cached. A reader that read the wallet before a change and sets it after
+    the change's invalidation therefore cannot bring the old balance back.
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def get(self, user_id: int = None, wallet_id: str = None) -> dict | None:
+        if not wallet_id:
+            wallet_id = await self.backend.get(f"user:{user_id}")
+
+        wallet = await self.backend.get(f"wallet:{wallet_id}") if wallet_id else None
+        if wallet is not None and wallet.get("invalidated"):
+            wallet = None
+        if wallet is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return wallet
+
+    async def set(self, wallet: dict) -> None:
+        await self.backend.set(f"user:{wallet['user_id']}", wallet["wallet_id"])
+        await self.backend.set_if_newer(f"wallet:{wallet['wallet_id']}", wallet)
+
+    async def invalidate(self, wallet_id: str, version: int) -> None:
+        """
+        Drop the cached wallet, which changed at the given version.
+        """
+        # The user -> wallet mapping never changes, so only the wallet is dropped.
+        await self.backend.set_if_newer(
+            f"wallet:{wallet_id}", {"version": version, "invalidated": True}
+        )
+
+
+def _create_backend() -> CacheBackend:
+    if WALLET_CACHE_BACKEND == "redis":
+        return RedisCache()
+    return LRUCache()
+
+
+wallet_cache = WalletCache(_create_backend())
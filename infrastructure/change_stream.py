@@ -0,0 +1,167 @@
+"""
+Checkpointed change-stream tailing, shared by the outbox relay and the balance
+projector.
+
+A tailer watches one collection, hands the inserted documents to ``_process``
+in batches of up to ``batch_size`` (or whatever arrived within
+``flush_interval`` seconds), then saves the stream's resume token under its
+name, so a restarted tailer picks up where it stopped. Without a resume token,
+or once it fell off the oplog, ``_reset`` brings the tailer up to date before
+the stream is read. Transient errors (lost connections, elections) reopen the
+stream from the last resume token, backing off up to ``TAILER_MAX_BACKOFF``
+seconds between attempts.
+"""
+import asyncio
+import os
+import signal
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import List
+
+from pymongo.errors import ConnectionFailure, OperationFailure, PyMongoError
+
+from infrastructure.data_access import mongo_instance
+from infrastructure.metrics import registry, serve_metrics, set_process_endpoint
+
+TAILER_MAX_BACKOFF = float(os.getenv("TAILER_MAX_BACKOFF", "30"))
+
+# Raised when the resume token fell off the oplog.
+CHANGE_STREAM_HISTORY_LOST = 286
+TRANSIENT_ERROR_LABELS = ("ResumableChangeStreamError", "RetryableWriteError")
+
+
+def is_transient(error: PyMongoError) -> bool:
+    return isinstance(error, ConnectionFailure) or any(
+        error.has_error_label(label) for label in TRANSIENT_ERROR_LABELS
+    )
+
+
+class ChangeStreamTailer(ABC):
+    """
+    Tails a change stream in batches, at least once and in commit order.
+    """
+
+    # What the tailer does and what it is called, for the logs.
+    action = "Tailing"
+    title = "Tailer"
+
+    def __init__(self, name: str, batch_size: int, flush_interval: float):
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.db = mongo_instance
+        self.checkpointed_at: datetime | None = None
+        self.checkpoint_collection = None
+        self.retries = 0
+        self._backoff = flush_interval
+
+    @abstractmethod
+    async def _initialize_collections(self) -> None:
+        """Initialize the collections, including ``checkpoint_collection``."""
+
+    @abstractmethod
+    def _watch(self, resume_token):
+        """Open the change stream, resuming after the token if any."""
+
+    @abstractmethod
+    async def _reset(self) -> None:
+        """Catch up with the watched collection without a resume token."""
+
+    @abstractmethod
+    async def _process(self, documents: List[dict]) -> None:
+        """Process a batch of inserted documents, in stream order."""
+
+    async def run(self) -> None:
+        await self._initialize_collections()
+
+        history_lost = False
+        while True:
+            try:
+                resume_token = None if history_lost else await self._load_checkpoint()
+                history_lost = False
+                await self._tail(resume_token)
+            except PyMongoError as e:
+                if (
+                    isinstance(e, OperationFailure)
+                    and e.code == CHANGE_STREAM_HISTORY_LOST
+                ):
+                    print(f"{self.title} resume token is no longer in the oplog")
+                    history_lost = True
+                    continue
+                if not is_transient(e):
+                    raise
+                self.retries += 1
+                print(f"{self.title} failed, retrying in {self._backoff:.1f}s: {e}")
+                await asyncio.sleep(self._backoff)
+                self._backoff = min(self._backoff * 2, TAILER_MAX_BACKOFF)
+
+    async def _load_checkpoint(self):
+        """Return the last saved resume token, if any."""
+        checkpoint = await self.checkpoint_collection.find_one({"_id": self.name})
+        if checkpoint is None:
+            return None
+        self.checkpointed_at = checkpoint["updated_at"]
+        return checkpoint["resume_token"]
+
+    async def _tail(self, resume_token) -> None:
+        async with self._watch(resume_token) as stream:
+            # Opened first, so that nothing inserted while resetting is missed.
+            if resume_token is None:
+                await self._reset()
+
+            while True:
+                documents = await self._next_batch(stream)
+                if documents:
+                    await self._process(documents)
+                if documents or stream.resume_token != resume_token:
+                    resume_token = stream.resume_token
+                    await self._save_checkpoint(resume_token)
+
+    async def _next_batch(self, stream) -> List[dict]:
+        documents = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(documents) < self.batch_size and time.monotonic() < deadline:
+            change = await stream.try_next()
+            if change is None:
+                if documents:
+                    break
+                continue
+            documents.append(change["fullDocument"])
+        return documents
+
+    async def _save_checkpoint(self, resume_token) -> None:
+        self._backoff = self.flush_interval
+        self.checkpointed_at = datetime.now()
+        await self.checkpoint_collection.update_one(
+            {"_id": self.name},
+            {
+                "$set": {
+                    "resume_token": resume_token,
+                    "updated_at": self.checkpointed_at,
+                }
+            },
+            upsert=True,
+        )
+
+
+async def serve(tailer: ChangeStreamTailer, endpoint: str, metrics_port: int) -> None:
+    """
+    Run the tailer until SIGTERM or SIGINT, exposing its stats as ``endpoint``.
+    """
+    set_process_endpoint(endpoint)
+    registry.register_stats(endpoint, tailer.stats)
+    if metrics_port:
+        await serve_metrics(metrics_port)
+
+    task = asyncio.create_task(tailer.run())
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    loop.add_signal_handler(signal.SIGINT, task.cancel)
+
+    print(f" [*] {tailer.action} as {tailer.name}")
+    try:
+        await task
+    except asyncio.CancelledError:
+        # Whatever was not checkpointed is processed again on restart.
+        print(f" [*] {tailer.title} stopped")
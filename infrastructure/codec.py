@@ -0,0 +1,305 @@
+"""
+Storage codec between the API models and MongoDB.
+
+With ``STORAGE_CODEC=compact`` wallet, event and snapshot documents are stored
+compactly: UUIDs as BSON Binary subtype 4 (16 bytes instead of a 36 character
+string), event types as small integer codes, and money as int64 minor units
+(``MONEY_MINOR_UNITS`` decimals). Amounts with more decimals are rejected
+rather than rounded. The repositories encode what they
+write and every filter value they query with, and decode what they read, so
+the API models and responses are the same in both modes. Idempotency records
+and the outbox hold API documents and are never encoded.
+
+Existing data is converted in place while no API process is writing, before
+switching modes. Every document is checked first: if any holds an amount the
+compact layout cannot store, they are listed and nothing is converted. The
+report estimates the savings from a sample:
+
+    python -m infrastructure.codec report
+    python -m infrastructure.codec migrate --to compact
+"""
+import argparse
+import asyncio
+import math
+import os
+import sys
+import uuid
+
+from bson import Binary, Int64, encode
+from pymongo import ReplaceOne
+
+STORAGE_CODEC = os.getenv("STORAGE_CODEC", "plain")
+MONEY_MINOR_UNITS = int(os.getenv("MONEY_MINOR_UNITS", "2"))
+CODEC_MIGRATION_BATCH_SIZE = int(os.getenv("CODEC_MIGRATION_BATCH_SIZE", "1000"))
+CODEC_REPORT_SAMPLE_SIZE = int(os.getenv("CODEC_REPORT_SAMPLE_SIZE", "1000"))
+# How many unconvertible documents a refused migration lists.
+CODEC_MIGRATION_MAX_REPORTED = 20
+
+# Codes are stored: never renumber them.
+EVENT_TYPE_CODES = {
+    "WalletCreated": 1,
+    "WalletDeleted": 2,
+    "Deposited": 3,
+    "Withdrawn": 4,
+}
+EVENT_TYPE_NAMES = {code: name for name, code in EVENT_TYPE_CODES.items()}
+
+UUID_FIELDS = ("wallet_id", "transaction_id")
+MONEY_FIELDS = ("balance", "amount", "balance_after")
+
+# The collections holding encoded documents.
+ENCODED_COLLECTIONS = ("WalletBalance", "WalletEvents", "WalletSnapshots")
+
+
+class PlainCodec:
+    """Stores documents as the API models dump them."""
+
+    name = "plain"
+
+    def encode(self, document: dict) -> dict:
+        return document
+
+    def decode(self, document: dict) -> dict:
+        return document
+
+    def encode_uuid(self, value: str):
+        return value
+
+    def encode_event_type(self, event_type: str):
+        return event_type
+
+    def encode_money(self, value: float):
+        return value
+
+    def decode_money(self, value) -> float:
+        return value
+
+
+class CompactCodec(PlainCodec):
+    """
+    Stores UUIDs as Binary subtype 4, event types as integer codes and money as
+    int64 minor units.
+
+    ``decode`` only converts values of the compact types, so it reads
+    documents in either layout.
+    """
+
+    name = "compact"
+
+    def __init__(self, minor_units: int = MONEY_MINOR_UNITS):
+        self.minor_units = minor_units
+        self.scale = 10**minor_units
+
+    def encode(self, document: dict) -> dict:
+        encoded = dict(document)
+        for field in UUID_FIELDS:
+            if field in encoded:
+                encoded[field] = self.encode_uuid(encoded[field])
+        if "event_type" in encoded:
+            encoded["event_type"] = self.encode_event_type(encoded["event_type"])
+        for field in MONEY_FIELDS:
+            if field in encoded:
+                encoded[field] = self.encode_money(encoded[field])
+        return encoded
+
+    def decode(self, document: dict) -> dict:
+        decoded = dict(document)
+        for field in UUID_FIELDS:
+            value = decoded.get(field)
+            if isinstance(value, Binary):
+                decoded[field] = str(value.as_uuid())
+        event_type = decoded.get("event_type")
+        if isinstance(event_type, int):
+            decoded["event_type"] = EVENT_TYPE_NAMES[event_type]
+        for field in MONEY_FIELDS:
+            if field in decoded:
+                decoded[field] = self.decode_money(decoded[field])
+        return decoded
+
+    def encode_uuid(self, value: str):
+        if isinstance(value, Binary):
+            return value
+        try:
+            return Binary.from_uuid(uuid.UUID(value))
+        except (AttributeError, TypeError, ValueError):
+            # Not a UUID: left as is, it matches no stored document.
+            return value
+
+    def encode_event_type(self, event_type: str):
+        return EVENT_TYPE_CODES.get(event_type, event_type)
+
+    def encode_money(self, value: float):
+        minor_units = value * self.scale
+        rounded = round(minor_units)
+        # Only the representation error of float arithmetic is rounded away.
+        if not math.isclose(minor_units, rounded, rel_tol=1e-9, abs_tol=1e-6):
+            raise ValueError(f"{value} has more than {self.minor_units} decimals")
+        return Int64(rounded)
+
+    def decode_money(self, value) -> float:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value / self.scale
+        return value
+
+
+codec = CompactCodec() if STORAGE_CODEC == "compact" else PlainCodec()
+
+
+async def _unconvertible(database, convert, pending: dict) -> int:
+    """
+    Try converting every pending document of the encoded collections, and
+    list those that cannot be.
+
+    Returns:
+        int: The number of documents that cannot be converted.
+    """
+    failed = 0
+    for collection_name in ENCODED_COLLECTIONS:
+        async for document in database[collection_name].find(pending):
+            try:
+                convert(document)
+            except ValueError as e:
+                failed += 1
+                if failed <= CODEC_MIGRATION_MAX_REPORTED:
+                    print(f"{collection_name} {document['_id']}: {e}")
+    return failed
+
+
+async def migrate(
+    database, to: str, batch_size: int = CODEC_MIGRATION_BATCH_SIZE
+) -> int:
+    """
+    Rewrite the documents of the encoded collections in the ``to`` layout.
+
+    Every pending document is converted once before anything is written, so
+    that an amount the compact layout cannot store leaves the collections
+    untouched rather than half converted. Documents already in the ``to``
+    layout are skipped, so an interrupted migration is resumed by running it
+    again. The partial index on WalletCreated events filters on the stored
+    event type and is rebuilt for the new layout.
+
+    Returns:
+        int: The number of documents that cannot be converted; if any,
+            nothing was converted.
+    """
+    from infrastructure.indexes import wallet_created_index
+
+    compact = CompactCodec()
+    if to == "compact":
+        convert, pending = compact.encode, {"wallet_id": {"$type": "string"}}
+        layout = compact
+    else:
+        convert, pending = compact.decode, {"wallet_id": {"$type": "binData"}}
+        layout = PlainCodec()
+
+    failed = await _unconvertible(database, convert, pending)
+    if failed:
+        print(f"{failed} documents cannot be converted to {to}, nothing converted.")
+        return failed
+
+    for collection_name in ENCODED_COLLECTIONS:
+        collection = database[collection_name]
+        converted = 0
+        operations = []
+        async for document in collection.find(pending).batch_size(batch_size):
+            operations.append(ReplaceOne({"_id": document["_id"]}, convert(document)))
+            if len(operations) == batch_size:
+                await collection.bulk_write(operations, ordered=False)
+                converted += len(operations)
+                operations = []
+        if operations:
+            await collection.bulk_write(operations, ordered=False)
+            converted += len(operations)
+        print(f"{collection_name}: {converted} documents converted to {to}")
+
+    index = wallet_created_index(layout)
+    events = database["WalletEvents"]
+    if index.document["name"] in await events.index_information():
+        await events.drop_index(index.document["name"])
+    await events.create_indexes([index])
+    print(f"WalletEvents: index {index.document['name']} rebuilt for {to}")
+    return 0
+
+
+def _key_size(document: dict, fields: list) -> int:
+    return len(encode({field: document.get(field) for field in fields}))
+
+
+async def report(database, sample_size: int = CODEC_REPORT_SAMPLE_SIZE) -> None:
+    """
+    Print, for every encoded collection, the average document size and index
+    key size of a sample in both layouts, and the current sizes in MongoDB.
+    """
+    compact = CompactCodec()
+    for collection_name in ENCODED_COLLECTIONS:
+        collection = database[collection_name]
+        sample = await collection.aggregate(
+            [{"$sample": {"size": sample_size}}]
+        ).to_list(length=sample_size)
+        stats = await database.command("collStats", collection_name)
+        print(
+            f"{collection_name}: {stats.get('count', 0)} documents, "
+            f"{stats.get('size', 0)} bytes, "
+            f"{stats.get('totalIndexSize', 0)} bytes of indexes"
+        )
+        if not sample:
+            continue
+
+        plain = [compact.decode(document) for document in sample]
+        encoded = [compact.encode(document) for document in plain]
+        _print_saving(
+            "document",
+            sum(len(encode(d)) for d in plain) / len(sample),
+            sum(len(encode(d)) for d in encoded) / len(sample),
+            stats.get("count", 0),
+        )
+
+        indexes = await collection.index_information()
+        for index_name, index in indexes.items():
+            fields = [field for field, _ in index["key"]]
+            _print_saving(
+                f"index {index_name}",
+                sum(_key_size(d, fields) for d in plain) / len(sample),
+                sum(_key_size(d, fields) for d in encoded) / len(sample),
+                stats.get("count", 0),
+                current=stats.get("indexSizes", {}).get(index_name),
+            )
+
+
+def _print_saving(
+    label: str, plain: float, compact: float, count: int, current: int = None
+) -> None:
+    saving = 1 - compact / plain if plain else 0.0
+    line = (
+        f"  {label:40} plain {plain:7.1f} B  compact {compact:7.1f} B  "
+        f"saving {saving:6.1%}  ~{(plain - compact) * count / 1e6:.1f} MB"
+    )
+    if current is not None:
+        line += f"  (now {current / 1e6:.1f} MB)"
+    print(line)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    report_parser = commands.add_parser("report", help="estimate the size savings")
+    report_parser.add_argument(
+        "--sample-size", type=int, default=CODEC_REPORT_SAMPLE_SIZE
+    )
+    migrate_parser = commands.add_parser("migrate", help="convert stored documents")
+    migrate_parser.add_argument("--to", choices=("compact", "plain"), default="compact")
+    migrate_parser.add_argument(
+        "--batch-size", type=int, default=CODEC_MIGRATION_BATCH_SIZE
+    )
+    args = parser.parse_args()
+
+    from infrastructure.data_access import mongo_instance
+
+    if args.command == "report":
+        await report(mongo_instance.database, args.sample_size)
+    elif await migrate(mongo_instance.database, args.to, args.batch_size):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
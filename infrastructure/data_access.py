@@ -1,27 +1,149 @@
+import asyncio
+import os
+import threading
+import time
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
 from pymongo.errors import ConnectionFailure
 from domain.exceptions import MongoConnectionError
+from infrastructure.indexes import apply_indexes
+
+# "mongodb://wallet-mongo:27017/?replicaSet=rs0&directConnection=true" inside docker
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/?replicaSet=rs0")
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000"))
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")
+MONGO_READ_CONCERN = os.getenv("MONGO_READ_CONCERN", "")
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN", "")
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Track connection pool usage: connections open and checked out, and how
+    long callers waited to check a connection out.
+
+    Motor runs pymongo in worker threads; a checkout starts and finishes on the
+    same thread, so the start time is kept in a thread-local.
+    """
+
+    def __init__(self):
+        self.open = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stats(self) -> dict:
+        return {
+            "open": self.open,
+            "in_use": self.in_use,
+            "checkouts": self.checkouts,
+            "checkout_failures": self.checkout_failures,
+            "checkout_wait_avg": (
+                self.checkout_wait_total / self.checkouts if self.checkouts else 0.0
+            ),
+            "checkout_wait_max": self.checkout_wait_max,
+        }
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = time.perf_counter() - getattr(
+            self._local, "started", time.perf_counter()
+        )
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.checkout_wait_total += waited
+            self.checkout_wait_max = max(self.checkout_wait_max, waited)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
 
 
 class MongoManager:
     """
     Class to handle connection MongoDB.
     """
-    def __init__(self, max_pool_size=100):
-        # self.mongo_url = "mongodb://wallet-mongo:27017/?replicaSet=rs0&directConnection=true"
-        self.mongo_url = "mongodb://localhost:27017/?replicaSet=rs0"
+
+    def __init__(
+        self,
+        mongo_url=MONGO_URL,
+        min_pool_size=MONGO_MIN_POOL_SIZE,
+        max_pool_size=MONGO_MAX_POOL_SIZE,
+    ):
+        self.mongo_url = mongo_url
+        self.min_pool_size = min_pool_size
         self.max_pool_size = max_pool_size
+        self.pool_monitor = PoolMonitor()
 
-        try:
-            self.client = AsyncIOMotorClient(
-                self.mongo_url
+        options = {
+            "minPoolSize": min_pool_size,
+            "maxPoolSize": max_pool_size,
+            "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            "event_listeners": [self.pool_monitor],
+        }
+        if MONGO_COMPRESSORS:
+            options["compressors"] = MONGO_COMPRESSORS
+        if MONGO_READ_CONCERN:
+            options["readConcernLevel"] = MONGO_READ_CONCERN
+        if MONGO_WRITE_CONCERN:
+            options["w"] = (
+                int(MONGO_WRITE_CONCERN)
+                if MONGO_WRITE_CONCERN.isdigit()
+                else MONGO_WRITE_CONCERN
             )
+
+        try:
+            self.client = AsyncIOMotorClient(self.mongo_url, **options)
             self.database = self.client.get_database("Wallet")
         except ConnectionFailure as e:
             raise MongoConnectionError(f"Failed to connect to MongoDB: {e}") from e
 
         self.database = self.client["Wallet"]
 
+    async def warm_up(self):
+        """
+        Open ``min_pool_size`` connections up front, so the first requests
+        don't pay for the connection handshakes.
+        """
+        await asyncio.gather(
+            *(self.client.admin.command("ping") for _ in range(self.min_pool_size))
+        )
+
     @property
     async def event_collection(self):
         """Get wallet event collection"""
@@ -32,5 +154,46 @@ class MongoManager:
     async def wallet_collection(self):
         return self.database["WalletBalance"]
 
+    @property
+    async def event_bucket_collection(self):
+        """Get wallet event bucket collection"""
+
+        return self.database["WalletEventBuckets"]
+
+    @property
+    async def snapshot_collection(self):
+        """Get wallet balance snapshot collection"""
+
+        return self.database["WalletSnapshots"]
+
+    @property
+    async def idempotency_collection(self):
+        """Get command idempotency key collection"""
+
+        return self.database["IdempotencyKeys"]
+
+    @property
+    async def outbox_collection(self):
+        """Get audit log outbox collection"""
+
+        return self.database["Outbox"]
+
+    @property
+    async def outbox_checkpoint_collection(self):
+        """Get outbox relay checkpoint collection"""
+
+        return self.database["OutboxCheckpoints"]
+
+    @property
+    async def projection_checkpoint_collection(self):
+        """Get balance projector checkpoint collection"""
+
+        return self.database["ProjectionCheckpoints"]
+
+    async def ensure_indexes(self):
+        """Create the indexes declared in the index registry."""
+
+        await apply_indexes(self.database)
+
 
-mongo_instance = MongoManager()
\ No newline at end of file
+mongo_instance = MongoManager()
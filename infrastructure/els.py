@@ -1,12 +1,45 @@
-from elasticsearch import AsyncElasticsearch
+from typing import List
+from elasticsearch import ApiError, AsyncElasticsearch
 
 
-elk = AsyncElasticsearch("http://localhost:9200",maxsize=10)
+elk = AsyncElasticsearch("http://localhost:9200", maxsize=10)
 
 
 async def save_log_to_elk(data: dict) -> None:
-    await elk.index(
-        index=data["index"],
-        document=data["document"]
-    )
+    await elk.index(index=data["index"], document=data["document"])
 
+
+def is_accepted(status: int) -> bool:
+    return 200 <= status < 300
+
+
+def is_retryable(status: int) -> bool:
+    """
+    Whether a request Elasticsearch failed with this status may succeed when
+    retried: throttling and server errors may, other client errors never do.
+    """
+    return status == 429 or status >= 500
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether a failed request may succeed when retried, e.g. a lost connection."""
+    return not isinstance(error, ApiError) or is_retryable(error.status_code)
+
+
+async def save_logs_to_elk_bulk(data: List[dict]) -> List[int]:
+    """
+    Index a batch of log entries with a single bulk request.
+
+    Args:
+        data (List[dict]): Log entries, each with an "index" and a "document" key.
+
+    Returns:
+        List[int]: The status Elasticsearch answered for each entry.
+    """
+    operations = []
+    for item in data:
+        operations.append({"index": {"_index": item["index"]}})
+        operations.append(item["document"])
+
+    response = await elk.bulk(body=operations)
+    return [item["index"]["status"] for item in response["items"]]
@@ -0,0 +1,115 @@
+import asyncio
+import os
+from collections import Counter
+from typing import List, Tuple
+
+from domain.events import Deposited
+from infrastructure.repository import WalletCommandRepository
+
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "false").lower() == "true"
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "2")) / 1000
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "100"))
+
+
+class DepositGroupCommitter:
+    """
+    Coalesce concurrent deposits to the same wallet into one transaction.
+
+    The first deposit for a wallet opens a batch that stays open for
+    ``window`` seconds or until it holds ``max_batch`` deposits. The batch is
+    then committed with a single ``$inc`` of the summed amount and a single
+    ``insert_many`` of the events, and every caller gets the outcome of that
+    transaction.
+
+    A wallet has at most one commit in flight: deposits arriving meanwhile
+    keep collecting in the next batch, which is flushed as soon as that
+    commit finishes, so batches of a wallet never contend for its document.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = GROUP_COMMIT_ENABLED,
+        window: float = GROUP_COMMIT_WINDOW,
+        max_batch: int = GROUP_COMMIT_MAX_BATCH,
+    ):
+        self.enabled = enabled
+        self.window = window
+        self.max_batch = max_batch
+        self.batch_sizes: Counter[int] = Counter()
+        self.repository = WalletCommandRepository()
+        self._batches: dict[str, List[Tuple[Deposited, asyncio.Future]]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self._commits: set[asyncio.Task] = set()
+
+    def stats(self) -> dict:
+        return {
+            "batches": sum(self.batch_sizes.values()),
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+        }
+
+    async def submit(self, event: Deposited) -> None:
+        """
+        Add the deposit to the open batch of its wallet and wait for the batch
+        to be committed.
+
+        Raises:
+            WalletNotFoundError: If the wallet does not exist.
+            PyMongoError: If the batch transaction failed.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        batch = self._batches.setdefault(event.wallet_id, [])
+        batch.append((event, future))
+        if len(batch) >= self.max_batch:
+            self._flush(event.wallet_id)
+        elif len(batch) == 1:
+            self._timers[event.wallet_id] = loop.call_later(
+                self.window, self._flush, event.wallet_id
+            )
+
+        await future
+
+    def _flush(self, wallet_id: str) -> None:
+        timer = self._timers.pop(wallet_id, None)
+        if timer is not None:
+            timer.cancel()
+
+        if wallet_id in self._in_flight:
+            # Flushed again when the commit in flight finishes.
+            return
+
+        batch = self._batches.pop(wallet_id, None)
+        if not batch:
+            return
+        if len(batch) > self.max_batch:
+            self._batches[wallet_id] = batch[self.max_batch :]
+            batch = batch[: self.max_batch]
+
+        self.batch_sizes[len(batch)] += 1
+        task = asyncio.create_task(self._commit(wallet_id, batch))
+        self._in_flight[wallet_id] = task
+        self._commits.add(task)
+        task.add_done_callback(self._commits.discard)
+
+    async def _commit(
+        self, wallet_id: str, batch: List[Tuple[Deposited, asyncio.Future]]
+    ) -> None:
+        try:
+            await self.repository.apply_deposits([event for event, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            del self._in_flight[wallet_id]
+            if wallet_id in self._batches:
+                self._flush(wallet_id)
+
+
+deposit_group_committer = DepositGroupCommitter()
@@ -0,0 +1,102 @@
+import hashlib
+import os
+
+from domain.exceptions import IdempotencyKeyReusedError
+from infrastructure.cache import LRUCache
+from infrastructure.codec import codec
+from infrastructure.data_access import mongo_instance
+
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "100000"))
+
+
+def idempotency_id(event_type: str, key: str) -> str:
+    """
+    Scope a client idempotency key to the kind of command it was sent with.
+    """
+    return f"{event_type}:{key}"
+
+
+def request_fingerprint(event: dict) -> str:
+    """
+    Hash the payload of a command, the wallet and the amount of its event, so
+    that a key sent again with a different payload is detected.
+    """
+    payload = f"{event['wallet_id']}:{float(event['amount'])!r}"
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Remembers which event each idempotency key produced, and the fingerprint
+    of the request it was sent with.
+
+    The command repository records a key in the same transaction as its event,
+    so a key exists exactly when its command was committed. With the
+    asynchronous projection the key is stored on the event itself instead. Recently seen keys
+    are also kept in an in-process LRU, which answers most retries without a
+    round trip to MongoDB.
+    """
+
+    def __init__(
+        self, cache_size: int = IDEMPOTENCY_CACHE_SIZE, ttl: int = IDEMPOTENCY_KEY_TTL
+    ):
+        self.db = mongo_instance
+        self.cache = LRUCache(maxsize=cache_size, ttl=ttl)
+        self.idempotency_collection = None
+        self.event_collection = None
+
+    async def get_cached(
+        self, event_type: str, key: str, fingerprint: str
+    ) -> dict | None:
+        """Return the event recorded under the key, if it is in the local cache."""
+        entry = await self.cache.get(idempotency_id(event_type, key))
+        return self._replay(entry, key, fingerprint) if entry else None
+
+    async def remember(
+        self, event_type: str, key: str, event: dict, fingerprint: str
+    ) -> None:
+        await self.cache.set(
+            idempotency_id(event_type, key),
+            {"event": event, "fingerprint": fingerprint},
+        )
+
+    async def fetch(self, event_type: str, key: str, fingerprint: str) -> dict | None:
+        """Return the event recorded under the key in MongoDB."""
+        if not self.idempotency_collection or not self.event_collection:
+            self.idempotency_collection = await self.db.idempotency_collection
+            self.event_collection = await self.db.event_collection
+
+        record = await self.idempotency_collection.find_one(
+            {"_id": idempotency_id(event_type, key)}
+        )
+        if record is not None:
+            event = record["event"]
+        else:
+            event = await self.event_collection.find_one(
+                {"idempotency_id": idempotency_id(event_type, key)},
+                {"_id": 0, "balance_after": 0, "idempotency_id": 0},
+            )
+            if event is None:
+                return None
+            event = codec.decode(event)
+
+        # An event stored with its key is its own request's payload.
+        recorded = record.get("fingerprint") if record else None
+        entry = {"event": event, "fingerprint": recorded or request_fingerprint(event)}
+        await self.cache.set(idempotency_id(event_type, key), entry)
+        return self._replay(entry, key, fingerprint)
+
+    @staticmethod
+    def _replay(entry: dict, key: str, fingerprint: str) -> dict:
+        """
+        Raises:
+            IdempotencyKeyReusedError: If the key was recorded for a request
+                with a different payload.
+        """
+        if entry["fingerprint"] != fingerprint:
+            raise IdempotencyKeyReusedError(key)
+        return entry["event"]
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,296 @@
+"""
+Index registry for the Wallet database and a query-plan check.
+
+Indexes are declared per collection in ``INDEXES`` and created at startup by
+``apply_indexes``. Running this module explains every query the repositories
+issue and exits non-zero if any of them falls back to a collection scan:
+
+    python -m infrastructure.indexes
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime
+from typing import Iterator, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from infrastructure.codec import PlainCodec, codec
+
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+OUTBOX_RETENTION = int(os.getenv("OUTBOX_RETENTION", "604800"))
+
+
+def wallet_created_index(layout: PlainCodec = codec) -> IndexModel:
+    """
+    One wallet per user while WalletBalance is written by the projector. The
+    partial filter matches the event type as stored in the given layout.
+    """
+    return IndexModel(
+        [("user_id", ASCENDING)],
+        name="user_id_wallet_created_unique",
+        unique=True,
+        partialFilterExpression={
+            "event_type": layout.encode_event_type("WalletCreated")
+        },
+    )
+
+
+INDEXES = {
+    "WalletBalance": [
+        IndexModel([("wallet_id", ASCENDING)], name="wallet_id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "WalletEvents": [
+        IndexModel(
+            [
+                ("wallet_id", ASCENDING),
+                ("created_at", ASCENDING),
+                ("transaction_id", ASCENDING),
+            ],
+            name="wallet_id_created_at_transaction_id",
+        ),
+        IndexModel(
+            [
+                ("wallet_id", ASCENDING),
+                ("event_type", ASCENDING),
+                ("created_at", ASCENDING),
+            ],
+            name="wallet_id_event_type_created_at",
+        ),
+        # Events written before versions were introduced have none.
+        IndexModel(
+            [("wallet_id", ASCENDING), ("version", ASCENDING)],
+            name="wallet_id_version_unique",
+            unique=True,
+            partialFilterExpression={"version": {"$exists": True}},
+        ),
+        IndexModel(
+            [("idempotency_id", ASCENDING)],
+            name="idempotency_id_unique",
+            unique=True,
+            partialFilterExpression={"idempotency_id": {"$exists": True}},
+        ),
+        wallet_created_index(),
+    ],
+    "WalletEventBuckets": [
+        # The open bucket of a wallet and day.
+        IndexModel(
+            [("wallet_id", ASCENDING), ("day", ASCENDING)], name="wallet_id_day"
+        ),
+        IndexModel(
+            [("wallet_id", ASCENDING), ("min_created_at", ASCENDING)],
+            name="wallet_id_min_created_at",
+        ),
+    ],
+    "WalletSnapshots": [
+        IndexModel(
+            [
+                ("wallet_id", ASCENDING),
+                ("as_of", DESCENDING),
+                ("version", DESCENDING),
+            ],
+            name="wallet_id_as_of_version",
+        ),
+    ],
+    "IdempotencyKeys": [
+        IndexModel(
+            [("created_at", ASCENDING)],
+            name="created_at_ttl",
+            expireAfterSeconds=IDEMPOTENCY_KEY_TTL,
+        ),
+    ],
+    "Outbox": [
+        # Unpublished records have no published_at and never expire.
+        IndexModel(
+            [("published_at", ASCENDING)],
+            name="published_at_ttl",
+            expireAfterSeconds=OUTBOX_RETENTION,
+        ),
+    ],
+}
+
+_SAMPLE_WALLET_ID = "00000000-0000-0000-0000-000000000000"
+_SAMPLE_DATE = datetime(2024, 1, 1)
+
+
+def registered_queries() -> dict:
+    """
+    The queries issued by the repositories, keyed by a short description, as
+    built by the repositories themselves for sample arguments.
+    """
+    # Imported here: the repositories import this module through data_access.
+    from infrastructure.buckets import EventBucketStore
+    from infrastructure.idempotency import idempotency_id
+    from infrastructure.outbox import UNPUBLISHED_RECORDS
+    from infrastructure.projection import LATEST_EVENTS_PIPELINE
+    from infrastructure.repository import (
+        TRANSACTIONS_SORT,
+        WalletQueryRepository,
+        batch_wallets_query,
+        wallet_query,
+    )
+    from infrastructure.snapshots import (
+        HEAD_SORT,
+        LATEST_SNAPSHOT_SORT,
+        head_query,
+        latest_snapshot_query,
+        replay_query,
+    )
+
+    buckets = EventBucketStore()
+    after = {"created_at": _SAMPLE_DATE, "transaction_id": _SAMPLE_WALLET_ID}
+    return {
+        "get_wallet by user_id": {
+            "collection": "WalletBalance",
+            "filter": wallet_query(user_id=0),
+        },
+        "get_wallet by wallet_id": {
+            "collection": "WalletBalance",
+            "filter": wallet_query(wallet_id=_SAMPLE_WALLET_ID),
+        },
+        "apply_batch wallets": {
+            "collection": "WalletBalance",
+            "filter": batch_wallets_query([_SAMPLE_WALLET_ID], [0]),
+        },
+        "get_transactions": {
+            "collection": "WalletEvents",
+            "filter": WalletQueryRepository._transactions_query(
+                _SAMPLE_WALLET_ID, after
+            ),
+            "sort": TRANSACTIONS_SORT,
+        },
+        "get_events": {
+            "collection": "WalletEvents",
+            "pipeline": WalletQueryRepository._events_pipeline(
+                _SAMPLE_WALLET_ID, _SAMPLE_DATE, _SAMPLE_DATE, True, 1
+            ),
+        },
+        "open bucket": {
+            "collection": "WalletEventBuckets",
+            "filter": buckets._open_bucket_query(_SAMPLE_WALLET_ID, _SAMPLE_DATE, 1),
+        },
+        "bucket totals": {
+            "collection": "WalletEventBuckets",
+            "pipeline": buckets._totals_pipeline(
+                _SAMPLE_WALLET_ID, _SAMPLE_DATE, _SAMPLE_DATE
+            ),
+        },
+        "bucket events": {
+            "collection": "WalletEventBuckets",
+            "pipeline": buckets._events_pipeline(
+                _SAMPLE_WALLET_ID, _SAMPLE_DATE, _SAMPLE_DATE, 1
+            ),
+        },
+        "bucket transactions": {
+            "collection": "WalletEventBuckets",
+            "filter": buckets._transactions_query(_SAMPLE_WALLET_ID, after),
+            "sort": [("min_created_at", 1)],
+        },
+        "latest snapshot": {
+            "collection": "WalletSnapshots",
+            "filter": latest_snapshot_query(_SAMPLE_WALLET_ID, _SAMPLE_DATE),
+            "sort": LATEST_SNAPSHOT_SORT,
+        },
+        "snapshot replay": {
+            "collection": "WalletEvents",
+            "filter": replay_query(_SAMPLE_WALLET_ID, {"version": 0}, 1),
+        },
+        "append head": {
+            "collection": "WalletEvents",
+            "filter": head_query(_SAMPLE_WALLET_ID),
+            "sort": HEAD_SORT,
+        },
+        "idempotent event": {
+            "collection": "WalletEvents",
+            "filter": {"idempotency_id": idempotency_id("Deposited", "")},
+        },
+        "projection rebuild": {
+            "collection": "WalletEvents",
+            "pipeline": LATEST_EVENTS_PIPELINE,
+        },
+        "outbox catch-up": {
+            "collection": "Outbox",
+            "filter": UNPUBLISHED_RECORDS,
+            "sort": [("_id", 1)],
+        },
+    }
+
+
+async def apply_indexes(database) -> None:
+    """
+    Create every index declared in ``INDEXES``. Existing indexes are left as is.
+    """
+    for collection_name, indexes in INDEXES.items():
+        await database[collection_name].create_indexes(indexes)
+
+
+def _stages(plan: dict) -> Iterator[str]:
+    yield plan.get("stage", "")
+    if "inputStage" in plan:
+        yield from _stages(plan["inputStage"])
+    for input_stage in plan.get("inputStages", []):
+        yield from _stages(input_stage)
+    if "queryPlan" in plan:
+        yield from _stages(plan["queryPlan"])
+
+
+def _winning_plans(explain: dict) -> Iterator[dict]:
+    if "queryPlanner" in explain:
+        yield explain["queryPlanner"]["winningPlan"]
+    for stage in explain.get("stages", []):
+        if "$cursor" in stage:
+            yield stage["$cursor"]["queryPlanner"]["winningPlan"]
+
+
+async def explain_query(database, query: dict) -> dict:
+    if "pipeline" in query:
+        return await database.command(
+            "explain",
+            {
+                "aggregate": query["collection"],
+                "pipeline": query["pipeline"],
+                "cursor": {},
+            },
+            verbosity="queryPlanner",
+        )
+
+    cursor = database[query["collection"]].find(query["filter"]).limit(1)
+    if "sort" in query:
+        cursor = cursor.sort(query["sort"])
+    return await cursor.explain()
+
+
+async def check_query_plans(database) -> List[str]:
+    """
+    Explain every registered query.
+
+    Returns:
+        List[str]: The descriptions of the queries that use a COLLSCAN.
+    """
+    collection_scans = []
+    for description, query in registered_queries().items():
+        explain = await explain_query(database, query)
+        stages = {stage for plan in _winning_plans(explain) for stage in _stages(plan)}
+        uses_collscan = "COLLSCAN" in stages
+        print(
+            f"{'COLLSCAN' if uses_collscan else 'ok':8} {description}: {sorted(stages)}"
+        )
+        if uses_collscan:
+            collection_scans.append(description)
+    return collection_scans
+
+
+async def main() -> int:
+    from infrastructure.data_access import mongo_instance
+
+    await mongo_instance.ensure_indexes()
+    collection_scans = await check_query_plans(mongo_instance.database)
+    if collection_scans:
+        print(f"{len(collection_scans)} queries use a collection scan.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,291 @@
+import asyncio
+import contextvars
+import functools
+import time
+from bisect import bisect_left
+from typing import Callable, Iterator
+
+# Upper bounds (seconds) of the latency buckets; +Inf is implied.
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# The ASGI scope of the request being handled, so stages recorded deeper in
+# the call stack can be labelled with the endpoint that ran them.
+_request_scope: contextvars.ContextVar[dict | None] = contextvars.ContextVar(
+    "request_scope", default=None
+)
+# Label used outside of HTTP requests, e.g. "consumer" in the log consumer.
+_process_endpoint = ""
+
+
+def current_endpoint() -> str:
+    """
+    Return the name of the endpoint function handling the current request, or
+    the name set with ``set_process_endpoint`` outside of requests.
+    """
+    scope = _request_scope.get()
+    if scope is None:
+        return _process_endpoint
+    # The router adds the endpoint to the scope once the route is matched.
+    endpoint = scope.get("endpoint")
+    return endpoint.__name__ if endpoint else ""
+
+
+def set_process_endpoint(name: str) -> None:
+    global _process_endpoint
+    _process_endpoint = name
+
+
+class Histogram:
+    """
+    A Prometheus histogram keeping one set of cumulative buckets per label values.
+
+    Observing takes a bisect and a few additions, without locks: everything
+    recording into it runs on the event loop thread.
+    """
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple, buckets=LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in self._series.items():
+            base = ",".join(
+                f'{name}="{_escape(value)}"'
+                for name, value in zip(self.labelnames, labels)
+            )
+            prefix = base + "," if base else ""
+
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+            cumulative += series[len(self.buckets)]
+            yield f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}'
+            yield f"{self.name}_sum{{{base}}} {series[-1]}"
+            yield f"{self.name}_count{{{base}}} {cumulative}"
+
+
+class MetricsRegistry:
+    """
+    Holds the histograms and the ``stats()`` providers exposed on /metrics.
+
+    Component stats are published as gauges named
+    ``wallet_<component>_<key>``; a dict value becomes one gauge per entry,
+    labelled with the entry's key.
+    """
+
+    def __init__(self):
+        self.histograms: list[Histogram] = []
+        self.stats_providers: dict[str, Callable[[], dict]] = {}
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple) -> Histogram:
+        histogram = Histogram(name, documentation, labelnames)
+        self.histograms.append(histogram)
+        return histogram
+
+    def register_stats(self, component: str, stats: Callable[[], dict]) -> None:
+        self.stats_providers[component] = stats
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.collect())
+
+        for component, stats in self.stats_providers.items():
+            for key, value in stats().items():
+                name = f"wallet_{component}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                if isinstance(value, dict):
+                    lines.extend(
+                        f'{name}{{key="{_escape(entry)}"}} {float(entry_value)}'
+                        for entry, entry_value in value.items()
+                    )
+                else:
+                    lines.append(f"{name} {float(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = MetricsRegistry()
+
+request_latency = registry.histogram(
+    "wallet_http_request_seconds",
+    "Time to handle an HTTP request.",
+    ("endpoint", "method", "status"),
+)
+stage_latency = registry.histogram(
+    "wallet_stage_seconds",
+    "Time spent in one stage of handling a request or a consumed message.",
+    ("endpoint", "stage", "event_type", "outcome"),
+)
+
+
+def outcome_of(error: BaseException | None) -> str:
+    return "ok" if error is None else type(error).__name__
+
+
+class stage:
+    """
+    Context manager recording how long its block took as a stage of the
+    current endpoint.
+
+    The outcome label is ``ok``, or the name of the exception the block raised.
+    A plain class rather than ``@contextmanager``, which costs a few
+    microseconds more per use.
+    """
+
+    __slots__ = ("name", "event_type", "started")
+
+    def __init__(self, name: str, event_type: str = ""):
+        self.name = name
+        self.event_type = event_type
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stage_latency.observe(
+            time.perf_counter() - self.started,
+            current_endpoint(),
+            self.name,
+            self.event_type,
+            "ok" if exc_type is None else exc_type.__name__,
+        )
+        return False
+
+
+def timed(name: str):
+    """
+    Decorate a coroutine function to record its duration as a stage.
+
+    The event type label is taken from the ``event`` argument (or the first
+    positional argument after ``self``) when it is an event.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            event = kwargs.get("event", args[1] if len(args) > 1 else None)
+            event_type = getattr(event, "event_type", "")
+
+            started = time.perf_counter()
+            error = None
+            try:
+                return await func(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                stage_latency.observe(
+                    time.perf_counter() - started,
+                    current_endpoint(),
+                    name,
+                    event_type,
+                    outcome_of(error),
+                )
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency of every HTTP request, labelled with
+    the endpoint function, the method and the response status.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        token = _request_scope.set(scope)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_latency.observe(
+                time.perf_counter() - started,
+                current_endpoint() or "unmatched",
+                scope["method"],
+                str(status_code),
+            )
+            _request_scope.reset(token)
+
+
+async def serve_metrics(port: int) -> asyncio.AbstractServer:
+    """
+    Serve ``GET /metrics`` on the port, for processes without an HTTP app
+    such as the log consumer.
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, port=port)
@@ -0,0 +1,209 @@
+"""
+Transactional outbox for the audit logs.
+
+The command repository writes the logs of the events it applies into the
+Outbox collection, in the same transaction as the events, so a log exists
+exactly when its event was committed. Request handlers record the logs of
+rejected commands there as well, and never talk to the broker.
+
+The relay tails the outbox with a change stream and publishes the logs to
+RabbitMQ in batches. After each batch it marks the records as published and
+saves the stream's resume token, so a restarted relay picks up where it
+stopped. Published records expire after OUTBOX_RETENTION seconds.
+
+    python -m infrastructure.outbox
+"""
+import asyncio
+import os
+from datetime import datetime
+from typing import List
+
+from pymongo.errors import PyMongoError
+
+from domain.events import Event
+from infrastructure.change_stream import ChangeStreamTailer, serve
+from infrastructure.data_access import mongo_instance
+from infrastructure.queue.publisher import publish_logs_batch
+
+OUTBOX_RELAY_NAME = os.getenv("OUTBOX_RELAY_NAME", "audit-logs")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "0.5"))
+OUTBOX_RELAY_METRICS_PORT = int(os.getenv("OUTBOX_RELAY_METRICS_PORT", "0"))
+
+SUCCESS_MESSAGES = {
+    "WalletCreated": "Wallet created successfully",
+    "Deposited": "Deposit successful",
+    "Withdrawn": "Withdrawal successful",
+}
+
+UNPUBLISHED_RECORDS = {"published_at": None}
+
+
+def audit_log(event_type: str, message: str, success: bool, **fields) -> dict:
+    """
+    Build the audit log of a command: wallet creations go to the wallet_logs
+    index, deposits and withdrawals to wallet_transactions.
+    """
+    index = "wallet_logs" if event_type == "WalletCreated" else "wallet_transactions"
+    document = {
+        **fields,
+        "message": message,
+        "success": success,
+        "timestamp": datetime.now().timestamp(),
+    }
+    return {"index": index, "document": document}
+
+
+def event_audit_log(event: Event, message: str, success: bool) -> dict:
+    if event.event_type == "WalletCreated":
+        fields = {"user_id": event.user_id}
+    else:
+        fields = {"wallet_id": event.wallet_id, "amount": event.amount}
+    return audit_log(event.event_type, message, success, **fields)
+
+
+def outbox_record(logs: List[dict]) -> dict:
+    return {"logs": logs, "created_at": datetime.now(), "published_at": None}
+
+
+async def record_rejection(event_type: str, message: str, **fields) -> None:
+    """
+    Record the audit log of a rejected command, outside of any transaction.
+
+    A failure to record it is reported and otherwise ignored, so it never
+    changes the response of the request.
+    """
+    await record_rejections([audit_log(event_type, message, False, **fields)])
+
+
+async def record_rejections(logs: List[dict]) -> None:
+    """Record the audit logs of rejected commands in one outbox record."""
+    try:
+        outbox = await mongo_instance.outbox_collection
+        await outbox.insert_one(outbox_record(logs))
+    except PyMongoError as e:
+        print(f"Recording audit log failed: {e}")
+
+
+def to_message(record: dict) -> dict:
+    """The broker message carrying the logs of an outbox record."""
+    logs = record["logs"]
+    return logs[0] if len(logs) == 1 else {"logs": logs}
+
+
+class OutboxRelay(ChangeStreamTailer):
+    """
+    Publishes outbox records to RabbitMQ, in commit order.
+
+    Delivery is at least once: records are marked as published and the resume
+    token is saved only after the broker accepted the batch.
+    """
+
+    action = "Relaying outbox"
+    title = "Outbox relay"
+
+    def __init__(
+        self,
+        name: str = OUTBOX_RELAY_NAME,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        flush_interval: float = OUTBOX_FLUSH_INTERVAL,
+    ):
+        super().__init__(name, batch_size, flush_interval)
+        self.published = 0
+        self.batches = 0
+        self.failures = 0
+        self.lag = 0.0
+        self.outbox_collection = None
+        self._caught_up = set()
+
+    def stats(self) -> dict:
+        return {
+            "published": self.published,
+            "batches": self.batches,
+            "failures": self.failures,
+            "retries": self.retries,
+            "lag_seconds": self.lag,
+        }
+
+    async def _initialize_collections(self) -> None:
+        self.outbox_collection = await self.db.outbox_collection
+        self.checkpoint_collection = await self.db.outbox_checkpoint_collection
+
+    def _watch(self, resume_token):
+        # Only a stream opened without a resume token follows a catch-up.
+        self._caught_up = set()
+        return self.outbox_collection.watch(
+            [{"$match": {"operationType": "insert"}}],
+            resume_after=resume_token,
+            max_await_time_ms=int(self.flush_interval * 1000),
+        )
+
+    async def _reset(self) -> None:
+        # Records written before the stream was opened are published from the
+        # collection first; the stream then skips them.
+        self._caught_up = await self._catch_up()
+
+    async def _process(self, records: List[dict]) -> None:
+        records = [r for r in records if r["_id"] not in self._caught_up]
+        if records:
+            await self._publish(records)
+
+    async def _catch_up(self) -> set:
+        """Publish the records not published yet, oldest first."""
+        published = set()
+        while True:
+            records = await (
+                self.outbox_collection.find(UNPUBLISHED_RECORDS)
+                .sort("_id", 1)
+                .limit(self.batch_size)
+                .to_list(length=self.batch_size)
+            )
+            if not records:
+                return published
+            await self._publish(records)
+            published.update(record["_id"] for record in records)
+
+    async def _publish(self, records: List[dict]) -> None:
+        """
+        Publish the records, marking each as published once the broker
+        confirmed it; those it did not are published again after a backoff.
+        """
+        delay = self.flush_interval
+        pending = records
+        while True:
+            try:
+                errors = await publish_logs_batch(
+                    [to_message(record) for record in pending]
+                )
+            except Exception as e:
+                errors = [e] * len(pending)
+
+            confirmed = [r["_id"] for r, e in zip(pending, errors) if e is None]
+            if confirmed:
+                await self.outbox_collection.update_many(
+                    {"_id": {"$in": confirmed}},
+                    {"$set": {"published_at": datetime.now()}},
+                )
+            failed = [(r, e) for r, e in zip(pending, errors) if e is not None]
+            if not failed:
+                break
+            self.failures += 1
+            print(
+                f"Publishing {len(failed)} outbox records failed, "
+                f"retrying in {delay:.1f}s: {failed[0][1]}"
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+            pending = [record for record, _ in failed]
+
+        self.published += len(records)
+        self.batches += 1
+        self.lag = (datetime.now() - records[-1]["created_at"]).total_seconds()
+
+
+async def main() -> None:
+    await serve(OutboxRelay(), "outbox_relay", OUTBOX_RELAY_METRICS_PORT)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
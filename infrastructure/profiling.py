@@ -0,0 +1,252 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from types import FrameType
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP_SLOWEST = int(os.getenv("PROFILE_KEEP_SLOWEST", "20"))
+# Required in the X-Admin-Token header of /admin/profiles; unset, it is closed.
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+def running_stack(frame: FrameType, root_code) -> list[str]:
+    """
+    Return the labels of the thread's stack, outermost first, starting at the
+    frame running ``root_code`` (the root coroutine of the profiled task).
+    """
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        if frame.f_code is root_code:
+            break
+        frame = frame.f_back
+    return [_frame_label(frame) for frame in reversed(frames)]
+
+
+def awaiting_stack(task: asyncio.Task) -> list[str]:
+    """
+    Return the labels of the coroutines a suspended task is awaiting through,
+    outermost first, ending with what it is waiting on.
+    """
+    stack = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = (
+            getattr(awaitable, "cr_frame", None)
+            or getattr(awaitable, "ag_frame", None)
+            or getattr(awaitable, "gi_frame", None)
+        )
+        if frame is None:
+            # A future, a task, or a coroutine that has finished.
+            stack.append(f"[{type(awaitable).__name__}]")
+            break
+        stack.append(_frame_label(frame))
+        awaitable = (
+            getattr(awaitable, "cr_await", None)
+            or getattr(awaitable, "ag_await", None)
+            or getattr(awaitable, "gi_yieldfrom", None)
+        )
+    return stack
+
+
+class Profile:
+    """
+    Stack samples of one request: where its task was running on the CPU, and
+    what it was awaiting while suspended.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, method: str, path: str, reason: str):
+        self.id = next(self._ids)
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.started_at = datetime.now()
+        self.duration = 0.0
+        self.status = 0
+        self.cpu = Counter()
+        self.awaiting = Counter()
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "reason": self.reason,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "cpu_samples": sum(self.cpu.values()),
+            "await_samples": sum(self.awaiting.values()),
+        }
+
+    def folded(self, kind: str = "all") -> str:
+        """
+        Render the samples in the folded stack format read by flamegraph.pl and
+        speedscope: one ``frame;frame;frame count`` line per distinct stack.
+        On-CPU and awaiting stacks are rooted at ``on-cpu`` and ``awaiting``.
+        """
+        # Copied first: the sampler may still add a last sample.
+        lines = []
+        if kind in ("all", "cpu"):
+            lines.extend(
+                f"on-cpu;{stack} {count}" for stack, count in list(self.cpu.items())
+            )
+        if kind in ("all", "await"):
+            lines.extend(
+                f"awaiting;{stack} {count}"
+                for stack, count in list(self.awaiting.items())
+            )
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread every ``interval`` seconds while requests are
+    being profiled.
+
+    A sampler thread looks at which task the loop is running: a profiled task
+    that is running gets an on-CPU sample of the loop thread's stack, and every
+    other profiled task gets an awaiting sample of its coroutine chain. Only the
+    ``keep`` slowest finished profiles are kept.
+    """
+
+    def __init__(
+        self,
+        interval: float = PROFILE_INTERVAL_MS / 1000,
+        keep: int = PROFILE_KEEP_SLOWEST,
+    ):
+        self.interval = interval
+        self.keep = keep
+        self._active: dict[asyncio.Task, Profile] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        # Min-heap of (duration, id, profile): the fastest kept profile is
+        # evicted first.
+        self._slowest: list[tuple[float, int, Profile]] = []
+
+    def start(self, profile: Profile) -> None:
+        """Start sampling the current task into the profile."""
+        if self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread_id = threading.get_ident()
+            self._thread = threading.Thread(
+                target=self._sample_forever, name="profiler", daemon=True
+            )
+            self._thread.start()
+
+        with self._lock:
+            self._active[asyncio.current_task()] = profile
+        self._wakeup.set()
+
+    def stop(self, profile: Profile) -> None:
+        """Stop sampling the current task and keep the profile if it is slow enough."""
+        with self._lock:
+            self._active.pop(asyncio.current_task(), None)
+            if not self._active:
+                self._wakeup.clear()
+
+        entry = (profile.duration, profile.id, profile)
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, entry)
+        elif entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def profiles(self) -> list[Profile]:
+        """Return the kept profiles, slowest first."""
+        return [profile for _, _, profile in sorted(self._slowest, reverse=True)]
+
+    def get(self, profile_id: int) -> Profile | None:
+        return next((p for _, _, p in self._slowest if p.id == profile_id), None)
+
+    def _sample_forever(self) -> None:
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.interval)
+            self._sample()
+
+    def _sample(self) -> None:
+        with self._lock:
+            active = list(self._active.items())
+        if not active:
+            return
+
+        running = asyncio.current_task(self._loop)
+        frame = sys._current_frames().get(self._loop_thread_id)
+        for task, profile in active:
+            if task.done():
+                continue
+            if task is running and frame is not None:
+                stack = running_stack(frame, task.get_coro().cr_code)
+                profile.cpu[";".join(stack)] += 1
+            else:
+                profile.awaiting[";".join(awaiting_stack(task))] += 1
+
+
+profiler = SamplingProfiler()
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling a ``PROFILE_SAMPLE_RATE`` fraction of requests,
+    and every request sent with the ``PROFILE_HEADER`` header.
+    """
+
+    def __init__(
+        self,
+        app,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+        header: str = PROFILE_HEADER,
+    ):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.header = header.lower().encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if any(name == self.header for name, _ in scope["headers"]):
+            reason = "header"
+        elif random.random() < self.sample_rate:
+            reason = "sampled"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(scope["method"], scope["path"], reason)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        profiler.start(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.duration = time.perf_counter() - started
+            profiler.stop(profile)
@@ -0,0 +1,238 @@
+"""
+Balance projector for the asynchronous projection mode.
+
+With ``WALLET_PROJECTION=async`` commands only append versioned events to
+WalletEvents. The projector tails them with a change stream and maintains
+WalletBalance: every event carries its wallet's version and the balance after
+it, so projecting it is setting both, guarded by the version so that replays
+and out-of-date events never move a wallet back. It also writes the audit log
+of every projected event to the outbox, keyed by the event's _id, and saves
+the stream's resume token after each batch, so a restarted projector picks up
+where it stopped. Without a usable resume token it rebuilds every wallet, and
+writes the audit logs of the events appended since the last checkpoint.
+
+    python -m infrastructure.projection
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import List
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from infrastructure.change_stream import ChangeStreamTailer, serve
+from infrastructure.codec import codec
+from infrastructure.outbox import SUCCESS_MESSAGES, audit_log, outbox_record
+
+PROJECTOR_NAME = os.getenv("PROJECTOR_NAME", "wallet-balance")
+PROJECTOR_BATCH_SIZE = int(os.getenv("PROJECTOR_BATCH_SIZE", "500"))
+PROJECTOR_FLUSH_INTERVAL = float(os.getenv("PROJECTOR_FLUSH_INTERVAL", "0.1"))
+PROJECTOR_METRICS_PORT = int(os.getenv("PROJECTOR_METRICS_PORT", "0"))
+# How long before the last checkpoint a rebuild writes audit logs from: events
+# are timestamped before they are appended.
+PROJECTOR_REBUILD_HORIZON = float(os.getenv("PROJECTOR_REBUILD_HORIZON", "300"))
+
+DUPLICATE_KEY = 11000
+
+# The events a rebuild projects: those appended in asynchronous mode.
+PROJECTED_EVENTS = {"version": {"$exists": True}, "balance_after": {"$exists": True}}
+LATEST_EVENTS_PIPELINE = [
+    {"$match": PROJECTED_EVENTS},
+    {"$sort": {"wallet_id": 1, "version": -1}},
+    {
+        "$group": {
+            "_id": "$wallet_id",
+            "created": {"$last": "$$ROOT"},
+            "event": {"$first": "$$ROOT"},
+        }
+    },
+]
+
+
+def balance_updates(events: List[dict]) -> List[UpdateOne]:
+    """
+    The WalletBalance writes projecting the (decoded) events, in stream order:
+    one upsert per created wallet, then one update per wallet to its latest
+    event.
+    """
+    creations = []
+    latest = {}
+    for event in events:
+        if event["event_type"] == "WalletCreated":
+            creations.append(
+                UpdateOne(
+                    {"wallet_id": codec.encode_uuid(event["wallet_id"])},
+                    {
+                        "$setOnInsert": codec.encode(
+                            {
+                                "wallet_id": event["wallet_id"],
+                                "user_id": event["user_id"],
+                                "balance": event["balance_after"],
+                                "version": event["version"],
+                            }
+                        )
+                    },
+                    upsert=True,
+                )
+            )
+        latest[event["wallet_id"]] = event
+
+    updates = [
+        UpdateOne(
+            {
+                "wallet_id": codec.encode_uuid(wallet_id),
+                "$or": [
+                    {"version": {"$lt": event["version"]}},
+                    # Wallets created in synchronous mode.
+                    {"version": {"$exists": False}},
+                ],
+            },
+            {
+                "$set": {
+                    "balance": codec.encode_money(event["balance_after"]),
+                    "version": event["version"],
+                }
+            },
+        )
+        for wallet_id, event in latest.items()
+    ]
+    return creations + updates
+
+
+def event_outbox_record(event: dict) -> dict:
+    if event["event_type"] == "WalletCreated":
+        fields = {"user_id": event["user_id"]}
+    else:
+        fields = {"wallet_id": event["wallet_id"], "amount": event["amount"]}
+    log = audit_log(
+        event["event_type"], SUCCESS_MESSAGES[event["event_type"]], True, **fields
+    )
+    return {"_id": event["_id"], **outbox_record([log])}
+
+
+class BalanceProjector(ChangeStreamTailer):
+    """
+    Projects appended events into WalletBalance, in commit order.
+
+    Projection is at least once and idempotent: balances are set, not
+    incremented, and outbox records of replayed events are already there.
+    """
+
+    action = "Projecting balances"
+    title = "Balance projector"
+
+    def __init__(
+        self,
+        name: str = PROJECTOR_NAME,
+        batch_size: int = PROJECTOR_BATCH_SIZE,
+        flush_interval: float = PROJECTOR_FLUSH_INTERVAL,
+    ):
+        super().__init__(name, batch_size, flush_interval)
+        self.projected = 0
+        self.batches = 0
+        self.lag = 0.0
+        self.event_collection = None
+        self.wallet_collection = None
+        self.outbox_collection = None
+
+    def stats(self) -> dict:
+        return {
+            "projected": self.projected,
+            "batches": self.batches,
+            "retries": self.retries,
+            "lag_seconds": self.lag,
+        }
+
+    async def _initialize_collections(self) -> None:
+        self.event_collection = await self.db.event_collection
+        self.wallet_collection = await self.db.wallet_collection
+        self.outbox_collection = await self.db.outbox_collection
+        self.checkpoint_collection = await self.db.projection_checkpoint_collection
+
+    def _watch(self, resume_token):
+        return self.event_collection.watch(
+            [
+                {
+                    "$match": {
+                        "operationType": "insert",
+                        "fullDocument.balance_after": {"$exists": True},
+                    }
+                }
+            ],
+            resume_after=resume_token,
+            max_await_time_ms=int(self.flush_interval * 1000),
+        )
+
+    async def _reset(self) -> None:
+        # Every wallet is first brought up to its latest event; the stream
+        # then replays what was appended since it was opened, which the
+        # version guard makes harmless.
+        await self._rebuild()
+
+    async def _process(self, documents: List[dict]) -> None:
+        await self._project([codec.decode(document) for document in documents])
+
+    async def _rebuild(self) -> None:
+        """
+        Project the creation and the latest event of every wallet, and write
+        the audit logs of the events appended since the last checkpoint (of
+        every event if there is none). Those already in the outbox are skipped.
+        """
+        latest_events = self.event_collection.aggregate(
+            LATEST_EVENTS_PIPELINE, allowDiskUse=True
+        )
+        events = []
+        async for latest in latest_events:
+            # Creates the wallets created since the stream was lost.
+            if latest["created"]["_id"] != latest["event"]["_id"]:
+                events.append(codec.decode(latest["created"]))
+            events.append(codec.decode(latest["event"]))
+            if len(events) >= self.batch_size:
+                await self.wallet_collection.bulk_write(balance_updates(events))
+                events = []
+        if events:
+            await self.wallet_collection.bulk_write(balance_updates(events))
+
+        events_filter = PROJECTED_EVENTS
+        if self.checkpointed_at:
+            since = self.checkpointed_at - timedelta(seconds=PROJECTOR_REBUILD_HORIZON)
+            events_filter = {**events_filter, "created_at": {"$gte": since}}
+        events = []
+        async for event in self.event_collection.find(events_filter):
+            events.append(codec.decode(event))
+            if len(events) == self.batch_size:
+                await self._write_outbox(events)
+                events = []
+        if events:
+            await self._write_outbox(events)
+
+    async def _project(self, events: List[dict]) -> None:
+        # The outbox first: a crash in between replays the batch, and the
+        # records already written are skipped as duplicates.
+        await self._write_outbox(events)
+        await self.wallet_collection.bulk_write(balance_updates(events))
+        self.projected += len(events)
+        self.batches += 1
+        self.lag = (datetime.now() - events[-1]["created_at"]).total_seconds()
+
+    async def _write_outbox(self, events: List[dict]) -> None:
+        """Write the events' audit logs, skipping those already written."""
+        try:
+            await self.outbox_collection.bulk_write(
+                [InsertOne(event_outbox_record(event)) for event in events],
+                ordered=False,
+            )
+        except BulkWriteError as e:
+            if any(
+                error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]
+            ):
+                raise
+
+
+async def main() -> None:
+    await serve(BalanceProjector(), "balance_projector", PROJECTOR_METRICS_PORT)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,33 +1,491 @@
+import argparse
 import asyncio
-import json
+import multiprocessing
+import os
+import signal
+import time
+from typing import List
 import aio_pika
+import orjson
+from aio_pika.abc import AbstractIncomingMessage
 
-from infrastructure.els import save_log_to_elk
+from infrastructure.els import (
+    is_accepted,
+    is_retryable,
+    is_retryable_error,
+    save_log_to_elk,
+    save_logs_to_elk_bulk,
+)
+from infrastructure.metrics import registry, serve_metrics, set_process_endpoint, stage
 from infrastructure.queue.base import channel_pool
+from infrastructure.queue.segment_log import SegmentLog, SegmentReplayer
 
+CONSUMER_MODE = os.getenv("LOG_CONSUMER_MODE", "bulk")
+BULK_SIZE = int(os.getenv("LOG_BULK_SIZE", "500"))
+BULK_FLUSH_INTERVAL = float(os.getenv("LOG_BULK_FLUSH_INTERVAL", "1.0"))
+CONSUMER_METRICS_PORT = int(os.getenv("LOG_CONSUMER_METRICS_PORT", "0"))
+CONSUMER_WORKERS = int(os.getenv("LOG_CONSUMER_WORKERS", "1"))
+CONSUMER_CONCURRENCY = int(os.getenv("LOG_CONSUMER_CONCURRENCY", "10"))
+# 0 picks a default for the mode: twice the bulk size, or the concurrency.
+CONSUMER_PREFETCH = int(os.getenv("LOG_CONSUMER_PREFETCH", "0"))
+CONSUMER_DRAIN_TIMEOUT = float(os.getenv("LOG_CONSUMER_DRAIN_TIMEOUT", "30"))
+CONSUMER_STATS_INTERVAL = float(os.getenv("LOG_CONSUMER_STATS_INTERVAL", "10"))
+CONSUMER_SPILL_DIR = os.getenv("LOG_CONSUMER_SPILL_DIR", "spill/consumer")
 
-async def process_message(message: aio_pika.abc.AbstractIncomingMessage) -> None:
+
+def unpack_logs(data: dict) -> List[dict]:
+    """
+    Return the logs carried by a message: either a single log, or several
+    under a "logs" key as sent for batch operations.
+    """
+    return data["logs"] if "logs" in data else [data]
+
+
+def spill_logs(spill: SegmentLog, logs: List[dict]) -> bool:
+    """
+    Park logs in the spill log, to be indexed by its replayer.
+
+    Returns:
+        bool: False if the spill log is full and some logs were not parked.
+    """
+    return all([spill.append(orjson.dumps(log)) for log in logs])
+
+
+async def process_message(
+    message: aio_pika.abc.AbstractIncomingMessage, spill: SegmentLog | None = None
+) -> None:
+    """
+    Index the logs of a message one request at a time. When Elasticsearch is
+    unreachable (or a backlog is already spilled) the logs go to the spill log
+    instead of the message being requeued. Logs Elasticsearch rejects are
+    never spilled: they would be rejected again when replayed.
+    """
     async with message.process():
         try:
-            data = json.loads(message.body.decode())
-            await save_log_to_elk(data)
-        except json.JSONDecodeError as e:
+            logs = unpack_logs(orjson.loads(message.body))
+        except orjson.JSONDecodeError as e:
             print(f"Error decoding JSON: {e}")
+            return
+
+        if spill is not None and not spill.empty and spill_logs(spill, logs):
+            return
+
+        try:
+            if len(logs) == 1:
+                with stage("elk.save_log_to_elk"):
+                    await save_log_to_elk(logs[0])
+            else:
+                with stage("elk.save_logs_to_elk_bulk"):
+                    statuses = await save_logs_to_elk_bulk(logs)
+                if not all(map(is_accepted, statuses)):
+                    raise RuntimeError(
+                        "Elasticsearch rejected some logs of the message"
+                    )
+        except RuntimeError:
+            raise
+        except Exception as e:
+            if (
+                spill is None
+                or not is_retryable_error(e)
+                or not spill_logs(spill, logs)
+            ):
+                raise
+            print(f"Indexing failed, spilled {len(logs)} logs to disk: {e}")
+
+
+class BulkLogConsumer:
+    """
+    Collect log messages and index them into Elasticsearch with the bulk API.
+
+    A batch is flushed once it holds ``batch_size`` logs or ``flush_interval``
+    seconds after its first message arrived, whichever comes first. Messages are
+    acked only after Elasticsearch accepted them. Messages with items it failed
+    with a retryable status (429 or 5xx) are requeued; those with items it
+    rejected for good (other 4xx) are rejected without requeueing, so that
+    RabbitMQ dead-letters them if the queue has a dead-letter exchange, and
+    drops them otherwise. They are counted as ``rejected``.
+
+    With a spill log, a batch that cannot be indexed because Elasticsearch is
+    unreachable is appended to it and acked, rather than requeued into a hot
+    redelivery loop; later batches follow it there until the backlog is replayed.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = BULK_SIZE,
+        flush_interval: float = BULK_FLUSH_INTERVAL,
+        spill: SegmentLog | None = None,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.indexed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.spilled = 0
+        self.spill = spill
+        self.last_batch_rate = 0.0
+        self._batch: list[tuple[AbstractIncomingMessage, List[dict]]] = []
+        self._pending_logs = 0
+        self._flush_task: asyncio.Task | None = None
+        self._flushing = 0
+        self._started_at = time.monotonic()
+
+    @property
+    def prefetch_count(self) -> int:
+        """Let the next batch fill up while the current one is being indexed."""
+        return self.batch_size * 2
 
+    @property
+    def docs_per_second(self) -> float:
+        """Average number of documents indexed per second since start."""
+        elapsed = time.monotonic() - self._started_at
+        return self.indexed / elapsed if elapsed > 0 else 0.0
 
-async def consume() -> None:
+    def stats(self) -> dict:
+        return {
+            "indexed": self.indexed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "spilled": self.spilled,
+            "pending": self._pending_logs,
+            "docs_per_second": self.docs_per_second,
+            "last_batch_docs_per_second": self.last_batch_rate,
+        }
+
+    async def on_message(self, message: AbstractIncomingMessage) -> None:
+        try:
+            data = orjson.loads(message.body)
+        except orjson.JSONDecodeError as e:
+            print(f"Error decoding JSON: {e}")
+            await message.ack()
+            return
+
+        logs = unpack_logs(data)
+        if any("index" not in log or "document" not in log for log in logs):
+            print(f"Invalid log message: {data}")
+            await message.reject()
+            return
+
+        self._batch.append((message, logs))
+        self._pending_logs += len(logs)
+        if self._pending_logs >= self.batch_size:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Send the pending batch to Elasticsearch, then ack, requeue or reject
+        each message.
+        """
+        current = asyncio.current_task()
+        if self._flush_task is not None and self._flush_task is not current:
+            self._flush_task.cancel()
+        self._flush_task = None
+
+        batch, self._batch = self._batch, []
+        self._pending_logs = 0
+        if not batch:
+            return
+
+        self._flushing += 1
+        try:
+            await self._index(batch)
+        finally:
+            self._flushing -= 1
+
+    async def drain(self) -> None:
+        """Index the pending batch and wait for the flushes in progress."""
+        await self.flush()
+        while self._flushing:
+            await asyncio.sleep(0.05)
+
+    async def _index(
+        self, batch: list[tuple[AbstractIncomingMessage, List[dict]]]
+    ) -> None:
+        logs = [log for _, message_logs in batch for log in message_logs]
+        if self.spill is not None and not self.spill.empty:
+            await self._spill(batch)
+            return
+
+        started = time.monotonic()
+        try:
+            with stage("elk.save_logs_to_elk_bulk"):
+                statuses = await save_logs_to_elk_bulk(logs)
+        except Exception as e:
+            if not is_retryable_error(e):
+                print(
+                    f"Elasticsearch rejected the bulk request of {len(logs)} logs: {e}"
+                )
+                self.rejected += len(logs)
+                for message, _ in batch:
+                    await message.reject()
+                return
+            if self.spill is not None:
+                print(f"Bulk indexing failed, spilling {len(logs)} logs to disk: {e}")
+                await self._spill(batch)
+                return
+            print(f"Bulk indexing failed, requeueing {len(batch)} messages: {e}")
+            self.failed += len(logs)
+            for message, _ in batch:
+                await message.nack(requeue=True)
+            return
 
-    async with channel_pool.acquire() as channel:
-        await channel.set_qos(10)
+        # A message is acked only once every log it carries was accepted.
+        position = 0
+        for message, message_logs in batch:
+            failed = [
+                status
+                for status in statuses[position : position + len(message_logs)]
+                if not is_accepted(status)
+            ]
+            position += len(message_logs)
+            if not failed:
+                await message.ack()
+            elif any(map(is_retryable, failed)):
+                self.failed += len(failed)
+                await message.nack(requeue=True)
+            else:
+                print(f"Elasticsearch rejected {len(failed)} logs with {failed}")
+                self.rejected += len(failed)
+                await message.reject()
 
-        queue = await channel.declare_queue(
-            "logs", durable=False, auto_delete=False,
+        succeeded = sum(map(is_accepted, statuses))
+        self.indexed += succeeded
+
+        elapsed = time.monotonic() - started
+        self.last_batch_rate = succeeded / elapsed if elapsed > 0 else 0.0
+        print(
+            f"Indexed {succeeded}/{len(logs)} logs "
+            f"({self.last_batch_rate:.0f} docs/s, avg {self.docs_per_second:.0f} docs/s)"
+        )
+
+    async def _spill(
+        self, batch: list[tuple[AbstractIncomingMessage, List[dict]]]
+    ) -> None:
+        """
+        Park the batch in the spill log and ack its messages. Once the spill
+        log is full, the remaining messages are requeued instead.
+        """
+        full = False
+        for message, message_logs in batch:
+            full = full or not spill_logs(self.spill, message_logs)
+            if full:
+                self.failed += len(message_logs)
+                await message.nack(requeue=True)
+            else:
+                self.spilled += len(message_logs)
+                await message.ack()
+
+
+class ConsumerWorker:
+    """
+    One consumer of the logs queue, with its own channel.
+
+    At most ``concurrency`` messages are handled at once and ``prefetch``
+    messages are delivered ahead. On SIGTERM the worker stops taking new
+    deliveries, finishes the messages in flight (indexing a partly filled bulk
+    batch), then closes its channel; anything still unacked is redelivered by
+    RabbitMQ to the remaining workers.
+
+    Logs that could not be indexed while Elasticsearch was down are parked in
+    the worker's spill log and indexed by its replayer once it is back.
+    """
+
+    def __init__(
+        self,
+        index: int = 0,
+        concurrency: int = CONSUMER_CONCURRENCY,
+        prefetch: int = CONSUMER_PREFETCH,
+    ):
+        self.index = index
+        self.concurrency = concurrency
+        self.spill = SegmentLog(os.path.join(CONSUMER_SPILL_DIR, f"worker-{index}"))
+        self.replayer = SegmentReplayer(self.spill, self._reindex)
+        self.bulk = (
+            BulkLogConsumer(spill=self.spill) if CONSUMER_MODE == "bulk" else None
+        )
+        if prefetch:
+            self.prefetch = prefetch
+        elif self.bulk:
+            self.prefetch = self.bulk.prefetch_count
+        else:
+            self.prefetch = concurrency
+
+        self.handled = 0
+        self.queue_depth = 0
+        self.lag = 0.0
+        self.messages_per_second = 0.0
+        self._in_flight = 0
+        self._semaphore: asyncio.Semaphore | None = None
+        self._stopping: asyncio.Event | None = None
+
+    def stats(self) -> dict:
+        stats = {
+            "worker": self.index,
+            "handled": self.handled,
+            "in_flight": self._in_flight,
+            "queue_depth": self.queue_depth,
+            "lag_seconds": self.lag,
+            "messages_per_second": self.messages_per_second,
+        }
+        if self.bulk:
+            stats.update(self.bulk.stats())
+        stats.update(self.spill.stats())
+        stats.update(self.replayer.stats())
+        return stats
+
+    async def handle(self, message: AbstractIncomingMessage) -> None:
+        published_at = (message.headers or {}).get("published_at")
+        if published_at:
+            self.lag = max(0.0, time.time() - float(published_at))
+
+        async with self._semaphore:
+            self._in_flight += 1
+            try:
+                if self.bulk:
+                    await self.bulk.on_message(message)
+                else:
+                    await process_message(message, self.spill)
+            finally:
+                self._in_flight -= 1
+                self.handled += 1
+
+    async def run(self) -> None:
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, self._stopping.set)
+        loop.add_signal_handler(signal.SIGINT, self._stopping.set)
+
+        set_process_endpoint("consumer")
+        registry.register_stats("consumer", self.stats)
+        if CONSUMER_METRICS_PORT:
+            await serve_metrics(CONSUMER_METRICS_PORT + self.index)
+
+        async with channel_pool.acquire() as channel:
+            queue = await channel.declare_queue(
+                "logs",
+                durable=False,
+                auto_delete=False,
+            )
+            await channel.set_qos(self.prefetch)
+            consumer_tag = await queue.consume(self.handle, no_ack=False)
+            print(
+                f" [*] Worker {self.index} waiting for messages "
+                f"(prefetch {self.prefetch}, concurrency {self.concurrency})"
+            )
+
+            reporter = asyncio.create_task(self._report(channel))
+            await self.replayer.start()
+            await self._stopping.wait()
+
+            print(f" [*] Worker {self.index} draining {self._in_flight} messages")
+            await queue.cancel(consumer_tag)
+            reporter.cancel()
+            try:
+                await asyncio.wait_for(self._drain(), CONSUMER_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(
+                    f" [!] Worker {self.index} gave up draining after "
+                    f"{CONSUMER_DRAIN_TIMEOUT}s, unacked messages will be redelivered"
+                )
+            await self.replayer.stop()
+            self.spill.close()
+
+    async def _drain(self) -> None:
+        while self._in_flight:
+            await asyncio.sleep(0.05)
+        if self.bulk:
+            await self.bulk.drain()
+
+    async def _reindex(self, records: List[bytes]) -> None:
+        logs = [orjson.loads(record) for record in records]
+        with stage("elk.save_logs_to_elk_bulk"):
+            statuses = await save_logs_to_elk_bulk(logs)
+        failed = [status for status in statuses if not is_accepted(status)]
+        if any(map(is_retryable, failed)):
+            # The replayer retries the whole batch with backoff.
+            raise RuntimeError(f"Elasticsearch failed {len(failed)} replayed logs")
+        if failed:
+            # A log it rejects now would be rejected on every retry.
+            print(f"Elasticsearch rejected {len(failed)} replayed logs")
+        if self.bulk:
+            self.bulk.indexed += len(statuses) - len(failed)
+            self.bulk.rejected += len(failed)
+
+    async def _report(self, channel) -> None:
+        """Refresh and print the queue depth, lag and throughput periodically."""
+        handled = self.handled
+        while True:
+            await asyncio.sleep(CONSUMER_STATS_INTERVAL)
+            queue = await channel.declare_queue("logs", passive=True)
+            self.queue_depth = queue.declaration_result.message_count
+            self.messages_per_second = (
+                self.handled - handled
+            ) / CONSUMER_STATS_INTERVAL
+            handled = self.handled
+            print(
+                f"Worker {self.index}: queue depth {self.queue_depth}, "
+                f"lag {self.lag:.2f}s, {self.messages_per_second:.0f} msg/s"
+            )
+
+
+def run_worker(index: int, concurrency: int, prefetch: int) -> None:
+    asyncio.run(ConsumerWorker(index, concurrency, prefetch).run())
+
+
+def main() -> None:
+    """
+    Start the log consumer workers, one process each (a single worker
+    included), and stop them on SIGTERM or SIGINT. A worker that crashes is
+    restarted.
+    """
+    parser = argparse.ArgumentParser(description="Index audit logs from RabbitMQ.")
+    parser.add_argument("--workers", type=int, default=CONSUMER_WORKERS)
+    parser.add_argument("--concurrency", type=int, default=CONSUMER_CONCURRENCY)
+    parser.add_argument("--prefetch", type=int, default=CONSUMER_PREFETCH)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    stopping = False
+
+    def start(index: int) -> multiprocessing.Process:
+        process = context.Process(
+            target=run_worker,
+            args=(index, args.concurrency, args.prefetch),
+            name=f"log-consumer-{index}",
         )
+        process.start()
+        return process
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
 
-        await queue.consume(process_message, no_ack=False)
+    workers = {index: start(index) for index in range(args.workers)}
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
 
-        print(" [*] Waiting for messages. To exit press CTRL+C")
-        await asyncio.Future()
+    while workers:
+        for index, process in list(workers.items()):
+            process.join(timeout=1)
+            if process.is_alive():
+                continue
+            if stopping or process.exitcode == 0:
+                del workers[index]
+            else:
+                print(f" [!] Worker {index} exited with {process.exitcode}, restarting")
+                workers[index] = start(index)
 
 
-asyncio.run(consume())
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,95 @@
-import json
+import asyncio
+import time
+from typing import List
 import aio_pika
+import orjson
 from aio_pika import ExchangeType, DeliveryMode
+from aio_pika.abc import AbstractChannel, AbstractExchange
 
+from infrastructure.metrics import timed
 from infrastructure.queue.base import channel_pool
 
 queue_name = "logs"
+routing_key = "logs"
 
+# Exchanges already declared (and bound to the logs queue) per pooled channel.
+_exchanges: dict[AbstractChannel, AbstractExchange] = {}
+
+
+async def declare_topology(channel: AbstractChannel) -> AbstractExchange:
+    """
+    Declare the logs exchange and queue on the channel and bind them together.
+    """
+    exchange = await channel.declare_exchange("logs", type=ExchangeType.DIRECT)
+
+    queue = await channel.declare_queue(queue_name)
+
+    await queue.bind(exchange, routing_key)
+    return exchange
+
+
+async def get_exchange(channel: AbstractChannel) -> AbstractExchange:
+    """
+    Return the logs exchange for the channel, declaring the topology only the
+    first time the channel is used or after it was closed or reopened.
+    """
+    exchange = _exchanges.get(channel)
+    if exchange is None:
+        exchange = await declare_topology(channel)
+        _exchanges[channel] = exchange
+
+        channel.close_callbacks.add(_forget_channel)
+        if hasattr(channel, "reopen_callbacks"):
+            channel.reopen_callbacks.add(_forget_channel)
+    return exchange
 
-async def publish_logs(data: dict) -> None:
-    routing_key = "logs"
-    async with channel_pool.acquire() as channel:
-        exchange = await channel.declare_exchange(
-            "logs",
-            type=ExchangeType.DIRECT
-        )
 
-        queue = await channel.declare_queue(queue_name)
+def _forget_channel(channel: AbstractChannel, *args) -> None:
+    _exchanges.pop(channel, None)
 
-        await queue.bind(exchange, routing_key)
 
-        message_body = json.dumps(data)
+@timed("publisher.publish_logs")
+async def publish_logs(data: dict) -> None:
+    async with channel_pool.acquire() as channel:
+        exchange = await get_exchange(channel)
+
         message = aio_pika.Message(
-            body=message_body.encode(),
-            delivery_mode=DeliveryMode.PERSISTENT
+            body=orjson.dumps(data),
+            delivery_mode=DeliveryMode.PERSISTENT,
+            headers={"published_at": time.time()},
         )
 
-        print("send message start.")
         await exchange.publish(message=message, routing_key=routing_key)
-        print("send message done.")
+
+
+@timed("publisher.publish_logs_batch")
+async def publish_logs_batch(data: List[dict]) -> List[Exception | None]:
+    """
+    Publish several logs, one message each, over a single pooled channel.
+
+    The messages are all sent before any confirm is awaited, so the batch
+    costs one confirm round trip rather than one per message.
+
+    Returns:
+        List[Exception | None]: For each log, None once the broker confirmed
+            it, or the error that failed its publish.
+    """
+    published_at = time.time()
+    async with channel_pool.acquire() as channel:
+        exchange = await get_exchange(channel)
+
+        results = await asyncio.gather(
+            *(
+                exchange.publish(
+                    message=aio_pika.Message(
+                        body=orjson.dumps(item),
+                        delivery_mode=DeliveryMode.PERSISTENT,
+                        headers={"published_at": published_at},
+                    ),
+                    routing_key=routing_key,
+                )
+                for item in data
+            ),
+            return_exceptions=True,
+        )
+    return [result if isinstance(result, Exception) else None for result in results]
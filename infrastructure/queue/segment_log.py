@@ -0,0 +1,329 @@
+import asyncio
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Awaitable, Callable, List
+
+SPILL_SEGMENT_SIZE = int(os.getenv("SPILL_SEGMENT_SIZE", str(16 * 1024 * 1024)))
+SPILL_MAX_SEGMENTS = int(os.getenv("SPILL_MAX_SEGMENTS", "64"))
+SPILL_REPLAY_BATCH_SIZE = int(os.getenv("SPILL_REPLAY_BATCH_SIZE", "500"))
+SPILL_REPLAY_INTERVAL = float(os.getenv("SPILL_REPLAY_INTERVAL", "1.0"))
+
+# Payload length, CRC32 of the payload, time the record was appended.
+RECORD_HEADER = struct.Struct("<IId")
+CURSOR_FILE = "cursor"
+
+
+class SegmentLog:
+    """
+    Append-only log of records, stored in fixed-size memory-mapped segment files.
+
+    Segment files are preallocated to ``segment_size`` bytes and named after
+    their sequence number. A record is a header followed by its payload; the
+    zero-filled tail of a segment marks where the written records end. Records
+    are read in the order they were appended, and a read only becomes
+    permanent once its position is committed: the cursor is saved to disk and
+    the segments before it are deleted, so a restart resumes where the last
+    commit left off.
+
+    At most ``max_segments`` segments exist at once; appends beyond that are
+    refused, which bounds the disk used during a long outage. The data lives in
+    the page cache rather than the Python heap, so memory stays flat however
+    much is spilled.
+
+    The directory is opened (and recovered) on first use. Not thread safe:
+    used from the event loop only.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_size: int = SPILL_SEGMENT_SIZE,
+        max_segments: int = SPILL_MAX_SEGMENTS,
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.appended = 0
+        self.dropped = 0
+
+        self._maps: dict[int, mmap.mmap] = {}
+        self._segments: list[int] | None = None
+        self._ends: dict[int, int] = {}
+        self._read_segment: int | None = None
+        self._read_offset = 0
+
+    def _open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._segments = sorted(
+            int(name.split(".")[0])
+            for name in os.listdir(self.directory)
+            if name.endswith(".segment")
+        )
+        # Written end offset of every segment, recovered by scanning them.
+        self._ends = {seq: self._scan_end(seq) for seq in self._segments}
+        self._read_segment, self._read_offset = self._load_cursor()
+
+    @property
+    def pending_bytes(self) -> int:
+        """Bytes appended and not yet committed as read."""
+        if self._segments is None:
+            self._open()
+        return sum(self._ends.values()) - self._read_offset
+
+    @property
+    def empty(self) -> bool:
+        return self.pending_bytes == 0
+
+    def stats(self) -> dict:
+        pending_bytes = self.pending_bytes
+        return {
+            "spill_segments": len(self._segments),
+            "spill_pending_bytes": pending_bytes,
+            "spill_appended": self.appended,
+            "spill_dropped": self.dropped,
+            "replay_lag_seconds": self.lag(),
+        }
+
+    def lag(self) -> float:
+        """Seconds since the oldest unread record was appended."""
+        if self._segments is None:
+            return 0.0
+        seq, offset = self._read_segment, self._read_offset
+        while seq is not None and offset >= self._ends[seq]:
+            seq, offset = self._next_segment(seq), 0
+        if seq is None:
+            return 0.0
+
+        _, _, appended_at = RECORD_HEADER.unpack_from(self._map(seq), offset)
+        return max(0.0, time.time() - appended_at)
+
+    def append(self, payload: bytes) -> bool:
+        """
+        Append a record.
+
+        Returns:
+            bool: False if the record was dropped because the log is full.
+
+        Raises:
+            ValueError: If the payload is empty or larger than a segment.
+        """
+        size = RECORD_HEADER.size + len(payload)
+        if not payload or size > self.segment_size:
+            raise ValueError(f"Cannot append a record of {len(payload)} bytes")
+        if self._segments is None:
+            self._open()
+
+        last = self._segments[-1] if self._segments else None
+        if last is None or self._ends[last] + size > self.segment_size:
+            # A fully read first segment is deleted by the roll.
+            if len(self._segments) - self._head_consumed() >= self.max_segments:
+                self.dropped += 1
+                return False
+            self._roll()
+
+        seq = self._segments[-1]
+        segment, offset = self._map(seq), self._ends[seq]
+        RECORD_HEADER.pack_into(
+            segment, offset, len(payload), zlib.crc32(payload), time.time()
+        )
+        segment[offset + RECORD_HEADER.size : offset + size] = payload
+        self._ends[seq] = offset + size
+        self.appended += 1
+        return True
+
+    def read(self, max_records: int) -> tuple[List[bytes], tuple[int, int]]:
+        """
+        Return up to ``max_records`` unread records, oldest first, and the
+        position to ``commit`` once they have been handled.
+        """
+        if self._segments is None:
+            self._open()
+        records = []
+        seq, offset = self._read_segment, self._read_offset
+        while seq is not None and len(records) < max_records:
+            if offset >= self._ends[seq]:
+                following = self._next_segment(seq)
+                if following is None:
+                    break
+                seq, offset = following, 0
+                continue
+
+            segment = self._map(seq)
+            length, _, _ = RECORD_HEADER.unpack_from(segment, offset)
+            start = offset + RECORD_HEADER.size
+            records.append(segment[start : start + length])
+            offset = start + length
+
+        return records, (seq, offset)
+
+    def commit(self, position: tuple[int, int]) -> None:
+        """Mark the records before ``position`` as handled."""
+        seq, offset = position
+        if seq is None:
+            return
+
+        while self._segments and self._segments[0] < seq:
+            self._delete(self._segments[0])
+        self._read_segment, self._read_offset = seq, offset
+        self._save_cursor()
+
+    def close(self) -> None:
+        for segment in self._maps.values():
+            segment.flush()
+            segment.close()
+        self._maps.clear()
+        self._segments = None
+
+    def _next_segment(self, seq: int) -> int | None:
+        index = self._segments.index(seq) + 1
+        return self._segments[index] if index < len(self._segments) else None
+
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{seq:020d}.segment")
+
+    def _map(self, seq: int) -> mmap.mmap:
+        segment = self._maps.get(seq)
+        if segment is None:
+            with open(self._path(seq), "r+b") as segment_file:
+                segment = mmap.mmap(segment_file.fileno(), self.segment_size)
+            self._maps[seq] = segment
+        return segment
+
+    def _roll(self) -> None:
+        """Start a new segment; the current one is complete."""
+        if self._segments:
+            current = self._segments[-1]
+            self._maps[current].flush()
+            if current != self._read_segment:
+                self._maps.pop(current).close()
+
+        seq = self._segments[-1] + 1 if self._segments else 0
+        with open(self._path(seq), "wb") as segment_file:
+            segment_file.truncate(self.segment_size)
+        self._segments.append(seq)
+        self._ends[seq] = 0
+        if self._read_segment is None:
+            self._read_segment, self._read_offset = seq, 0
+        elif self._head_consumed():
+            self._delete(self._read_segment)
+            self._read_segment, self._read_offset = self._segments[0], 0
+            self._save_cursor()
+
+    def _head_consumed(self) -> bool:
+        """Whether every record of the first segment was read and committed."""
+        if not self._segments:
+            return False
+        return self._read_offset >= self._ends[self._read_segment]
+
+    def _delete(self, seq: int) -> None:
+        segment = self._maps.pop(seq, None)
+        if segment is not None:
+            segment.close()
+        os.remove(self._path(seq))
+        self._segments.remove(seq)
+        del self._ends[seq]
+
+    def _scan_end(self, seq: int) -> int:
+        """
+        Return where the valid records of a segment end, stopping at the
+        zero-filled tail or at a record torn by a crash.
+        """
+        segment = self._map(seq)
+        offset = 0
+        while offset + RECORD_HEADER.size <= self.segment_size:
+            length, crc, _ = RECORD_HEADER.unpack_from(segment, offset)
+            start = offset + RECORD_HEADER.size
+            if length == 0 or start + length > self.segment_size:
+                break
+            if zlib.crc32(segment[start : start + length]) != crc:
+                break
+            offset = start + length
+        return offset
+
+    def _load_cursor(self) -> tuple[int | None, int]:
+        first = self._segments[0] if self._segments else None
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as cursor_file:
+                seq, offset = (int(value) for value in cursor_file.read().split())
+        except (FileNotFoundError, ValueError):
+            return first, 0
+
+        if seq not in self._ends:
+            return first, 0
+        return seq, min(offset, self._ends[seq])
+
+    def _save_cursor(self) -> None:
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", "w") as cursor_file:
+            cursor_file.write(f"{self._read_segment} {self._read_offset}")
+        os.replace(path + ".tmp", path)
+
+
+class SegmentReplayer:
+    """
+    Background task delivering the records of a segment log to their
+    downstream, in order, once it accepts them again.
+
+    Records are committed only after ``deliver`` returned, so a crash or a
+    failed delivery replays them (at least once). Failures are retried with
+    exponential backoff.
+    """
+
+    def __init__(
+        self,
+        log: SegmentLog,
+        deliver: Callable[[List[bytes]], Awaitable[None]],
+        batch_size: int = SPILL_REPLAY_BATCH_SIZE,
+        interval: float = SPILL_REPLAY_INTERVAL,
+    ):
+        self.log = log
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.interval = interval
+        self.replayed = 0
+        self.failures = 0
+        self._task: asyncio.Task | None = None
+
+    def stats(self) -> dict:
+        return {"replayed": self.replayed, "replay_failures": self.failures}
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop replaying; records not yet committed are replayed after restart."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        delay = self.interval
+        while True:
+            records, position = self.log.read(self.batch_size)
+            if not records:
+                await asyncio.sleep(self.interval)
+                continue
+
+            try:
+                await self.deliver(records)
+            except Exception as e:
+                self.failures += 1
+                print(
+                    f"Replaying {len(records)} spilled records failed, "
+                    f"retrying in {delay:.1f}s: {e}"
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+                continue
+
+            delay = self.interval
+            self.log.commit(position)
+            self.replayed += len(records)
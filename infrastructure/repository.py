@@ -1,7 +1,105 @@
-from typing import Callable, List
+import base64
+import binascii
+import json
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import AsyncIterator, Callable, List
 from domain.events import WalletCreated, Deposited, Withdrawn, Event
+from domain.exceptions import (
+    ConcurrentAppendError,
+    DuplicateCommandError,
+    NegativeBalanceError,
+    WalletNotFoundError,
+)
+from infrastructure.buckets import EVENT_STORAGE, event_bucket_store
+from infrastructure.cache import wallet_cache
+from infrastructure.codec import codec
 from infrastructure.data_access import mongo_instance
-from pymongo.errors import PyMongoError, DuplicateKeyError
+from infrastructure.idempotency import idempotency_id, request_fingerprint
+from infrastructure.metrics import timed
+from infrastructure.outbox import (
+    SUCCESS_MESSAGES,
+    event_audit_log,
+    outbox_record,
+    record_rejections,
+)
+from infrastructure.snapshots import HEAD_SORT, head_query, snapshot_store
+from infrastructure.transactions import transaction_runner
+from pymongo import InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+EVENTS_TRANSACTIONS_LIMIT = 1000
+TRANSACTIONS_PAGE_SIZE = 100
+TRANSACTIONS_STREAM_BATCH_SIZE = 500
+BATCH_TRANSACTION_SIZE = 1000
+
+# "sync" updates WalletBalance in the command's transaction; "async" only
+# appends to WalletEvents and leaves WalletBalance to the balance projector.
+WALLET_PROJECTION = os.getenv("WALLET_PROJECTION", "sync")
+APPEND_CONFLICT_RETRIES = int(os.getenv("APPEND_CONFLICT_RETRIES", "10"))
+
+# Versioned events are appended one document each, so buckets only apply to
+# the synchronous projection.
+EVENT_BUCKETS = EVENT_STORAGE == "buckets" and WALLET_PROJECTION == "sync"
+
+DUPLICATE_KEY = 11000
+
+TRANSACTIONS_SORT = [("created_at", 1), ("transaction_id", 1)]
+
+
+def stamp_version(event: Event, version: int) -> None:
+    """
+    Record on the event's document the version of its wallet it was committed
+    with. Deliberately mutates the cached document, so the version is stored
+    with the event and returned to the client.
+    """
+    event.to_document()["version"] = version
+
+
+def wallet_query(user_id: int = None, wallet_id: str = None) -> dict:
+    """Query for a wallet in WalletBalance, by wallet ID or else by user ID."""
+    if not wallet_id:
+        return {"user_id": user_id}
+    return {"wallet_id": codec.encode_uuid(wallet_id)}
+
+
+def batch_wallets_query(wallet_ids: List[str], user_ids: List[int]) -> dict:
+    """Query for the wallets a batch touches or would create."""
+    return {
+        "$or": [
+            {"wallet_id": {"$in": [codec.encode_uuid(w) for w in wallet_ids]}},
+            {"user_id": {"$in": user_ids}},
+        ]
+    }
+
+
+def encode_cursor(transaction: dict) -> str:
+    """
+    Build the opaque pagination cursor pointing right after the given transaction.
+    """
+    position = {
+        "created_at": transaction["created_at"].isoformat(),
+        "transaction_id": transaction["transaction_id"],
+    }
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    Decode a pagination cursor built by ``encode_cursor``.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {
+            "created_at": datetime.fromisoformat(position["created_at"]),
+            "transaction_id": position["transaction_id"],
+        }
+    except (binascii.Error, json.JSONDecodeError, KeyError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
 
 
 class WalletCommandRepository:
@@ -14,23 +112,36 @@ class WalletCommandRepository:
         self.db = mongo_instance
         self.wallet_collection = None
         self.event_collection = None
+        self.idempotency_collection = None
+        self.outbox_collection = None
 
-    async def apply(self, event: Event) -> None:
+    @timed("repository.apply")
+    async def apply(self, event: Event, idempotency_key: str = None) -> None:
         """
-        Apply the given event to update the wallet and event collections.
+        Apply the given event to update the wallet and event collections, and
+        record its audit log in the outbox.
 
         Args:
             event: The event to apply.
+            idempotency_key: Client key recorded with the event in the same
+                transaction, so the command is applied at most once per key.
 
         Raises:
             PyMongoError: If there is an error during MongoDB operations.
-            ValueError: If there is an invalid operation, e.g., withdrawing more than the available balance.
+            WalletNotFoundError: If the wallet to deposit to or withdraw from does not exist.
+            NegativeBalanceError: If withdrawing more than the available balance.
+            DuplicateCommandError: If a command was already applied with the idempotency key.
             DuplicateKeyError: If there is a duplicate key error during MongoDB operations.
         """
 
         if not self.wallet_collection or not self.event_collection:
             await self._initialize_collections()
 
+        if WALLET_PROJECTION == "async":
+            await self._append([event], idempotency_key=idempotency_key)
+            await self._after_commit([event])
+            return
+
         async def transaction_logic(session):
             """
             Execute the transaction logic within a MongoDB session.
@@ -39,58 +150,496 @@ class WalletCommandRepository:
                 session: The MongoDB session to execute the transaction in.
             """
 
+            if idempotency_key:
+                try:
+                    await self.idempotency_collection.insert_one(
+                        {
+                            "_id": idempotency_id(event.event_type, idempotency_key),
+                            "event": event.to_document(),
+                            "fingerprint": request_fingerprint(event.to_document()),
+                            "created_at": datetime.now(),
+                        },
+                        session=session,
+                    )
+                except DuplicateKeyError as e:
+                    raise DuplicateCommandError(idempotency_key) from e
+
             match event.event_type:
                 case "WalletCreated":
+                    stamp_version(event, 1)
                     await self.wallet_collection.insert_one(
-                        document=event.model_dump(), session=session
-                    )
-                    await self.event_collection.insert_one(
-                        document=event.model_dump(), session=session
+                        document=codec.encode(dict(event.to_document())),
+                        session=session,
                     )
+                    await self._record_events([event], session)
 
                 case "Deposited":
-                    await self.wallet_collection.find_one_and_update(
-                        {"wallet_id": event.wallet_id},
-                        {"$inc": {"balance": event.amount}},
+                    wallet = await self.wallet_collection.find_one_and_update(
+                        {"wallet_id": codec.encode_uuid(event.wallet_id)},
+                        {
+                            "$inc": {
+                                "balance": codec.encode_money(event.amount),
+                                "version": 1,
+                            }
+                        },
+                        projection={"_id": 0, "version": 1},
+                        return_document=ReturnDocument.AFTER,
                         session=session,
                     )
-                    await self.event_collection.insert_one(
-                        document=event.model_dump(), session=session
-                    )
+                    if wallet is None:
+                        raise WalletNotFoundError("Wallet does not exist.")
+
+                    stamp_version(event, wallet["version"])
+                    await self._record_events([event], session)
 
                 case "Withdrawn":
-                    wallet = await self.wallet_collection.find_one(
-                        {"wallet_id": event.wallet_id}, session=session
+                    # Deduct only when the balance covers the amount. The
+                    # pre-image tells apart a missing wallet (None) from
+                    # insufficient funds without a separate read.
+                    amount = codec.encode_money(event.amount)
+                    wallet = await self.wallet_collection.find_one_and_update(
+                        {"wallet_id": codec.encode_uuid(event.wallet_id)},
+                        [
+                            {
+                                "$set": {
+                                    "balance": {
+                                        "$cond": [
+                                            {"$gte": ["$balance", amount]},
+                                            {"$subtract": ["$balance", amount]},
+                                            "$balance",
+                                        ]
+                                    },
+                                    # A rejected withdrawal aborts the
+                                    # transaction, so this is never kept.
+                                    "version": {
+                                        "$add": [{"$ifNull": ["$version", 0]}, 1]
+                                    },
+                                }
+                            }
+                        ],
+                        projection={"_id": 0, "balance": 1, "version": 1},
+                        return_document=ReturnDocument.BEFORE,
+                        session=session,
                     )
+                    if wallet is None:
+                        raise WalletNotFoundError("Wallet does not exist.")
+                    if amount > wallet["balance"]:
+                        raise NegativeBalanceError("Unable to withdraw")
 
-                    balance = wallet["balance"]
-                    if event.amount > balance:
-                        raise ValueError("Unable to withdraw")
+                    stamp_version(event, wallet.get("version", 0) + 1)
+                    await self._record_events([event], session)
 
-                    await self.wallet_collection.update_one(
-                        {"wallet_id": event.wallet_id},
-                        {"$inc": {"balance": -event.amount}},
-                        session=session,
-                    )
-                    await self.event_collection.insert_one(
-                        document=event.model_dump(), session=session
+            log = event_audit_log(event, SUCCESS_MESSAGES[event.event_type], True)
+            await self.outbox_collection.insert_one(
+                outbox_record([log]), session=session
+            )
+
+        await self._run_transaction(transaction_logic, wallet_id=event.wallet_id)
+        await self._after_commit([event])
+
+    @timed("repository.apply_deposits")
+    async def apply_deposits(self, events: List[Deposited]) -> None:
+        """
+        Apply several deposits to the same wallet in one transaction, with a
+        single increment of their summed amount.
+
+        Args:
+            events: The deposits to apply, all for the same wallet.
+
+        Raises:
+            PyMongoError: If there is an error during MongoDB operations.
+            WalletNotFoundError: If the wallet does not exist.
+        """
+
+        if not self.wallet_collection or not self.event_collection:
+            await self._initialize_collections()
+
+        if WALLET_PROJECTION == "async":
+            await self._append(events)
+            await self._after_commit(events)
+            return
+
+        wallet_id = events[0].wallet_id
+
+        async def transaction_logic(session):
+            amount = sum(codec.encode_money(event.amount) for event in events)
+            wallet = await self.wallet_collection.find_one_and_update(
+                {"wallet_id": codec.encode_uuid(wallet_id)},
+                {"$inc": {"balance": amount, "version": len(events)}},
+                projection={"_id": 0, "version": 1},
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            if wallet is None:
+                raise WalletNotFoundError("Wallet does not exist.")
+
+            first_version = wallet["version"] - len(events) + 1
+            for version, event in enumerate(events, start=first_version):
+                stamp_version(event, version)
+            await self._record_events(events, session)
+            await self.outbox_collection.insert_one(
+                outbox_record(
+                    [
+                        event_audit_log(event, SUCCESS_MESSAGES["Deposited"], True)
+                        for event in events
+                    ]
+                ),
+                session=session,
+            )
+
+        await self._run_transaction(transaction_logic, wallet_id=wallet_id)
+        await self._after_commit(events)
+
+    @timed("repository.apply_batch")
+    async def apply_batch(self, events: List[Event]) -> List[Exception | None]:
+        """
+        Apply a batch of events in as few transactions as possible.
+
+        Events are applied in order, ``BATCH_TRANSACTION_SIZE`` per transaction.
+        Each transaction reads the involved wallets once, checks every event
+        against the running balances, then writes all wallet changes with one
+        ``bulk_write`` and all accepted events with one ``insert_many``.
+
+        With the asynchronous projection, events are appended one at a time
+        instead, each against the version of its wallet.
+
+        A transaction (or append) that fails does not fail the batch: the ones
+        before it are committed, so its events are reported as rejected by the
+        error and the batch goes on with the next one.
+
+        Args:
+            events: The events to apply.
+
+        Returns:
+            List[Exception | None]: For each event, None if it was applied or
+                the error that rejected it.
+        """
+
+        if not self.wallet_collection or not self.event_collection:
+            await self._initialize_collections()
+
+        if WALLET_PROJECTION == "async":
+            results = [await self._append_quietly(event) for event in events]
+            await self._record_batch_rejections(
+                [event for event, error in zip(events, results) if error]
+            )
+            return results
+
+        results = []
+        for start in range(0, len(events), BATCH_TRANSACTION_SIZE):
+            chunk = events[start : start + BATCH_TRANSACTION_SIZE]
+            results.extend(await self._apply_chunk(chunk))
+        return results
+
+    async def _apply_chunk(self, events: List[Event]) -> List[Exception | None]:
+        results: List[Exception | None] = []
+        applied: List[Event] = []
+
+        async def transaction_logic(session):
+            # Start over on every attempt of the transaction.
+            results.clear()
+            applied.clear()
+
+            wallet_ids = [
+                e.wallet_id for e in events if e.event_type != "WalletCreated"
+            ]
+            user_ids = [e.user_id for e in events if e.event_type == "WalletCreated"]
+            wallets = self.wallet_collection.find(
+                batch_wallets_query(wallet_ids, user_ids),
+                {"_id": 0, "wallet_id": 1, "user_id": 1, "balance": 1, "version": 1},
+                session=session,
+            )
+            balances = {}
+            versions = {}
+            users = set()
+            async for wallet in wallets:
+                wallet = codec.decode(wallet)
+                balances[wallet["wallet_id"]] = wallet["balance"]
+                versions[wallet["wallet_id"]] = wallet.get("version", 0)
+                users.add(wallet["user_id"])
+
+            operations = []
+            # In stored units, summed into one $inc per wallet.
+            changes = defaultdict(int)
+            version_changes = defaultdict(int)
+            for event in events:
+                match event.event_type:
+                    case "WalletCreated":
+                        if event.user_id in users:
+                            results.append(ValueError("Wallet already exists"))
+                            continue
+                        users.add(event.user_id)
+                        balances[event.wallet_id] = event.balance
+                        versions[event.wallet_id] = 1
+                        stamp_version(event, 1)
+                        operations.append(
+                            InsertOne(codec.encode(dict(event.to_document())))
+                        )
+
+                    case "Deposited":
+                        if event.wallet_id not in balances:
+                            results.append(
+                                WalletNotFoundError("Wallet does not exist.")
+                            )
+                            continue
+                        balances[event.wallet_id] += event.amount
+                        changes[event.wallet_id] += codec.encode_money(event.amount)
+
+                    case "Withdrawn":
+                        if event.wallet_id not in balances:
+                            results.append(
+                                WalletNotFoundError("Wallet does not exist.")
+                            )
+                            continue
+                        if event.amount > balances[event.wallet_id]:
+                            results.append(NegativeBalanceError("Unable to withdraw"))
+                            continue
+                        balances[event.wallet_id] -= event.amount
+                        changes[event.wallet_id] -= codec.encode_money(event.amount)
+
+                if event.event_type != "WalletCreated":
+                    versions[event.wallet_id] += 1
+                    version_changes[event.wallet_id] += 1
+                    stamp_version(event, versions[event.wallet_id])
+                results.append(None)
+                applied.append(event)
+
+            operations.extend(
+                UpdateOne(
+                    {"wallet_id": codec.encode_uuid(wallet_id)},
+                    {
+                        "$inc": {
+                            "balance": change,
+                            "version": version_changes[wallet_id],
+                        }
+                    },
+                )
+                for wallet_id, change in changes.items()
+            )
+            if operations:
+                await self.wallet_collection.bulk_write(operations, session=session)
+            if applied:
+                await self._record_events(applied, session)
+
+            logs = [
+                event_audit_log(
+                    event,
+                    f"Batch {event.event_type} "
+                    + ("successful" if error is None else "failed"),
+                    error is None,
+                )
+                for event, error in zip(events, results)
+            ]
+            await self.outbox_collection.insert_one(
+                outbox_record(logs), session=session
+            )
+
+        try:
+            await self._run_transaction(transaction_logic)
+        except Exception as e:
+            # Nothing of the chunk was committed, its audit logs included.
+            await self._record_batch_rejections(events)
+            return [e] * len(events)
+        if applied:
+            await self._after_commit(applied)
+        return list(results)
+
+    @staticmethod
+    async def _record_batch_rejections(events: List[Event]) -> None:
+        if events:
+            await record_rejections(
+                [
+                    event_audit_log(event, f"Batch {event.event_type} failed", False)
+                    for event in events
+                ]
+            )
+
+    async def _record_events(self, events: List[Event], session) -> None:
+        """
+        Store committed events in the transaction of the given session, as
+        one document each or in buckets.
+        """
+        if EVENT_BUCKETS:
+            await event_bucket_store.push(events, session=session)
+        elif len(events) == 1:
+            await self.event_collection.insert_one(
+                codec.encode(dict(events[0].to_document())), session=session
+            )
+        else:
+            await self.event_collection.insert_many(
+                [codec.encode(dict(event.to_document())) for event in events],
+                session=session,
+            )
+
+    async def _append_quietly(self, event: Event) -> Exception | None:
+        try:
+            await self._append([event])
+        except (WalletNotFoundError, NegativeBalanceError, ConcurrentAppendError) as e:
+            return e
+        except DuplicateKeyError:
+            return ValueError("Wallet already exists")
+        except Exception as e:
+            # The events before it are appended: only this one failed.
+            return e
+        await self._after_commit([event])
+        return None
+
+    async def _append(self, events: List[Event], idempotency_key: str = None) -> None:
+        """
+        Append events of one wallet to WalletEvents, without touching
+        WalletBalance.
+
+        Every appended event carries the next version of its wallet and the
+        balance after it, computed from the wallet's latest event. The unique
+        (wallet_id, version) index rejects an append that raced with another
+        one, in which case the head is read again and the events retried. The
+        version each event was stored with is added to its document.
+
+        Args:
+            events: The events to append, all for the same wallet.
+            idempotency_key: Client key stored on the (single) event.
+
+        Raises:
+            PyMongoError: If there is an error during MongoDB operations.
+            WalletNotFoundError: If the wallet does not exist.
+            NegativeBalanceError: If withdrawing more than the available balance.
+            DuplicateCommandError: If a command was already applied with the idempotency key.
+            DuplicateKeyError: If the user already has a wallet.
+            ConcurrentAppendError: If the append kept racing with others.
+        """
+        wallet_id = events[0].wallet_id
+        for _ in range(APPEND_CONFLICT_RETRIES):
+            version, balance = await self._head(events[0])
+            documents = []
+            for event in events:
+                match event.event_type:
+                    case "WalletCreated":
+                        balance = event.balance
+                    case "Deposited":
+                        balance += event.amount
+                    case "Withdrawn":
+                        if event.amount > balance:
+                            raise NegativeBalanceError("Unable to withdraw")
+                        balance -= event.amount
+                version += 1
+                documents.append(
+                    codec.encode(
+                        {
+                            **event.to_document(),
+                            "version": version,
+                            "balance_after": balance,
+                        }
                     )
+                )
+            if idempotency_key:
+                documents[0]["idempotency_id"] = idempotency_id(
+                    events[0].event_type, idempotency_key
+                )
+
+            try:
+                await self._insert_events(documents)
+            except DuplicateKeyError as e:
+                conflict = (e.details or {}).get("keyPattern", {})
+                if "idempotency_id" in conflict:
+                    raise DuplicateCommandError(idempotency_key) from e
+                if "version" not in conflict:
+                    raise
+                transaction_runner.record_conflict(wallet_id)
+                continue
+
+            for event, document in zip(events, documents):
+                stamp_version(event, document["version"])
+            return
+
+        raise ConcurrentAppendError(
+            f"Too many concurrent appends to wallet {wallet_id}"
+        )
+
+    async def _head(self, event: Event) -> tuple[int, float]:
+        """Return the version and balance of the event's wallet."""
+        if event.event_type == "WalletCreated":
+            return 0, 0.0
+
+        head = await self.event_collection.find_one(
+            head_query(event.wallet_id),
+            {"_id": 0, "version": 1, "balance_after": 1},
+            sort=HEAD_SORT,
+        )
+        if head is not None and "balance_after" in head:
+            return head["version"], codec.decode_money(head["balance_after"])
+
+        # The wallet was last written in synchronous mode, which keeps
+        # WalletBalance up to date.
+        wallet = await self.wallet_collection.find_one(
+            wallet_query(wallet_id=event.wallet_id),
+            {"_id": 0, "balance": 1, "version": 1},
+        )
+        if wallet is None:
+            raise WalletNotFoundError("Wallet does not exist.")
+        return wallet.get("version", 0), codec.decode_money(wallet["balance"])
+
+    async def _insert_events(self, documents: List[dict]) -> None:
+        if len(documents) == 1:
+            await self.event_collection.insert_one(documents[0])
+            return
 
-        await self._run_transaction(transaction_logic)
+        # Several events are appended all or nothing.
+        async def transaction_logic(session):
+            try:
+                await self.event_collection.insert_many(documents, session=session)
+            except BulkWriteError as e:
+                error = e.details["writeErrors"][0]
+                if error["code"] != DUPLICATE_KEY:
+                    raise
+                raise DuplicateKeyError(error["errmsg"], DUPLICATE_KEY, error) from e
+
+        await self._run_transaction(
+            transaction_logic, wallet_id=codec.decode(documents[0])["wallet_id"]
+        )
+
+    async def _after_commit(self, events: List[Event]) -> None:
+        """
+        Let the snapshot store and the wallet cache know about committed events.
+        """
+        # Buckets carry running totals and need no snapshots.
+        if not EVENT_BUCKETS:
+            for event in events:
+                snapshot_store.record(event.wallet_id)
+
+        last_events = {event.wallet_id: event for event in events}
+        for event in last_events.values():
+            if event.event_type == "WalletCreated":
+                await wallet_cache.set(
+                    {
+                        "wallet_id": event.wallet_id,
+                        "user_id": event.user_id,
+                        "balance": event.balance,
+                        "version": event.to_document().get("version", 0),
+                    }
+                )
+            else:
+                await wallet_cache.invalidate(
+                    event.wallet_id, event.to_document().get("version", 0)
+                )
 
     async def _initialize_collections(self):
         """
-        Initialize the wallet and event collections.
+        Initialize the wallet, event, idempotency key and outbox collections.
         """
         self.wallet_collection = await self.db.wallet_collection
         self.event_collection = await self.db.event_collection
+        self.idempotency_collection = await self.db.idempotency_collection
+        self.outbox_collection = await self.db.outbox_collection
 
-    async def _run_transaction(self, transaction_func: Callable):
+    @timed("repository.transaction")
+    async def _run_transaction(self, transaction_func: Callable, wallet_id: str = None):
         """
-        Execute a MongoDB transaction with the provided transaction logic.
+        Execute a MongoDB transaction with the provided transaction logic,
+        retrying it on transient errors such as write conflicts.
 
         Args:
             transaction_func: The transaction logic function to execute within the transaction.
+            wallet_id: The wallet the transaction writes to.
 
         Raises:
             PyMongoError: If there is an error during MongoDB operations.
@@ -98,21 +647,16 @@ class WalletCommandRepository:
             DuplicateKeyError: If there is a duplicate key error during MongoDB operations.
         """
 
-        try:
-            async with await self.db.client.start_session() as session:
-                async with session.start_transaction():
-                    await transaction_func(session)
-        except (PyMongoError, ValueError, DuplicateKeyError) as e:
-            raise e
+        await transaction_runner.run(self.db.client, transaction_func, wallet_id)
 
     async def create_wallet(self, event: WalletCreated) -> None:
         await self.apply(event)
 
-    async def deposit(self, event: Deposited) -> None:
-        await self.apply(event)
+    async def deposit(self, event: Deposited, idempotency_key: str = None) -> None:
+        await self.apply(event, idempotency_key=idempotency_key)
 
-    async def withdraw(self, event: Withdrawn) -> None:
-        await self.apply(event)
+    async def withdraw(self, event: Withdrawn, idempotency_key: str = None) -> None:
+        await self.apply(event, idempotency_key=idempotency_key)
 
 
 class WalletQueryRepository:
@@ -132,6 +676,7 @@ class WalletQueryRepository:
         self.wallet_collection = await self.db.wallet_collection
         self.event_collection = await self.db.event_collection
 
+    @timed("repository.get_wallet")
     async def get_wallet(
         self, user_id: int = None, wallet_id: str = None
     ) -> dict | None:
@@ -148,12 +693,12 @@ class WalletQueryRepository:
         if not self.wallet_collection or not self.event_collection:
             await self._initialize_collections()
 
-        if not wallet_id:
-            wallet = await self.wallet_collection.find_one({"user_id": user_id})
-        else:
-            wallet = await self.wallet_collection.find_one({"wallet_id": wallet_id})
-        return wallet if wallet else None
+        wallet = await self.wallet_collection.find_one(
+            wallet_query(user_id=user_id, wallet_id=wallet_id)
+        )
+        return codec.decode(wallet) if wallet else None
 
+    @timed("repository.get_balance")
     async def get_balance(self, wallet_id: str) -> float:
         """
         Retrieve the balance of a wallet.
@@ -172,69 +717,273 @@ class WalletQueryRepository:
             raise ValueError("Could not find wallet")
         return wallet["balance"]
 
-    async def get_transactions(self, wallet_id: str) -> List[dict]:
+    @staticmethod
+    def _transactions_query(wallet_id: str, after: dict = None) -> dict:
+        query = {
+            "wallet_id": codec.encode_uuid(wallet_id),
+            "event_type": {"$ne": codec.encode_event_type("WalletCreated")},
+        }
+        if after:
+            query["$or"] = [
+                {"created_at": {"$gt": after["created_at"]}},
+                {
+                    "created_at": after["created_at"],
+                    "transaction_id": {
+                        "$gt": codec.encode_uuid(after["transaction_id"])
+                    },
+                },
+            ]
+        return query
+
+    @timed("repository.get_transactions")
+    async def get_transactions(
+        self, wallet_id: str, limit: int = TRANSACTIONS_PAGE_SIZE, cursor: str = None
+    ) -> dict:
         """
-        Retrieve transactions for a wallet, excluding "WalletCreated" events.
+        Retrieve a page of transactions for a wallet, excluding "WalletCreated" events.
+
+        Transactions are ordered by (created_at, transaction_id); the returned
+        cursor points right after the last transaction of the page.
 
         Args:
             wallet_id (str): The ID of the wallet.
+            limit (int): Maximum number of transactions in the page.
+            cursor (str, optional): Cursor returned with the previous page.
 
         Returns:
-            List[dict]: List of transactions for the wallet.
+            dict: The transactions of the page and the cursor of the next page,
+                which is None on the last page.
+
+        Raises:
+            ValueError: If the cursor is invalid.
         """
         if not self.wallet_collection or not self.event_collection:
             await self._initialize_collections()
-        documents = self.event_collection.find(
-            {
-                "$and": [
-                    {"wallet_id": wallet_id},
-                    {"event_type": {"$ne": "WalletCreated"}},
-                ]
-            },
-            {"_id": 0, "wallet_id": 0},
-        )
 
-        transactions = [document async for document in documents]
-        return transactions
+        after = decode_cursor(cursor) if cursor else None
+        if EVENT_BUCKETS:
+            transactions = await event_bucket_store.get_transactions(
+                wallet_id, after=after, limit=limit + 1
+            )
+        else:
+            documents = (
+                self.event_collection.find(
+                    self._transactions_query(wallet_id, after),
+                    {"_id": 0, "wallet_id": 0},
+                )
+                .sort(TRANSACTIONS_SORT)
+                .limit(limit + 1)
+            )
+            transactions = [
+                codec.decode(document)
+                for document in await documents.to_list(length=limit + 1)
+            ]
+
+        next_cursor = None
+        if len(transactions) > limit:
+            transactions = transactions[:limit]
+            next_cursor = encode_cursor(transactions[-1])
+
+        return {"transactions": transactions, "next_cursor": next_cursor}
+
+    async def stream_transactions(self, wallet_id: str) -> AsyncIterator[dict]:
+        """
+        Yield every transaction of a wallet as the cursor fetches it, holding at
+        most one batch of ``TRANSACTIONS_STREAM_BATCH_SIZE`` documents in memory.
+        Bucketed events are read page by page instead.
 
-    async def get_events(self, wallet_id: str, from_date: str, to_date: str) -> dict:
+        Args:
+            wallet_id (str): The ID of the wallet.
+        """
+        if not self.wallet_collection or not self.event_collection:
+            await self._initialize_collections()
+
+        if EVENT_BUCKETS:
+            after = None
+            while True:
+                page = await event_bucket_store.get_transactions(
+                    wallet_id, after=after, limit=TRANSACTIONS_STREAM_BATCH_SIZE
+                )
+                for transaction in page:
+                    yield transaction
+                if len(page) < TRANSACTIONS_STREAM_BATCH_SIZE:
+                    return
+                after = page[-1]
+
+        documents = (
+            self.event_collection.find(
+                self._transactions_query(wallet_id),
+                {"_id": 0, "wallet_id": 0},
+            )
+            .sort(TRANSACTIONS_SORT)
+            .batch_size(TRANSACTIONS_STREAM_BATCH_SIZE)
+        )
+        async for document in documents:
+            yield codec.decode(document)
+
+    @staticmethod
+    def _events_pipeline(
+        wallet_id: str,
+        from_date: datetime,
+        to_date: datetime,
+        include_transactions: bool,
+        limit: int,
+    ) -> List[dict]:
+        facets = {
+            "totals": [
+                {
+                    "$group": {
+                        "_id": None,
+                        "deposited": {
+                            "$sum": {
+                                "$cond": [
+                                    {
+                                        "$eq": [
+                                            "$event_type",
+                                            codec.encode_event_type("Deposited"),
+                                        ]
+                                    },
+                                    "$amount",
+                                    0,
+                                ]
+                            }
+                        },
+                        "withdrawn": {
+                            "$sum": {
+                                "$cond": [
+                                    {
+                                        "$eq": [
+                                            "$event_type",
+                                            codec.encode_event_type("Withdrawn"),
+                                        ]
+                                    },
+                                    "$amount",
+                                    0,
+                                ]
+                            }
+                        },
+                        "count": {"$sum": 1},
+                    }
+                }
+            ]
+        }
+        if include_transactions:
+            facets["transactions"] = [
+                {"$limit": limit},
+                {"$project": {"_id": 0, "wallet_id": 0}},
+            ]
+
+        return [
+            {
+                "$match": {
+                    "wallet_id": codec.encode_uuid(wallet_id),
+                    "created_at": {"$gte": from_date, "$lte": to_date},
+                }
+            },
+            {"$sort": dict(TRANSACTIONS_SORT)},
+            {"$facet": facets},
+        ]
+
+    @timed("repository.get_events")
+    async def get_events(
+        self,
+        wallet_id: str,
+        from_date: datetime,
+        to_date: datetime,
+        include_transactions: bool = False,
+        limit: int = EVENTS_TRANSACTIONS_LIMIT,
+        include_balances: bool = False,
+    ) -> dict:
         """
         Retrieve events for a wallet within the specified date range.
 
+        The totals are computed by MongoDB in a single aggregation, so only a
+        small summary (plus the requested page of transactions) is sent back.
+        Bucketed events are summed from the bucket totals instead, reading only
+        the events of the buckets straddling the range bounds.
+
         Args:
             wallet_id (str): The ID of the wallet.
-            from_date (str): Start date of the date range (format: YYYY-MM-DD).
-            to_date (str): End date of the date range (format: YYYY-MM-DD).
+            from_date (datetime): Start of the date range.
+            to_date (datetime): End of the date range.
+            include_transactions (bool): Whether to return the transactions as well.
+            limit (int): Maximum number of transactions to return.
+            include_balances (bool): Whether to return the opening and closing
+                balance as well. The opening balance is replayed from the
+                nearest snapshot, so it costs more than the totals.
 
         Returns:
-            dict: Dictionary containing wallet balance and transactions within the specified date range.
+            dict: Dictionary containing the net change (wallet_balance), the
+                number of events, and when asked for, the opening and closing
+                balance and the transactions within the specified date range.
         """
 
         if not self.wallet_collection or not self.event_collection:
             await self._initialize_collections()
 
-        events = self.event_collection.find(
-            {
-                "$and": [
-                    {"wallet_id": wallet_id},
-                    {"created_at": {"$gte": from_date}},
-                    {"created_at": {"$lte": to_date}},
-                ]
-            },
-            {"_id": 0},
-        ).sort("created_at", 1)
+        if EVENT_BUCKETS:
+            totals = await event_bucket_store.get_events(
+                wallet_id, from_date, to_date, include_transactions, limit
+            )
+            events = {
+                "wallet_balance": totals["deposited"] - totals["withdrawn"],
+                "events_count": totals["count"],
+            }
+            if include_balances:
+                opening_balance = await event_bucket_store.balance_at(
+                    wallet_id, from_date, inclusive=False
+                )
+                events["opening_balance"] = opening_balance
+                events["closing_balance"] = opening_balance + events["wallet_balance"]
+            if include_transactions:
+                events["transactions"] = totals["transactions"]
+            return events
+
+        pipeline = self._events_pipeline(
+            wallet_id, from_date, to_date, include_transactions, limit
+        )
+        result = await self.event_collection.aggregate(pipeline).to_list(length=1)
 
-        wallet_balance = 0
-        transactions = []
-        async for event in events:
-            match event.get("event_type"):
-                case "WalletCreated":
-                    transactions.append(event)
-                case "Deposited":
-                    wallet_balance += event.get("amount", 0)
-                    transactions.append(event)
-                case "Withdrawn":
-                    wallet_balance -= event.get("amount", 0)
-                    transactions.append(event)
+        totals = result[0]["totals"][0] if result and result[0]["totals"] else {}
+        wallet_balance = codec.decode_money(
+            totals.get("deposited", 0) - totals.get("withdrawn", 0)
+        )
+
+        events = {
+            "wallet_balance": wallet_balance,
+            "events_count": totals.get("count", 0),
+        }
+        if include_balances:
+            opening_balance = await snapshot_store.balance_at(
+                wallet_id, from_date, inclusive=False
+            )
+            events["opening_balance"] = opening_balance
+            events["closing_balance"] = opening_balance + wallet_balance
+        if include_transactions:
+            events["transactions"] = [
+                codec.decode(document)
+                for document in (result[0]["transactions"] if result else [])
+            ]
+        return events
+
+    @timed("repository.get_balance_at")
+    async def get_balance_at(self, wallet_id: str, at: datetime) -> float:
+        """
+        Retrieve the balance of a wallet at the given point in time.
+
+        Args:
+            wallet_id (str): The ID of the wallet.
+            at (datetime): The point in time.
 
-        return {"wallet_balance": wallet_balance, "transactions": transactions}
+        Returns:
+            float: The balance of the wallet at that time.
+
+        Raises:
+            ValueError: If the wallet cannot be found.
+        """
+        wallet = await self.get_wallet(wallet_id=wallet_id)
+        if not wallet:
+            raise ValueError("Could not find wallet")
+        if EVENT_BUCKETS:
+            return await event_bucket_store.balance_at(wallet_id, at)
+        return await snapshot_store.balance_at(wallet_id, at)
@@ -0,0 +1,407 @@
+"""
+Wallet balance snapshots.
+
+Snapshots are taken as wallets are written to. The backfill snapshots the
+history of the wallets written before snapshots existed, or idle since, so
+that balance-at-time queries never replay a whole history:
+
+    python -m infrastructure.snapshots backfill
+
+The check compares the latest snapshot of every wallet, plus the events
+committed after it, with WalletBalance, and exits with status 1 on mismatch:
+
+    python -m infrastructure.snapshots check
+"""
+import argparse
+import asyncio
+import math
+import os
+import sys
+from datetime import datetime
+
+from infrastructure.codec import codec
+from infrastructure.data_access import mongo_instance
+
+SNAPSHOT_EVERY_N_EVENTS = int(os.getenv("SNAPSHOT_EVERY_N_EVENTS", "100"))
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "300"))
+
+
+def signed_amount(event: dict) -> float:
+    """
+    Return how much the given stored event changes the wallet balance.
+    """
+    match event.get("event_type"):
+        case "WalletCreated":
+            return event.get("balance", 0)
+        case "Deposited":
+            return event.get("amount", 0)
+        case "Withdrawn":
+            return -event.get("amount", 0)
+    return 0
+
+
+LATEST_SNAPSHOT_SORT = [("as_of", -1), ("version", -1)]
+HEAD_SORT = [("version", -1)]
+
+
+def head_query(wallet_id: str) -> dict:
+    """Query for the versioned events of a wallet, newest version first."""
+    return {"wallet_id": codec.encode_uuid(wallet_id), "version": {"$exists": True}}
+
+
+def latest_snapshot_query(
+    wallet_id: str, at: datetime = None, inclusive: bool = True
+) -> dict:
+    # Snapshots anchored to an event time rather than a version are ignored.
+    query = {"wallet_id": codec.encode_uuid(wallet_id), "version": {"$exists": True}}
+    if at:
+        query["as_of"] = {"$lte" if inclusive else "$lt": at}
+    return query
+
+
+def replay_query(
+    wallet_id: str,
+    snapshot: dict | None,
+    up_to_version: int = None,
+    until: datetime = None,
+    inclusive: bool = True,
+) -> dict:
+    """
+    Query for the events of a wallet not covered by the snapshot, optionally
+    only up to a version and created up to a time.
+
+    Events written before versions were introduced have none; they are older
+    than any snapshot and covered by it.
+    """
+    query = {"wallet_id": codec.encode_uuid(wallet_id)}
+    if snapshot:
+        query["version"] = {"$gt": snapshot["version"]}
+        if up_to_version is not None:
+            query["version"]["$lte"] = up_to_version
+    elif up_to_version is not None:
+        # Matches the events without a version too.
+        query["version"] = {"$not": {"$gt": up_to_version}}
+    if until:
+        query["created_at"] = {"$lte" if inclusive else "$lt": until}
+    return query
+
+
+class SnapshotStore:
+    """
+    Periodic wallet balance snapshots.
+
+    A snapshot records the balance of a wallet at a given version, so that
+    replaying a wallet only has to read the events committed after it.
+    Snapshots are taken in the background every ``every_n_events`` committed
+    events per wallet, and every ``interval`` seconds for wallets that had
+    activity since their last snapshot.
+    """
+
+    def __init__(
+        self,
+        every_n_events: int = SNAPSHOT_EVERY_N_EVENTS,
+        interval: float = SNAPSHOT_INTERVAL,
+    ):
+        self.db = mongo_instance
+        self.every_n_events = every_n_events
+        self.interval = interval
+        self.snapshot_collection = None
+        self.event_collection = None
+        self.wallet_collection = None
+        self._pending: dict[str, int] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._timer: asyncio.Task | None = None
+
+    async def _initialize_collections(self):
+        """
+        Initialize the snapshot, event and wallet collections.
+        """
+        self.snapshot_collection = await self.db.snapshot_collection
+        self.event_collection = await self.db.event_collection
+        self.wallet_collection = await self.db.wallet_collection
+
+    def record(self, wallet_id: str) -> None:
+        """
+        Count a committed event for the wallet. Only touches an in-memory
+        counter; the snapshot itself is written by a background task.
+        """
+        count = self._pending.get(wallet_id, 0) + 1
+        if count >= self.every_n_events:
+            self._pending.pop(wallet_id, None)
+            self._schedule(wallet_id)
+        else:
+            self._pending[wallet_id] = count
+
+    def _schedule(self, wallet_id: str) -> None:
+        task = asyncio.create_task(self._snapshot_quietly(wallet_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _snapshot_quietly(self, wallet_id: str) -> None:
+        try:
+            await self.take_snapshot(wallet_id)
+        except Exception as e:
+            print(f"Taking snapshot of wallet {wallet_id} failed: {e}")
+
+    async def start(self) -> None:
+        """Start snapshotting active wallets on a timer."""
+        self._timer = asyncio.create_task(self._run_timer())
+
+    async def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run_timer(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            wallet_ids, self._pending = list(self._pending), {}
+            for wallet_id in wallet_ids:
+                self._schedule(wallet_id)
+
+    async def take_snapshot(self, wallet_id: str) -> dict | None:
+        """
+        Persist the current balance of the wallet, starting from its latest
+        snapshot and replaying only the events committed after it.
+
+        A snapshot covers the events up to a version of the wallet. Versions
+        are assigned in commit order, so the events up to the newest version
+        found are all committed and the next snapshot starts right after it,
+        whatever the events' ``created_at``. ``as_of`` is the latest
+        ``created_at`` among the covered events.
+
+        Returns:
+            dict | None: The newest snapshot, or None if the wallet has no events.
+        """
+        if not self.snapshot_collection or not self.event_collection:
+            await self._initialize_collections()
+
+        head = await self.event_collection.find_one(
+            head_query(wallet_id), {"_id": 0, "version": 1}, sort=HEAD_SORT
+        )
+        snapshot = await self.latest(wallet_id)
+        version = head["version"] if head else 0
+        if snapshot and snapshot["version"] >= version:
+            return snapshot
+
+        balance = snapshot["balance"] if snapshot else 0.0
+        as_of = snapshot["as_of"] if snapshot else None
+        events = self.event_collection.find(
+            replay_query(wallet_id, snapshot, up_to_version=version),
+            {"event_type": 1, "amount": 1, "balance": 1, "created_at": 1},
+        )
+        replayed = 0
+        async for event in events:
+            event = codec.decode(event)
+            balance += signed_amount(event)
+            as_of = max(as_of, event["created_at"]) if as_of else event["created_at"]
+            replayed += 1
+        if not replayed:
+            return snapshot
+
+        snapshot = {
+            "wallet_id": wallet_id,
+            "as_of": as_of,
+            "balance": balance,
+            "version": version,
+        }
+        await self.snapshot_collection.insert_one(codec.encode(snapshot))
+        return snapshot
+
+    async def backfill(self, wallet_id: str) -> int:
+        """
+        Snapshot the history of the wallet after its latest snapshot: one
+        snapshot every ``every_n_events`` versioned events, and one at its
+        newest version.
+
+        Events without a version cannot be told apart by a snapshot, so they
+        are all covered by the first one.
+
+        Returns:
+            int: The number of snapshots taken.
+        """
+        if not self.snapshot_collection or not self.event_collection:
+            await self._initialize_collections()
+
+        head = await self.event_collection.find_one(
+            head_query(wallet_id), {"_id": 0, "version": 1}, sort=HEAD_SORT
+        )
+        snapshot = await self.latest(wallet_id)
+        version = head["version"] if head else 0
+        if snapshot and snapshot["version"] >= version:
+            return 0
+
+        balance = snapshot["balance"] if snapshot else 0.0
+        as_of = snapshot["as_of"] if snapshot else None
+        events = self.event_collection.find(
+            replay_query(wallet_id, snapshot, up_to_version=version),
+            {"event_type": 1, "amount": 1, "balance": 1, "created_at": 1, "version": 1},
+        ).sort([("version", 1), ("created_at", 1)])
+        taken = replayed = 0
+        async for event in events:
+            event = codec.decode(event)
+            balance += signed_amount(event)
+            as_of = max(as_of, event["created_at"]) if as_of else event["created_at"]
+            replayed += 1
+            at_version = event.get("version", 0)
+            if at_version and (
+                replayed >= self.every_n_events or at_version == version
+            ):
+                await self._insert(wallet_id, as_of, balance, at_version)
+                taken += 1
+                replayed = 0
+        if replayed and not version:
+            # Only events without a version.
+            await self._insert(wallet_id, as_of, balance, 0)
+            taken += 1
+        return taken
+
+    async def _insert(
+        self, wallet_id: str, as_of: datetime, balance: float, version: int
+    ) -> None:
+        await self.snapshot_collection.insert_one(
+            codec.encode(
+                {
+                    "wallet_id": wallet_id,
+                    "as_of": as_of,
+                    "balance": balance,
+                    "version": version,
+                }
+            )
+        )
+
+    async def latest(
+        self, wallet_id: str, at: datetime = None, inclusive: bool = True
+    ) -> dict | None:
+        """
+        Retrieve the newest snapshot of the wallet, optionally one covering
+        only events created at or before the given time.
+        """
+        if not self.snapshot_collection or not self.event_collection:
+            await self._initialize_collections()
+
+        snapshot = await self.snapshot_collection.find_one(
+            latest_snapshot_query(wallet_id, at, inclusive), sort=LATEST_SNAPSHOT_SORT
+        )
+        return codec.decode(snapshot) if snapshot else None
+
+    async def balance_at(
+        self, wallet_id: str, at: datetime, inclusive: bool = True
+    ) -> float:
+        """
+        Compute the balance of the wallet at the given time from the nearest
+        earlier snapshot plus the events created up to that time and committed
+        after the snapshot.
+
+        Args:
+            wallet_id (str): The ID of the wallet.
+            at (datetime): The point in time to compute the balance for.
+            inclusive (bool): Whether events recorded exactly at ``at`` count.
+
+        Returns:
+            float: The balance of the wallet at the given time.
+        """
+        snapshot = await self.latest(wallet_id, at=at, inclusive=inclusive)
+        events = self.event_collection.find(
+            replay_query(wallet_id, snapshot, until=at, inclusive=inclusive),
+            {"event_type": 1, "amount": 1, "balance": 1},
+        )
+        balance = snapshot["balance"] if snapshot else 0.0
+        async for event in events:
+            balance += signed_amount(codec.decode(event))
+        return balance
+
+    async def check(self, wallet_id: str) -> bool | None:
+        """
+        Compare the latest snapshot of the wallet, plus the events committed
+        after it, with the balance in WalletBalance at the same version.
+
+        Returns:
+            bool | None: Whether they agree, or None if there is nothing to
+                compare (no snapshot, or WalletBalance is behind it).
+        """
+        if not self.snapshot_collection or not self.event_collection:
+            await self._initialize_collections()
+
+        wallet = await self.wallet_collection.find_one(
+            {"wallet_id": codec.encode_uuid(wallet_id)},
+            {"_id": 0, "balance": 1, "version": 1},
+        )
+        snapshot = await self.latest(wallet_id)
+        if wallet is None or snapshot is None:
+            return None
+        wallet = codec.decode(wallet)
+        version = wallet.get("version", 0)
+        if snapshot["version"] > version:
+            return None
+
+        balance = snapshot["balance"]
+        events = self.event_collection.find(
+            replay_query(wallet_id, snapshot, up_to_version=version),
+            {"event_type": 1, "amount": 1, "balance": 1},
+        )
+        async for event in events:
+            balance += signed_amount(codec.decode(event))
+        return math.isclose(balance, wallet["balance"], abs_tol=1e-6)
+
+
+snapshot_store = SnapshotStore()
+
+
+async def check(wallet_ids: list = None) -> int:
+    """
+    Check the snapshots of the given wallets, or of every wallet.
+
+    Returns:
+        int: The number of wallets whose snapshot disagrees with WalletBalance.
+    """
+    if not wallet_ids:
+        wallet_collection = await mongo_instance.wallet_collection
+        wallets = wallet_collection.find({}, {"_id": 0, "wallet_id": 1})
+        wallet_ids = [codec.decode(wallet)["wallet_id"] async for wallet in wallets]
+
+    mismatches = 0
+    for wallet_id in wallet_ids:
+        if await snapshot_store.check(wallet_id) is False:
+            print(f"Snapshot of wallet {wallet_id} disagrees with WalletBalance")
+            mismatches += 1
+    print(f"{len(wallet_ids)} wallets checked, {mismatches} mismatches.")
+    return mismatches
+
+
+async def backfill(wallet_ids: list = None) -> None:
+    """Backfill the snapshots of the given wallets, or of every wallet."""
+    if not wallet_ids:
+        wallet_collection = await mongo_instance.wallet_collection
+        wallets = wallet_collection.find({}, {"_id": 0, "wallet_id": 1})
+        wallet_ids = [codec.decode(wallet)["wallet_id"] async for wallet in wallets]
+
+    taken = 0
+    for wallet_id in wallet_ids:
+        taken += await snapshot_store.backfill(wallet_id)
+    print(f"{len(wallet_ids)} wallets backfilled, {taken} snapshots taken.")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    check_parser = commands.add_parser(
+        "check", help="compare snapshots with WalletBalance"
+    )
+    check_parser.add_argument("wallet_ids", nargs="*")
+    backfill_parser = commands.add_parser(
+        "backfill", help="snapshot the history of existing wallets"
+    )
+    backfill_parser.add_argument("wallet_ids", nargs="*")
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        await backfill(args.wallet_ids)
+    elif await check(args.wallet_ids):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,173 @@
+import asyncio
+import os
+import random
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+from pymongo.errors import PyMongoError
+
+TRANSACTION_MAX_ATTEMPTS = int(os.getenv("TRANSACTION_MAX_ATTEMPTS", "5"))
+TRANSACTION_DEADLINE = float(os.getenv("TRANSACTION_DEADLINE", "5.0"))
+TRANSACTION_BACKOFF_BASE = float(os.getenv("TRANSACTION_BACKOFF_BASE", "0.01"))
+TRANSACTION_BACKOFF_MAX = float(os.getenv("TRANSACTION_BACKOFF_MAX", "0.5"))
+SERIALIZE_WALLET_WRITES = (
+    os.getenv("SERIALIZE_WALLET_WRITES", "false").lower() == "true"
+)
+
+TRANSIENT_TRANSACTION_ERROR = "TransientTransactionError"
+UNKNOWN_COMMIT_RESULT = "UnknownTransactionCommitResult"
+
+
+class KeyedLock:
+    """
+    One asyncio lock per key, dropped again once nobody holds or waits for it.
+    """
+
+    def __init__(self):
+        self._locks: dict[str, tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def acquire(self, key: str):
+        lock, users = self._locks.get(key, (asyncio.Lock(), 0))
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+
+class TransactionRunner:
+    """
+    Run MongoDB transactions with bounded retries.
+
+    Transactions failing with a ``TransientTransactionError`` label (e.g. write
+    conflicts) are retried from the start, and commits failing with an
+    ``UnknownTransactionCommitResult`` label are retried on their own. Retries
+    back off exponentially with full jitter and stop after ``max_attempts``
+    attempts or once ``deadline`` seconds have passed, whichever comes first.
+
+    Conflicts are counted in total and per wallet; the per-wallet counts only
+    cover the time since the last ``stats()`` call, which clears them, so they
+    stay bounded by the wallets conflicting between two scrapes.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = TRANSACTION_MAX_ATTEMPTS,
+        deadline: float = TRANSACTION_DEADLINE,
+        backoff_base: float = TRANSACTION_BACKOFF_BASE,
+        backoff_max: float = TRANSACTION_BACKOFF_MAX,
+        serialize_wallet_writes: bool = SERIALIZE_WALLET_WRITES,
+    ):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.serialize_wallet_writes = serialize_wallet_writes
+        self.conflicts = 0
+        self.retries = 0
+        self._wallet_conflicts: Counter[str] = Counter()
+        self._wallet_locks = KeyedLock()
+
+    def record_conflict(self, wallet_id: str) -> None:
+        self.conflicts += 1
+        self._wallet_conflicts[wallet_id] += 1
+
+    def stats(self) -> dict:
+        most_conflicted = dict(self._wallet_conflicts.most_common(10))
+        self._wallet_conflicts.clear()
+        return {
+            "retries": self.retries,
+            "conflicts": self.conflicts,
+            "most_conflicted_wallets": most_conflicted,
+        }
+
+    async def run(
+        self,
+        client,
+        transaction_func: Callable[..., Awaitable],
+        wallet_id: str = None,
+    ) -> None:
+        """
+        Execute the transaction logic in a transaction, retrying transient failures.
+
+        Args:
+            client: The Motor client to start the session on.
+            transaction_func: The transaction logic, called with the session.
+            wallet_id (str, optional): The wallet the transaction writes to, used
+                to count conflicts and, if enabled, to serialize writes per wallet.
+
+        Raises:
+            PyMongoError: If the transaction still fails after the last attempt.
+        """
+        if self.serialize_wallet_writes and wallet_id:
+            async with self._wallet_locks.acquire(wallet_id):
+                await self._run(client, transaction_func, wallet_id)
+        else:
+            await self._run(client, transaction_func, wallet_id)
+
+    async def _run(self, client, transaction_func, wallet_id: str | None) -> None:
+        give_up_at = time.monotonic() + self.deadline
+        attempt = 0
+
+        async with await client.start_session() as session:
+            while True:
+                attempt += 1
+                session.start_transaction()
+                try:
+                    await transaction_func(session)
+                except Exception as e:
+                    if session.in_transaction:
+                        await session.abort_transaction()
+                    if self._should_retry(
+                        e, TRANSIENT_TRANSACTION_ERROR, attempt, give_up_at
+                    ):
+                        await self._backoff(attempt, wallet_id)
+                        continue
+                    raise
+
+                while True:
+                    try:
+                        await session.commit_transaction()
+                        return
+                    except PyMongoError as e:
+                        if self._should_retry(
+                            e, UNKNOWN_COMMIT_RESULT, attempt, give_up_at
+                        ):
+                            attempt += 1
+                            await self._backoff(attempt, wallet_id)
+                            continue
+                        if self._should_retry(
+                            e, TRANSIENT_TRANSACTION_ERROR, attempt, give_up_at
+                        ):
+                            await self._backoff(attempt, wallet_id)
+                            break
+                        raise
+
+    def _should_retry(
+        self, error: Exception, label: str, attempt: int, give_up_at: float
+    ) -> bool:
+        return (
+            isinstance(error, PyMongoError)
+            and error.has_error_label(label)
+            and attempt < self.max_attempts
+            and time.monotonic() < give_up_at
+        )
+
+    async def _backoff(self, attempt: int, wallet_id: str | None) -> None:
+        self.retries += 1
+        if wallet_id:
+            self.record_conflict(wallet_id)
+
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        await asyncio.sleep(random.uniform(0, delay))
+
+
+transaction_runner = TransactionRunner()
@@ -1,20 +1,194 @@
+"""
+Load profiles for the wallet API.
+
+Every run first seeds LOAD_WALLETS wallets (creating them, or looking them up
+when they already exist) and deposits LOAD_OPENING_BALANCE into each, so that
+withdrawals and transfers are applied rather than rejected, then runs the task
+mix picked by LOAD_MIX:
+
+- read_heavy:  mostly balance, wallet and transaction reads
+- write_heavy: mostly deposits and withdrawals
+- hot_key:     write-heavy, with wallets picked from a Zipf(LOAD_ZIPF_S) distribution
+- transfer:    withdraw from one wallet and deposit the amount into another
+
+LOAD_SHAPE=step or LOAD_SHAPE=ramp replaces the --users/--spawn-rate settings
+with a stepped or linear load shape. When the run ends, p50/p95/p99 latencies
+per endpoint are written as JSON to LOAD_REPORT, to be diffed between releases.
+Commands answered with success false (insufficient funds) count as failures.
+
+    locust -f locustfile.py --host http://localhost:8000 --headless -t 5m
+"""
+import itertools
 import json
+import os
+import random
+import uuid
 
-from locust import HttpUser, task, between
+import requests
+from locust import HttpUser, LoadTestShape, between, events, task
 
+LOAD_WALLETS = int(os.getenv("LOAD_WALLETS", "1000"))
+LOAD_MIX = os.getenv("LOAD_MIX", "read_heavy")
+LOAD_ZIPF_S = float(os.getenv("LOAD_ZIPF_S", "1.2"))
+LOAD_SHAPE = os.getenv("LOAD_SHAPE", "")
+LOAD_REPORT = os.getenv("LOAD_REPORT", "load_report.json")
+LOAD_FIRST_USER_ID = int(os.getenv("LOAD_FIRST_USER_ID", "1000000"))
+LOAD_OPENING_BALANCE = int(os.getenv("LOAD_OPENING_BALANCE", "1000000"))
 
-class HelloWorldUser(HttpUser):
-    wait_time = between(1, 6)  # Time between consecutive tasks
+# Task weights per mix.
+MIXES = {
+    "read_heavy": {
+        "balance": 6,
+        "get_wallet": 2,
+        "transactions": 2,
+        "deposit": 1,
+        "withdraw": 1,
+    },
+    "write_heavy": {"balance": 1, "deposit": 6, "withdraw": 3},
+    "hot_key": {"balance": 1, "deposit": 6, "withdraw": 3},
+    "transfer": {"balance": 1, "transfer": 4},
+}
+
+wallet_ids: list[str] = []
+zipf_weights: list[float] = []
+
+
+@events.test_start.add_listener
+def seed_wallets(environment, **kwargs):
+    """Create (or look up) and fund the wallets the tasks operate on."""
+    if wallet_ids:
+        return
+
+    with requests.Session() as session:
+        for user_id in range(LOAD_FIRST_USER_ID, LOAD_FIRST_USER_ID + LOAD_WALLETS):
+            response = session.post(f"{environment.host}/create-wallet/{user_id}")
+            if response.status_code == 201:
+                wallet_id = response.json()["data"]["wallet_id"]
+            else:
+                response = session.get(f"{environment.host}/get-wallet/{user_id}")
+                response.raise_for_status()
+                wallet_id = response.json()["wallet_id"]
+
+            response = session.post(
+                f"{environment.host}/deposit/",
+                json={"wallet_id": wallet_id, "amount": LOAD_OPENING_BALANCE},
+            )
+            response.raise_for_status()
+            if not response.json().get("success"):
+                raise RuntimeError(
+                    f"Could not fund wallet {wallet_id}: {response.text}"
+                )
+            wallet_ids.append(wallet_id)
+
+    zipf_weights.extend(
+        itertools.accumulate(
+            1 / rank**LOAD_ZIPF_S for rank in range(1, len(wallet_ids) + 1)
+        )
+    )
+
+
+@events.quitting.add_listener
+def write_report(environment, **kwargs):
+    """Write latency percentiles per endpoint as JSON."""
+    report = {"mix": LOAD_MIX, "shape": LOAD_SHAPE or "fixed", "endpoints": {}}
+    for (name, method), entry in environment.stats.entries.items():
+        report["endpoints"][f"{method} {name}"] = {
+            "requests": entry.num_requests,
+            "failures": entry.num_failures,
+            "rps": entry.total_rps,
+            "p50_ms": entry.get_response_time_percentile(0.5),
+            "p95_ms": entry.get_response_time_percentile(0.95),
+            "p99_ms": entry.get_response_time_percentile(0.99),
+        }
+
+    with open(LOAD_REPORT, "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+class WalletUser(HttpUser):
+    wait_time = between(0.1, 1)
+
+    def pick_wallet(self) -> str:
+        if LOAD_MIX == "hot_key":
+            return random.choices(wallet_ids, cum_weights=zipf_weights)[0]
+        return random.choice(wallet_ids)
+
+    def post_command(self, path: str, wallet_id: str, amount: float) -> bool:
+        with self.client.post(
+            path,
+            json={"wallet_id": wallet_id, "amount": amount},
+            headers={"Idempotency-Key": str(uuid.uuid4())},
+            catch_response=True,
+        ) as response:
+            # Rejected commands are answered with 200 and success false.
+            success = response.status_code == 200 and response.json().get("success")
+            if success:
+                response.success()
+            else:
+                response.failure(f"{response.status_code}: {response.text}")
+            return bool(success)
+
+    def balance(self):
+        self.client.get(f"/balance/{self.pick_wallet()}/", name="/balance/[wallet_id]/")
+
+    def get_wallet(self):
+        user_id = LOAD_FIRST_USER_ID + random.randrange(len(wallet_ids))
+        self.client.get(f"/get-wallet/{user_id}", name="/get-wallet/[user_id]")
+
+    def transactions(self):
+        self.client.get(
+            f"/transactions/{self.pick_wallet()}/?limit=50",
+            name="/transactions/[wallet_id]/",
+        )
 
-    @task
     def deposit(self):
-        for i in range(400_000, 600_000):
-            data = {
-                "wallet_id": "f0b70509-0d5d-4240-9466-4ed99106d513",
-                "amount": i
-                }
+        self.post_command("/deposit/", self.pick_wallet(), random.randint(1, 1000))
+
+    def withdraw(self):
+        self.post_command("/withdraw/", self.pick_wallet(), random.randint(1, 500))
+
+    def transfer(self):
+        source, target = random.sample(wallet_ids, 2)
+        amount = random.randint(1, 500)
+        if self.post_command("/withdraw/", source, amount):
+            self.post_command("/deposit/", target, amount)
+
+    @task
+    def run_mix(self):
+        weights = MIXES[LOAD_MIX]
+        name = random.choices(list(weights), weights=list(weights.values()))[0]
+        getattr(self, name)()
+
+
+if LOAD_SHAPE == "step":
+
+    class StepLoadShape(LoadTestShape):
+        """Add STEP_USERS users every STEP_SECONDS, up to STEP_COUNT steps."""
+
+        step_users = int(os.getenv("STEP_USERS", "50"))
+        step_seconds = int(os.getenv("STEP_SECONDS", "60"))
+        step_count = int(os.getenv("STEP_COUNT", "10"))
+
+        def tick(self):
+            run_time = self.get_run_time()
+            step = int(run_time // self.step_seconds) + 1
+            if step > self.step_count:
+                return None
+            return step * self.step_users, self.step_users
+
+elif LOAD_SHAPE == "ramp":
+
+    class RampLoadShape(LoadTestShape):
+        """Ramp linearly to RAMP_USERS over RAMP_SECONDS, then hold for HOLD_SECONDS."""
 
-            response = self.client.post(f"/deposit/", json=data)
-            if response.status_code != 201:
-                print(f"Failed to create wallet: {response.text}")
+        ramp_users = int(os.getenv("RAMP_USERS", "500"))
+        ramp_seconds = int(os.getenv("RAMP_SECONDS", "300"))
+        hold_seconds = int(os.getenv("HOLD_SECONDS", "120"))
 
+        def tick(self):
+            run_time = self.get_run_time()
+            if run_time > self.ramp_seconds + self.hold_seconds:
+                return None
+            users = self.ramp_users * min(1.0, run_time / self.ramp_seconds)
+            spawn_rate = max(1.0, self.ramp_users / self.ramp_seconds)
+            return max(1, int(users)), spawn_rate
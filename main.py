@@ -1,35 +1,84 @@
-import json
-from typing import List
+import hmac
+import orjson
+from typing import AsyncIterator, Literal
 from datetime import datetime
-from fastapi import FastAPI, status, HTTPException
+from fastapi import APIRouter, Depends, FastAPI, Header, Query, status, HTTPException
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from domain.events import WalletCreated, Deposited, Withdrawn
+from domain.exceptions import (
+    ConcurrentAppendError,
+    DuplicateCommandError,
+    IdempotencyKeyReusedError,
+    ProjectionLagError,
+    WalletNotFoundError,
+)
 from domain.models import Wallet
+from infrastructure.cache import wallet_cache
 from infrastructure.data_access import mongo_instance
-from infrastructure.queue.publisher import publish_logs
+from infrastructure.group_commit import deposit_group_committer
+from infrastructure.metrics import MetricsMiddleware, registry, stage
+from infrastructure.outbox import record_rejection
+from infrastructure.profiling import (
+    PROFILE_ADMIN_TOKEN,
+    PROFILING_ENABLED,
+    ProfilingMiddleware,
+    profiler,
+)
+from infrastructure.snapshots import snapshot_store
+from infrastructure.transactions import transaction_runner
 from presentation.schemas import (
+    BatchIn,
     GetWalletOutSchema,
     DepositIn,
     WithdrawIn,
 )
-from services.commands import CreateWalletCommand, DepositCommand, WithdrawCommand
+from services.commands import (
+    BatchCommand,
+    CreateWalletCommand,
+    DepositCommand,
+    WithdrawCommand,
+)
 from services.queries import (
     WalletQueryService,
     WalletBalanceQueryService,
+    WalletBalanceAtQueryService,
     WalletTransactionQueryService,
+    WalletTransactionStreamQueryService,
     WalletReplyEventsQueryService,
 )
+from presentation.responses import base_response
 from presentation.schemas import BaseResponse
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(MetricsMiddleware)
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+
+registry.register_stats("mongo_pool", mongo_instance.pool_monitor.stats)
+registry.register_stats("wallet_cache", wallet_cache.stats)
+registry.register_stats("transactions", transaction_runner.stats)
+registry.register_stats("group_commit", deposit_group_committer.stats)
 
 
 @app.on_event("startup")
 async def startup():
-    await mongo_instance.client.start_session()
+    await mongo_instance.warm_up()
+    await mongo_instance.ensure_indexes()
+    await snapshot_store.start()
 
 
-@app.post("/create-wallet/{user_id}", status_code=status.HTTP_201_CREATED)
-async def create_wallet(user_id: int) -> BaseResponse:
+@app.on_event("shutdown")
+async def shutdown():
+    await snapshot_store.stop()
+
+
+@app.post(
+    "/create-wallet/{user_id}",
+    response_model=BaseResponse,
+    status_code=status.HTTP_201_CREATED,
+)
+async def create_wallet(user_id: int) -> ORJSONResponse:
     """
     Create a new wallet for the given user ID.
 
@@ -40,41 +89,34 @@ async def create_wallet(user_id: int) -> BaseResponse:
         dict: Response containing the details of the created wallet.
     """
 
-    existing_wallet = await WalletQueryService().execute(user_id=user_id)
-
-    if existing_wallet:
-        data = {
-            "index": "wallet_logs",
-            "document": {
-                "message": "Wallet created failed",
-                "success": False,
-                "user_id": user_id,
-                "timestamp": datetime.now().timestamp(),
-            }
-        }
-        await publish_logs(data=data)
-        raise HTTPException(status_code=400, detail="Wallet already exists")
+    with stage("existence_check", "WalletCreated"):
+        existing_wallet = await WalletQueryService().execute(user_id=user_id)
 
     wallet = Wallet(user_id=user_id)
     event = WalletCreated(user_id=user_id, wallet_id=wallet.wallet_id)
-    await CreateWalletCommand().execute(event)
-
-    data = {
-        "index": "wallet_logs",
-        "document": {
-            "message": "Wallet created successfully",
-            "success": True,
-            "user_id": user_id,
-            "timestamp": datetime.now().timestamp(),
-        }
-    }
-    await publish_logs(data=data)
+    created = False
+    if not existing_wallet:
+        try:
+            with stage("command", event.event_type):
+                await CreateWalletCommand().execute(event)
+            created = True
+        except DuplicateKeyError:
+            # A concurrent request created the wallet after our existence
+            # check; the unique user_id index rejected this one.
+            pass
+
+    if not created:
+        await record_rejection(
+            "WalletCreated", "Wallet created failed", user_id=user_id
+        )
+        raise HTTPException(status_code=400, detail="Wallet already exists")
 
-    return BaseResponse(
-        data=event.model_dump(),
+    return base_response(
+        data=event.to_document(),
         message="Wallet created successfully",
         status=status.HTTP_201_CREATED,
         success=True,
+        status_code=status.HTTP_201_CREATED,
     )
 
 
@@ -83,132 +125,157 @@ async def create_wallet(user_id: int) -> BaseResponse:
     response_model=GetWalletOutSchema,
     status_code=status.HTTP_200_OK,
 )
-async def get_wallet(user_id: int) -> dict:
+async def get_wallet(
+    user_id: int, fresh: bool = False, min_version: int | None = None
+) -> ORJSONResponse:
     """
     Retrieve the details of the wallet associated with the given user ID.
 
     Args:
         user_id (int): The ID of the user.
+        fresh (bool): Read from the database instead of the wallet cache.
+        min_version (int, optional): Wait until the wallet reflects the command
+            that returned this version (asynchronous projection only).
 
     Returns:
         dict: Details of the wallet.
     """
 
-    existing_wallet = await WalletQueryService().execute(user_id=user_id)
+    try:
+        existing_wallet = await WalletQueryService().execute(
+            user_id=user_id, fresh=fresh, min_version=min_version
+        )
+    except ProjectionLagError:
+        raise HTTPException(
+            status_code=503, detail="Wallet is not up to date yet, try again."
+        )
 
     if not existing_wallet:
         raise HTTPException(status_code=404, detail="Wallet does not exist.")
 
-    return existing_wallet
+    return ORJSONResponse(existing_wallet)
 
 
-@app.post("/deposit/")
-async def deposit(deposit: DepositIn) -> BaseResponse:
+@app.post("/deposit/", response_model=BaseResponse)
+async def deposit(
+    deposit: DepositIn, idempotency_key: str | None = Header(default=None)
+) -> ORJSONResponse:
     """
     Deposit funds into a wallet.
 
     Args:
         deposit (DepositIn): Input data containing wallet ID and amount to be deposited.
+        idempotency_key (str, optional): Idempotency-Key header; a retried request
+            with the same key returns the original deposit instead of depositing again.
 
     Returns:
         dict: Response containing details of the deposit transaction.
     """
 
     wallet_id = deposit.wallet_id
-    existing_wallet = await WalletQueryService().execute(wallet_id=wallet_id)
-
-    if not existing_wallet:
-        data = {
-            "index": "wallet_transactions",
-            "document": {
-                "message": "Deposit failed. Wallet does not exist.",
-                "success": False,
-                "wallet_id": wallet_id,
-                "amount": deposit.amount,
-                "timestamp": datetime.now().timestamp(),
-            }
-        }
+    event = Deposited(wallet_id=wallet_id, amount=deposit.amount)
 
-        await publish_logs(data=data)
+    try:
+        with stage("command", event.event_type):
+            applied = await DepositCommand().execute(
+                event=event, idempotency_key=idempotency_key
+            )
+    except WalletNotFoundError:
+        await record_rejection(
+            "Deposited",
+            "Deposit failed. Wallet does not exist.",
+            wallet_id=wallet_id,
+            amount=deposit.amount,
+        )
         raise HTTPException(status_code=404, detail="Wallet does not exist.")
+    except IdempotencyKeyReusedError:
+        raise HTTPException(
+            status_code=422,
+            detail="Idempotency key was already used for a different deposit.",
+        )
+    except DuplicateCommandError:
+        # The key was used, but its record expired before it could be replayed.
+        raise HTTPException(
+            status_code=409,
+            detail="Idempotency key was already used and its result has expired.",
+        )
+    except ConcurrentAppendError:
+        raise HTTPException(status_code=409, detail="Wallet is busy, try again.")
 
-    event = Deposited(wallet_id=wallet_id, amount=deposit.amount)
-    await DepositCommand().execute(event=event)
-    data = {
-        "index": "wallet_transactions",
-        "document": {
-            "message": "Deposit successful",
-            "success": True,
-            "wallet_id": wallet_id,
-            "amount": deposit.amount,
-            "timestamp": datetime.now().timestamp(),
-        }
-    }
-
-    await publish_logs(data=data)
-    return BaseResponse(
-        data=event.model_dump(),
+    return base_response(
+        data=applied,
         message="Deposit successful",
         status=status.HTTP_200_OK,
         success=True,
     )
 
 
-@app.post("/withdraw/")
-async def withdraw(withdraw: WithdrawIn) -> BaseResponse:
+@app.post("/withdraw/", response_model=BaseResponse)
+async def withdraw(
+    withdraw: WithdrawIn, idempotency_key: str | None = Header(default=None)
+) -> ORJSONResponse:
     """
     Withdraw funds from a wallet.
 
     Args:
         withdraw (WithdrawIn): Input data containing wallet ID and amount to be withdrawn.
+        idempotency_key (str, optional): Idempotency-Key header; a retried request
+            with the same key returns the original withdrawal instead of withdrawing again.
 
     Returns:
         dict: Response containing details of the withdrawal transaction.
     """
 
     wallet_id = withdraw.wallet_id
-    existing_wallet = await WalletQueryService().execute(wallet_id=wallet_id)
-
-    if not existing_wallet:
-        raise HTTPException(status_code=404, detail="Wallet does not exist.")
 
     try:
         event = Withdrawn(wallet_id=wallet_id, amount=withdraw.amount)
-        await WithdrawCommand().execute(event=event)
-
-        data = {
-            "index": "wallet_transactions",
-            "document": {
-                "message": "Withdrawal successful",
-                "success": True,
-                "wallet_id": wallet_id,
-                "amount": withdraw.amount,
-                "timestamp": datetime.now().timestamp(),
-            }
-        }
+        with stage("command", event.event_type):
+            applied = await WithdrawCommand().execute(
+                event=event, idempotency_key=idempotency_key
+            )
 
-        await publish_logs(data=data)
-        return BaseResponse(
-            data=event.model_dump(),
+        return base_response(
+            data=applied,
             message="Withdrawal successful",
             status=status.HTTP_200_OK,
             success=True,
         )
+    except WalletNotFoundError:
+        raise HTTPException(status_code=404, detail="Wallet does not exist.")
+    except IdempotencyKeyReusedError:
+        raise HTTPException(
+            status_code=422,
+            detail="Idempotency key was already used for a different withdrawal.",
+        )
+    except DuplicateCommandError:
+        # The key was used, but its record expired before it could be replayed.
+        raise HTTPException(
+            status_code=409,
+            detail="Idempotency key was already used and its result has expired.",
+        )
+    except ConcurrentAppendError:
+        raise HTTPException(status_code=409, detail="Wallet is busy, try again.")
+    except PyMongoError:
+        # Transient errors were already retried by the transaction runner.
+        await record_rejection(
+            "Withdrawn",
+            "Withdrawal failed. Database unavailable.",
+            wallet_id=wallet_id,
+            amount=withdraw.amount,
+        )
+        raise HTTPException(
+            status_code=503, detail="Withdrawal could not be processed, try again."
+        )
     except Exception as e:
-        data = {
-            "index": "wallet_transactions",
-            "document": {
-                "message": "Withdrawal failed",
-                "success": False,
-                "wallet_id": wallet_id,
-                "amount": withdraw.amount,
-                "timestamp": datetime.now().timestamp(),
-            }
-        }
-
-        await publish_logs(data=data)
+        await record_rejection(
+            "Withdrawn",
+            "Withdrawal failed",
+            wallet_id=wallet_id,
+            amount=withdraw.amount,
+        )
 
-        return BaseResponse(
+        return base_response(
             data=e.args,
             message="Withdrawal failed",
             status=status.HTTP_400_BAD_REQUEST,
@@ -216,27 +283,126 @@ async def withdraw(withdraw: WithdrawIn) -> BaseResponse:
         )
 
 
-@app.get("/balance/{wallet_id}/")
-async def wallet_balance(wallet_id: str) -> BaseResponse:
+@app.post("/batch/", response_model=BaseResponse)
+async def batch(batch: BatchIn) -> ORJSONResponse:
+    """
+    Apply a batch of create, deposit and withdraw operations in order.
+
+    Args:
+        batch (BatchIn): The operations to apply.
+
+    Returns:
+        dict: Response containing the result of every operation.
+    """
+
+    events = []
+    results = [None] * len(batch.operations)
+    for index, operation in enumerate(batch.operations):
+        try:
+            match operation.operation:
+                case "create":
+                    wallet = Wallet(user_id=operation.user_id)
+                    event = WalletCreated(
+                        user_id=operation.user_id, wallet_id=wallet.wallet_id
+                    )
+                case "deposit":
+                    event = Deposited(
+                        wallet_id=operation.wallet_id, amount=operation.amount
+                    )
+                case "withdraw":
+                    event = Withdrawn(
+                        wallet_id=operation.wallet_id, amount=operation.amount
+                    )
+            events.append((index, event))
+        except ValueError as e:
+            results[index] = {"success": False, "message": str(e), "data": None}
+
+    with stage("command", "Batch"):
+        errors = await BatchCommand().execute([event for _, event in events])
+
+    for (index, event), error in zip(events, errors):
+        results[index] = {
+            "success": error is None,
+            "message": "" if error is None else str(error),
+            "data": event.to_document() if error is None else None,
+        }
+
+    return base_response(
+        data=results,
+        message="Batch processed",
+        status=status.HTTP_200_OK,
+        success=all(result["success"] for result in results),
+    )
+
+
+@app.get("/balance/{wallet_id}/", response_model=BaseResponse)
+async def wallet_balance(
+    wallet_id: str, fresh: bool = False, min_version: int | None = None
+) -> ORJSONResponse:
     """
     Retrieve the balance of a wallet.
 
     Args:
         wallet_id (str): The ID of the wallet.
+        fresh (bool): Read from the database instead of the wallet cache.
+        min_version (int, optional): Wait until the balance reflects the command
+            that returned this version (asynchronous projection only).
 
     Returns:
         dict: Response containing the balance of the wallet.
     """
     try:
-        balance = await WalletBalanceQueryService().execute(wallet_id=wallet_id)
-        return BaseResponse(
+        balance = await WalletBalanceQueryService().execute(
+            wallet_id=wallet_id, fresh=fresh, min_version=min_version
+        )
+        return base_response(
             data={"balance": balance},
             message="",
             status=status.HTTP_200_OK,
             success=True,
         )
+    except ProjectionLagError:
+        raise HTTPException(
+            status_code=503, detail="Balance is not up to date yet, try again."
+        )
     except Exception as e:
-        return BaseResponse(
+        return base_response(
+            data=e.args,
+            message="Failed to retrieve balance.",
+            status=status.HTTP_400_BAD_REQUEST,
+            success=False,
+        )
+
+
+@app.get("/balance/{wallet_id}/at/", response_model=BaseResponse)
+async def wallet_balance_at(wallet_id: str, at: str) -> ORJSONResponse:
+    """
+    Retrieve the balance of a wallet at a point in time.
+
+    Args:
+        wallet_id (str): The ID of the wallet.
+        at (str): The point in time (ISO 8601, e.g. 2024-02-01T12:00:00).
+
+    Returns:
+        dict: Response containing the balance of the wallet at that time.
+    """
+    try:
+        at_dt = datetime.fromisoformat(at)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format.")
+
+    try:
+        balance = await WalletBalanceAtQueryService().execute(
+            wallet_id=wallet_id, at=at_dt
+        )
+        return base_response(
+            data={"balance": balance, "at": at_dt},
+            message="",
+            status=status.HTTP_200_OK,
+            success=True,
+        )
+    except Exception as e:
+        return base_response(
             data=e.args,
             message="Failed to retrieve balance.",
             status=status.HTTP_400_BAD_REQUEST,
@@ -245,30 +411,60 @@ async def wallet_balance(wallet_id: str) -> BaseResponse:
 
 
 @app.get("/transactions/{wallet_id}/")
-async def wallet_transactions(wallet_id: str) -> List[dict] | dict:
+async def wallet_transactions(
+    wallet_id: str,
+    limit: int = Query(default=100, ge=1, le=1000),
+    cursor: str = None,
+    stream: bool = False,
+):
     """
-    Retrieve the transactions of a wallet.
+    Retrieve the transactions of a wallet, one page at a time.
 
     Args:
         wallet_id (str): The ID of the wallet.
+        limit (int): Maximum number of transactions in the page.
+        cursor (str, optional): The next_cursor returned with the previous page.
+        stream (bool): Stream every transaction as NDJSON instead of returning a page.
 
     Returns:
-        Union[List[dict], dict]: List of transactions or error response.
+        dict: The page of transactions and the cursor of the next page, or an error response.
     """
 
+    if stream:
+        return StreamingResponse(
+            _ndjson(WalletTransactionStreamQueryService().execute(wallet_id)),
+            media_type="application/x-ndjson",
+        )
+
     try:
-        transactions: list = await WalletTransactionQueryService().execute(wallet_id)
-        return transactions
+        transactions: dict = await WalletTransactionQueryService().execute(
+            wallet_id, limit=limit, cursor=cursor
+        )
+        return ORJSONResponse(transactions)
     except Exception as e:
-        return {
-            "data": e.args,
-            "message": "Failed to retrieve transactions.",
-            "status": status.HTTP_400_BAD_REQUEST,
-        }
+        return ORJSONResponse(
+            {
+                "data": e.args,
+                "message": "Failed to retrieve transactions.",
+                "status": status.HTTP_400_BAD_REQUEST,
+            }
+        )
+
+
+async def _ndjson(documents: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    async for document in documents:
+        yield orjson.dumps(document) + b"\n"
 
 
 @app.get("/events/{wallet_id}/")
-async def reply_events(wallet_id: str, from_date: str, to_date: str) -> dict:
+async def reply_events(
+    wallet_id: str,
+    from_date: str,
+    to_date: str,
+    include_transactions: bool = False,
+    limit: int = Query(default=1000, ge=1, le=10_000),
+    include_balances: bool = False,
+) -> ORJSONResponse:
     """
     Retrieve events for a wallet within the specified date range.
 
@@ -276,6 +472,9 @@ async def reply_events(wallet_id: str, from_date: str, to_date: str) -> dict:
         wallet_id (str): The ID of the wallet.
         from_date (str): Start date of the date range (format: YYYY-MM-DD).
         to_date (str): End date of the date range (format: YYYY-MM-DD).
+        include_transactions (bool): Whether to return the transactions or only the totals.
+        limit (int): Maximum number of transactions to return.
+        include_balances (bool): Whether to return the opening and closing balance.
 
     Returns:
         dict: Response containing the events within the specified date range.
@@ -286,12 +485,74 @@ async def reply_events(wallet_id: str, from_date: str, to_date: str) -> dict:
         to_date_dt = datetime.strptime(to_date, "%Y-%m-%d")
 
         wallet_events: dict = await WalletReplyEventsQueryService().execute(
-            wallet_id, from_date_dt, to_date_dt
+            wallet_id,
+            from_date_dt,
+            to_date_dt,
+            include_transactions,
+            limit,
+            include_balances,
         )
 
-        return wallet_events
+        return ORJSONResponse(wallet_events)
 
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Invalid date format.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    """
+    Expose request and stage latency histograms and component stats in the
+    Prometheus text format.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+async def require_admin(x_admin_token: str | None = Header(default=None)) -> None:
+    """
+    Refuse requests without the admin token, and every request if none is set.
+    """
+    if not PROFILE_ADMIN_TOKEN or not hmac.compare_digest(
+        (x_admin_token or "").encode(), PROFILE_ADMIN_TOKEN.encode()
+    ):
+        raise HTTPException(status_code=403, detail="Admin token required.")
+
+
+admin = APIRouter(
+    prefix="/admin", dependencies=[Depends(require_admin)], include_in_schema=False
+)
+
+
+@admin.get("/profiles")
+async def profiles() -> ORJSONResponse:
+    """
+    List the slowest profiled requests, slowest first.
+    """
+    return ORJSONResponse([profile.summary() for profile in profiler.profiles()])
+
+
+@admin.get("/profiles/{profile_id}")
+async def profile_stacks(
+    profile_id: int, kind: Literal["all", "cpu", "await"] = "all"
+) -> PlainTextResponse:
+    """
+    Return the stack samples of a profiled request as folded stacks, to be
+    rendered with flamegraph.pl or speedscope.
+
+    Args:
+        profile_id (int): The id listed by /admin/profiles.
+        kind (str): ``cpu`` for on-CPU samples, ``await`` for the stacks the
+            request was suspended on, or ``all``.
+    """
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found.")
+
+    return PlainTextResponse(profile.folded(kind))
+
+
+# The profiles are only collected, and exposed, when profiling is enabled.
+if PROFILING_ENABLED:
+    app.include_router(admin)
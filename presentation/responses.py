@@ -0,0 +1,27 @@
+from typing import Any
+from fastapi import status as http_status
+from fastapi.responses import ORJSONResponse
+
+
+def base_response(
+    data: Any,
+    message: str = "",
+    status: int = http_status.HTTP_200_OK,
+    success: bool = False,
+    status_code: int = http_status.HTTP_200_OK,
+) -> ORJSONResponse:
+    """
+    Build a response shaped like BaseResponse and encode it with orjson.
+
+    The data is already validated (events, query results), so FastAPI's
+    response model validation and jsonable_encoder pass are skipped.
+    """
+    return ORJSONResponse(
+        content={
+            "data": data,
+            "message": message,
+            "status": status,
+            "success": success,
+        },
+        status_code=status_code,
+    )
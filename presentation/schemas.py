@@ -1,6 +1,11 @@
 import datetime
-from pydantic import BaseModel, field_validator
-from typing import Any
+import os
+from pydantic import BaseModel, Field, field_validator
+from typing import Annotated, Any, List, Literal, Union
+
+from infrastructure.codec import codec
+
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "1000"))
 
 
 class CreateWalletInSchema(BaseModel):
@@ -11,6 +16,7 @@ class GetWalletOutSchema(BaseModel):
     user_id: int
     wallet_id: str
     balance: float
+    version: int = 0
 
 
 class DepositIn(BaseModel):
@@ -24,6 +30,12 @@ class DepositIn(BaseModel):
 
         return value
 
+    @field_validator("amount")
+    def amount_must_be_storable(cls, value):
+        # Amounts the storage codec cannot store exactly are rejected.
+        codec.encode_money(value)
+        return value
+
 
 class WithdrawIn(BaseModel):
     wallet_id: str
@@ -36,6 +48,12 @@ class WithdrawIn(BaseModel):
 
         return value
 
+    @field_validator("amount")
+    def amount_must_be_storable(cls, value):
+        # Amounts the storage codec cannot store exactly are rejected.
+        codec.encode_money(value)
+        return value
+
 
 class BalanceOut(BaseModel):
     balance: float
@@ -53,3 +71,24 @@ class BaseResponse(BaseModel):
     message: str = ""
     status: int
     success: bool = False
+
+
+class BatchCreateWalletIn(CreateWalletInSchema):
+    operation: Literal["create"]
+
+
+class BatchDepositIn(DepositIn):
+    operation: Literal["deposit"]
+
+
+class BatchWithdrawIn(WithdrawIn):
+    operation: Literal["withdraw"]
+
+
+class BatchIn(BaseModel):
+    operations: List[
+        Annotated[
+            Union[BatchCreateWalletIn, BatchDepositIn, BatchWithdrawIn],
+            Field(discriminator="operation"),
+        ]
+    ] = Field(max_length=BATCH_MAX_OPERATIONS)
@@ -1,4 +1,9 @@
-from domain.events import WalletCreated, Deposited, Withdrawn
+from abc import ABC, abstractmethod
+from typing import List
+from domain.events import Event, WalletCreated, Deposited, Withdrawn
+from domain.exceptions import DuplicateCommandError
+from infrastructure.group_commit import deposit_group_committer
+from infrastructure.idempotency import idempotency_store, request_fingerprint
 from infrastructure.repository import WalletCommandRepository
 
 
@@ -7,16 +12,73 @@ class BaseWalletCommand:
         self.repository = WalletCommandRepository()
 
 
+class IdempotentWalletCommand(BaseWalletCommand, ABC):
+    """
+    Command that can be given a client idempotency key.
+
+    ``execute`` returns the event the command applied. When the key was already
+    used for a committed command, that command's event is returned instead and
+    nothing is applied again; if that command had a different wallet or amount,
+    IdempotencyKeyReusedError is raised.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.idempotency = idempotency_store
+
+    async def execute(self, event: Event, idempotency_key: str = None) -> dict:
+        if not idempotency_key:
+            await self.apply(event)
+            return event.to_document()
+
+        fingerprint = request_fingerprint(event.to_document())
+        recorded = await self.idempotency.get_cached(
+            event.event_type, idempotency_key, fingerprint
+        )
+        if recorded is not None:
+            return recorded
+
+        try:
+            await self.apply(event, idempotency_key=idempotency_key)
+        except DuplicateCommandError:
+            recorded = await self.idempotency.fetch(
+                event.event_type, idempotency_key, fingerprint
+            )
+            if recorded is None:
+                # The key expired in between; nothing left to replay, and
+                # the caller reports the command as a conflict.
+                raise
+            return recorded
+
+        applied = event.to_document()
+        await self.idempotency.remember(
+            event.event_type, idempotency_key, applied, fingerprint
+        )
+        return applied
+
+    @abstractmethod
+    async def apply(self, event: Event, idempotency_key: str = None) -> None:
+        """Apply the event, recording the idempotency key with it if given."""
+
+
 class CreateWalletCommand(BaseWalletCommand):
     async def execute(self, event: WalletCreated):
         await self.repository.create_wallet(event=event)
 
 
-class DepositCommand(BaseWalletCommand):
-    async def execute(self, event: Deposited):
-        await self.repository.deposit(event=event)
+class DepositCommand(IdempotentWalletCommand):
+    async def apply(self, event: Deposited, idempotency_key: str = None) -> None:
+        if deposit_group_committer.enabled and not idempotency_key:
+            await deposit_group_committer.submit(event)
+        else:
+            await self.repository.deposit(event=event, idempotency_key=idempotency_key)
+
+
+class WithdrawCommand(IdempotentWalletCommand):
+    async def apply(self, event: Withdrawn, idempotency_key: str = None) -> None:
+        await self.repository.withdraw(event=event, idempotency_key=idempotency_key)
 
 
-class WithdrawCommand(BaseWalletCommand):
-    async def execute(self, event: Withdrawn):
-        await self.repository.withdraw(event=event)
+class BatchCommand(BaseWalletCommand):
+    async def execute(self, events: List[Event]) -> List[Exception | None]:
+        return await self.repository.apply_batch(events=events)
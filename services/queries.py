@@ -1,5 +1,13 @@
-from typing import List
-from infrastructure.repository import WalletQueryRepository
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import AsyncIterator
+from domain.exceptions import ProjectionLagError
+from infrastructure.cache import wallet_cache
+from infrastructure.repository import WALLET_PROJECTION, WalletQueryRepository
+
+PROJECTION_WAIT_TIMEOUT = float(os.getenv("PROJECTION_WAIT_TIMEOUT", "2.0"))
 
 
 class BaseWalletQuery:
@@ -8,35 +16,131 @@ class BaseWalletQuery:
 
 
 class WalletQueryService(BaseWalletQuery):
-    async def execute(self, user_id: int = None, wallet_id: str = None) -> dict | None:
-        if user_id:
+    """
+    Look up a wallet through the wallet cache. Pass ``fresh=True`` to skip the
+    cache for reads that must reflect the latest committed state.
+
+    With the asynchronous projection, WalletBalance trails the commands. Pass
+    the ``version`` a command returned as ``min_version`` to read your own
+    writes: the lookup waits, up to ``PROJECTION_WAIT_TIMEOUT`` seconds, until
+    the wallet is projected at that version or later. In synchronous mode
+    every committed command is already visible and ``min_version`` is ignored.
+    """
+
+    def __init__(self, wait_timeout: float = PROJECTION_WAIT_TIMEOUT):
+        super().__init__()
+        self.cache = wallet_cache
+        self.wait_timeout = wait_timeout
+
+    async def execute(
+        self,
+        user_id: int = None,
+        wallet_id: str = None,
+        fresh: bool = False,
+        min_version: int = None,
+    ) -> dict | None:
+        if WALLET_PROJECTION != "async":
+            min_version = None
+
+        if not fresh:
+            if user_id:
+                wallet = await self.cache.get(user_id=user_id)
+            else:
+                wallet = await self.cache.get(wallet_id=wallet_id)
+            if wallet and wallet.get("version", 0) >= (min_version or 0):
+                return wallet
+
+        if min_version:
+            wallet = await self._wait_for_version(user_id, wallet_id, min_version)
+        elif user_id:
             wallet = await self.repository.get_wallet(user_id=user_id)
         else:
             wallet = await self.repository.get_wallet(wallet_id=wallet_id)
 
-        return (
-            None
-            if not wallet
-            else {
-                "wallet_id": wallet.get("wallet_id", ""),
-                "user_id": wallet.get("user_id", ""),
-                "balance": wallet.get("balance", ""),
-            }
+        if not wallet:
+            return None
+
+        wallet = {
+            "wallet_id": wallet.get("wallet_id", ""),
+            "user_id": wallet.get("user_id", ""),
+            "balance": wallet.get("balance", ""),
+            "version": wallet.get("version", 0),
+        }
+        await self.cache.set(wallet)
+        return wallet
+
+    async def _wait_for_version(
+        self, user_id: int, wallet_id: str, min_version: int
+    ) -> dict:
+        """
+        Poll the projection, backing off from 5 to 100 ms, until the wallet
+        reaches ``min_version``.
+
+        Raises:
+            ProjectionLagError: If it did not within the wait timeout.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        delay = 0.005
+        while True:
+            wallet = await self.repository.get_wallet(
+                user_id=user_id, wallet_id=wallet_id
+            )
+            if wallet and wallet.get("version", 0) >= min_version:
+                return wallet
+            if time.monotonic() + delay > deadline:
+                raise ProjectionLagError(
+                    f"Wallet not projected at version {min_version} yet"
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+
+class WalletBalanceQueryService(WalletQueryService):
+    async def execute(
+        self, wallet_id: str, fresh: bool = False, min_version: int = None
+    ) -> float:
+        wallet = await super().execute(
+            wallet_id=wallet_id, fresh=fresh, min_version=min_version
         )
+        if not wallet:
+            raise ValueError("Could not find wallet")
+        return wallet["balance"]
 
 
-class WalletBalanceQueryService(BaseWalletQuery):
-    async def execute(self, wallet_id: str) -> float:
-        return await self.repository.get_balance(wallet_id=wallet_id)
+class WalletBalanceAtQueryService(BaseWalletQuery):
+    async def execute(self, wallet_id: str, at: datetime) -> float:
+        return await self.repository.get_balance_at(wallet_id=wallet_id, at=at)
 
 
 class WalletTransactionQueryService(BaseWalletQuery):
-    async def execute(self, wallet_id: str) -> List[dict]:
-        return await self.repository.get_transactions(wallet_id=wallet_id)
+    async def execute(
+        self, wallet_id: str, limit: int = 100, cursor: str = None
+    ) -> dict:
+        return await self.repository.get_transactions(
+            wallet_id=wallet_id, limit=limit, cursor=cursor
+        )
+
+
+class WalletTransactionStreamQueryService(BaseWalletQuery):
+    def execute(self, wallet_id: str) -> AsyncIterator[dict]:
+        return self.repository.stream_transactions(wallet_id=wallet_id)
 
 
 class WalletReplyEventsQueryService(BaseWalletQuery):
-    async def execute(self, wallet_id: str, from_date: str, to_date: str) -> dict:
+    async def execute(
+        self,
+        wallet_id: str,
+        from_date: datetime,
+        to_date: datetime,
+        include_transactions: bool = False,
+        limit: int = 1000,
+        include_balances: bool = False,
+    ) -> dict:
         return await self.repository.get_events(
-            wallet_id=wallet_id, from_date=from_date, to_date=to_date
+            wallet_id=wallet_id,
+            from_date=from_date,
+            to_date=to_date,
+            include_transactions=include_transactions,
+            limit=limit,
+            include_balances=include_balances,
         )
@@ -0,0 +1,63 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from bson import Binary, Int64
+
+from infrastructure.codec import CompactCodec, PlainCodec
+
+EVENT = {
+    "wallet_id": "6f1c1f1e-7c0e-4a4b-9c64-1a2b3c4d5e6f",
+    "transaction_id": "0b7e8f52-2a8f-4d43-8f1b-52a1f4c9e0d1",
+    "event_type": "Withdrawn",
+    "amount": 12.34,
+    "balance_after": 0.3,
+    "version": 7,
+    "created_at": datetime(2024, 1, 2, 3, 4, 5),
+}
+
+
+@pytest.mark.parametrize("layout", [PlainCodec(), CompactCodec()])
+def test_round_trip(layout):
+    assert layout.decode(layout.encode(EVENT)) == EVENT
+
+
+def test_plain_codec_stores_documents_as_is():
+    layout = PlainCodec()
+
+    assert layout.encode(EVENT) == EVENT
+    assert layout.encode_uuid(EVENT["wallet_id"]) == EVENT["wallet_id"]
+    assert layout.encode_event_type("Deposited") == "Deposited"
+    assert layout.encode_money(1.005) == 1.005
+
+
+def test_compact_codec_stores_compact_types():
+    encoded = CompactCodec().encode(EVENT)
+
+    assert encoded["wallet_id"] == Binary.from_uuid(uuid.UUID(EVENT["wallet_id"]))
+    assert encoded["event_type"] == 4
+    assert encoded["amount"] == Int64(1234)
+    assert isinstance(encoded["amount"], Int64)
+    assert encoded["balance_after"] == Int64(30)
+    assert encoded["version"] == 7
+    assert encoded["created_at"] == EVENT["created_at"]
+
+
+def test_compact_codec_reads_plain_documents():
+    assert CompactCodec().decode(EVENT) == EVENT
+
+
+def test_compact_codec_leaves_non_uuids_as_is():
+    assert CompactCodec().encode_uuid("not-a-uuid") == "not-a-uuid"
+
+
+def test_compact_codec_rejects_amounts_with_more_decimals():
+    with pytest.raises(ValueError):
+        CompactCodec().encode_money(1.005)
+
+
+def test_compact_codec_uses_the_configured_minor_units():
+    layout = CompactCodec(minor_units=3)
+
+    assert layout.encode_money(1.005) == Int64(1005)
+    assert layout.decode_money(Int64(1005)) == 1.005
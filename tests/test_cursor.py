@@ -0,0 +1,46 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from infrastructure.repository import decode_cursor, encode_cursor
+
+TRANSACTION = {
+    "transaction_id": "0b7e8f52-2a8f-4d43-8f1b-52a1f4c9e0d1",
+    "created_at": datetime(2024, 1, 2, 3, 4, 5, 678000),
+    "amount": 10.0,
+}
+
+
+def encoded(position) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def test_round_trip():
+    assert decode_cursor(encode_cursor(TRANSACTION)) == {
+        "created_at": TRANSACTION["created_at"],
+        "transaction_id": TRANSACTION["transaction_id"],
+    }
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(TRANSACTION)
+
+    assert all(c.isalnum() or c in "-_=" for c in cursor)
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "",
+        "not a cursor",
+        base64.urlsafe_b64encode(b"not json").decode(),
+        encoded([]),
+        encoded({"created_at": "2024-01-02T03:04:05"}),
+        encoded({"created_at": "yesterday", "transaction_id": "x"}),
+    ],
+)
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
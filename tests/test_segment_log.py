@@ -0,0 +1,166 @@
+import asyncio
+import os
+
+import pytest
+
+from infrastructure.queue.segment_log import RECORD_HEADER, SegmentLog, SegmentReplayer
+
+# Three records of 5 bytes per segment.
+SEGMENT_SIZE = 3 * (RECORD_HEADER.size + 5)
+
+
+def records(count: int) -> list:
+    return [f"r{i:04d}".encode() for i in range(count)]
+
+
+def segment_files(directory) -> list:
+    return sorted(name for name in os.listdir(directory) if name.endswith(".segment"))
+
+
+def test_reads_appended_records_in_order(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+    for record in records(3):
+        assert log.append(record)
+
+    read, _ = log.read(10)
+
+    assert read == records(3)
+    assert log.appended == 3
+
+
+def test_read_is_repeated_until_committed(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+    for record in records(2):
+        log.append(record)
+
+    first, _ = log.read(10)
+    again, position = log.read(10)
+    log.commit(position)
+
+    assert first == again == records(2)
+    assert log.read(10)[0] == []
+    assert log.empty
+
+
+def test_rejects_empty_and_oversized_records(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+
+    with pytest.raises(ValueError):
+        log.append(b"")
+    with pytest.raises(ValueError):
+        log.append(b"x" * SEGMENT_SIZE)
+
+
+def test_rolls_over_to_new_segments(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+    for record in records(7):
+        log.append(record)
+
+    read, _ = log.read(10)
+
+    assert read == records(7)
+    assert len(segment_files(tmp_path)) == 3
+
+
+def test_commit_deletes_read_segments(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+    for record in records(7):
+        log.append(record)
+
+    read, position = log.read(5)
+    log.commit(position)
+
+    assert read == records(5)
+    assert len(segment_files(tmp_path)) == 2
+    assert log.read(10)[0] == records(7)[5:]
+
+
+def test_drops_records_when_full(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE, max_segments=2)
+    appended = [log.append(record) for record in records(7)]
+
+    assert appended == [True] * 6 + [False]
+    assert log.dropped == 1
+    assert log.read(10)[0] == records(6)
+
+
+def test_full_log_accepts_records_once_read(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE, max_segments=2)
+    for record in records(6):
+        log.append(record)
+
+    _, position = log.read(3)
+    log.commit(position)
+
+    assert log.append(b"after")
+    assert log.read(10)[0] == records(6)[3:] + [b"after"]
+
+
+def test_reopened_log_resumes_after_the_committed_cursor(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+    for record in records(5):
+        log.append(record)
+    _, position = log.read(2)
+    log.commit(position)
+    # Read but not committed: replayed after the restart.
+    log.read(2)
+    log.close()
+
+    reopened = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+
+    assert reopened.read(10)[0] == records(5)[2:]
+
+
+def test_recovery_stops_at_a_corrupted_record(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+    for record in records(3):
+        log.append(record)
+    log.close()
+
+    # Flip a byte of the second record's payload.
+    path = tmp_path / segment_files(tmp_path)[0]
+    data = bytearray(path.read_bytes())
+    data[2 * RECORD_HEADER.size + 5] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+    reopened = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+
+    assert reopened.read(10)[0] == records(1)
+
+
+def test_recovered_log_appends_after_the_last_valid_record(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+    for record in records(2):
+        log.append(record)
+    log.close()
+
+    reopened = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+    reopened.append(b"after")
+
+    assert reopened.read(10)[0] == records(2) + [b"after"]
+
+
+def test_replayer_commits_delivered_records_and_retries_failures(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=SEGMENT_SIZE)
+    for record in records(4):
+        log.append(record)
+    delivered = []
+
+    async def deliver(batch):
+        if not delivered:
+            delivered.append(None)
+            raise ConnectionError("downstream unavailable")
+        delivered.extend(batch)
+
+    async def replay():
+        replayer = SegmentReplayer(log, deliver, batch_size=3, interval=0.01)
+        await replayer.start()
+        while not log.empty:
+            await asyncio.sleep(0.01)
+        await replayer.stop()
+        return replayer
+
+    replayer = asyncio.run(asyncio.wait_for(replay(), timeout=5))
+
+    assert delivered[1:] == records(4)
+    assert replayer.stats() == {"replayed": 4, "replay_failures": 1}